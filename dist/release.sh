@@ -26,7 +26,7 @@ ${SYNC_CMD} macro/private/* ${TMP_DIR}/sd/sys/mos
 ${SYNC_CMD} macro/machine/* ${TMP_DIR}/sd/sys/
 ${SYNC_CMD} macro/movement/* ${TMP_DIR}/sd/sys/
 ${SYNC_CMD} macro/tool-change/* ${TMP_DIR}/sd/sys/
-${SYNC_CMD} post-processors/**/* ${TMP_DIR}/posts/
+${SYNC_CMD} --exclude=bench post-processors/**/* ${TMP_DIR}/posts/
 ${SYNC_CMD} ui/* ${TMP_DIR}/
 
 find ${TMP_DIR}
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Benchmark the move formatter used for every G command emitted
+# by the post-processor, on a synthetic stream of moves.
+import argparse
+import math
+import random
+import time
+
+import standins
+
+post = standins.load_post()
+
+# Generate moves in chunks so generation is not timed and
+# memory usage stays bounded.
+def moves(count, seed, chunk=100000):
+    rng = random.Random(seed)
+    x, y, z = 0.0, 0.0, -1.0
+    for start in range(0, count, chunk):
+        out = []
+        for i in range(start, min(count, start + chunk)):
+            a = i * 0.01
+            x = round(50 + 40 * math.cos(a) + rng.uniform(-0.5, 0.5), 4)
+            y = round(50 + 40 * math.sin(a) + rng.uniform(-0.5, 0.5), 4)
+            if rng.random() < 0.01:
+                z = round(rng.uniform(-5, 0), 1)
+            out.append(dict(X=x, Y=y, Z=z, F=rng.choice((600, 1200, 1800))))
+        yield out
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark post-processor move formatting")
+    parser.add_argument('--moves', type=int, default=1000000, help="Number of moves to format.")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for move generation.")
+    args = parser.parse_args()
+
+    # Move formatters are created for each post-processor instance
+    G = post.MillenniumOSPostProcessor(args=post.parser.parse_args([]))._G
+    lines = 0
+    elapsed = 0.0
+
+    for chunk in moves(args.moves, args.seed):
+        start = time.perf_counter()
+        for params in chunk:
+            cmd, _ = G(post.GCODES.LINEAR, **params)
+            if cmd:
+                ' '.join(cmd)
+                lines += 1
+        elapsed += time.perf_counter() - start
+
+    print("moves:      {}".format(args.moves))
+    print("lines:      {}".format(lines))
+    print("time:       {:.3f}s".format(elapsed))
+    print("lines/sec:  {:.0f}".format(lines / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Benchmark the startup cost of the post-processor, as paid by
+# batch scripts that load it once per job: the time to import
+# it in a fresh interpreter, the time to post a small job after
+# that, and which slow to import modules were loaded by the
+# import itself.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that should only be imported by the options or
+# functions that need them.
+DEFERRED = ['numpy', 'argparse', 'multiprocessing', 'concurrent.futures', 'tempfile',
+    'gzip', 'hashlib', 'Path.Base.Util', 'Path.Post.Utils']
+
+# Run in a fresh interpreter for each sample. Stand-ins are
+# installed before timing, so only the post itself is measured,
+# and stand-in FreeCAD modules are never reported as loaded.
+SAMPLE = '''
+import json, sys, time
+import standins
+standins.install()
+import jobs
+sys.path.insert(0, standins.POST_DIR)
+before = set(sys.modules)
+
+start = time.perf_counter()
+import millennium_os_post as post
+imported = time.perf_counter() - start
+loaded = sorted(set(sys.modules) - before)
+
+objects = jobs.job(['facing'], {size}, 1)
+start = time.perf_counter()
+pp = post.MillenniumOSPostProcessor(args=post.parser.parse_args([]))
+pp.parse(objects)
+pp.output()
+posted = time.perf_counter() - start
+
+print(json.dumps({{'import': imported, 'post': posted, 'loaded': loaded}}))
+'''
+
+def sample(size):
+    out = subprocess.run([sys.executable, '-c', SAMPLE.format(size=size)], cwd=BENCH_DIR,
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+def ms(seconds):
+    return '{:.1f}ms'.format(seconds * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark post-processor import and startup time")
+    parser.add_argument('--runs', type=int, default=20, help="Number of fresh interpreters to sample.")
+    parser.add_argument('--size', type=int, default=100, help="Approximate number of moves in the job posted after import.")
+    args = parser.parse_args()
+
+    samples = [sample(args.size) for _ in range(args.runs)]
+    imports = [s['import'] for s in samples]
+    posts = [s['post'] for s in samples]
+    loaded = set(samples[0]['loaded'])
+
+    print("runs:              {}".format(args.runs))
+    print("import time:       {} median, {} min".format(ms(statistics.median(imports)), ms(min(imports))))
+    print("first post time:   {} median, {} min".format(ms(statistics.median(posts)), ms(min(posts))))
+    print("modules imported:  {}".format(len(loaded)))
+    eager = [name for name in DEFERRED if name in loaded]
+    print("deferred modules:  {}".format(', '.join(eager) + ' imported eagerly' if eager else 'none imported eagerly'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Benchmark parsing and output of whole synthetic jobs by the
+# post-processor, reporting throughput, peak memory usage and
+# output size.
+import argparse
+import shlex
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import standins
+
+post = standins.load_post()
+
+import jobs
+
+# Peak resident set size of this process in bytes, or
+# None if it cannot be measured on this platform.
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def mib(value):
+    return 'n/a' if value is None else '{:.1f}MiB'.format(value / (1 << 20))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark post-processor parsing and output")
+    parser.add_argument('--ops', default='facing,adaptive,drilling,surface',
+        help="Comma-separated operation kinds to include, from: {}.".format(', '.join(jobs.GENERATORS)))
+    parser.add_argument('--size', type=int, default=100000, help="Approximate number of moves per operation.")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for job generation.")
+    parser.add_argument('--args', default='', help="Post-processor arguments, as passed by FreeCAD, e.g. --args='--stream --batch'.")
+    args = parser.parse_args()
+
+    kinds = [k.strip() for k in args.ops.split(',') if k.strip()]
+    for kind in kinds:
+        if kind not in jobs.GENERATORS:
+            parser.error("Unknown operation kind {}".format(kind))
+
+    objects = jobs.job(kinds, args.size, args.seed)
+    commands = sum(len(o.Path.Commands) for o in objects)
+    baseline = peak_rss()
+
+    pp = post.MillenniumOSPostProcessor(args=post.parser.parse_args(shlex.split(args.args)))
+
+    start = time.perf_counter()
+    pp.parse(objects)
+    parsed = time.perf_counter() - start
+    parse_rss = peak_rss()
+
+    start = time.perf_counter()
+    out = pp.output()
+    output = time.perf_counter() - start
+    output_rss = peak_rss()
+
+    lines = out.count('\n') + 1
+    size = len(out.encode('utf-8'))
+
+    print("operations:        {}".format(', '.join(kinds)))
+    print("commands:          {}".format(commands))
+    print("lines:             {}".format(lines))
+    print("output bytes:      {}".format(size))
+    print("parse time:        {:.3f}s ({:.0f} commands/sec)".format(parsed, commands / parsed))
+    print("output time:       {:.3f}s ({:.0f} lines/sec)".format(output, lines / output))
+    print("total:             {:.0f} lines/sec".format(lines / (parsed + output)))
+    if baseline is not None:
+        print("peak RSS:          {} (job), {} (after parse), {} (after output)".format(
+            mib(baseline), mib(parse_rss), mib(output_rss)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Benchmark the per-command cost of converting command parameters
+# to machine units, comparing a new Quantity per parameter against
+# the conversion used by the post-processor.
+import argparse
+import random
+import time
+
+import standins
+
+post = standins.load_post()
+
+from FreeCAD import Units
+
+# Reference conversion, creating a Quantity for every parameter
+def quantity_param(key, value):
+    if key == post.ARGS.FEED:
+        return int(Units.Quantity(value, Units.Velocity).getValueAs(post.UNITS.FEED))
+    if key in post.LENGTH_ARGS:
+        return float(Units.Quantity(value, Units.Length).getValueAs(post.UNITS.LENGTH))
+    return value
+
+def commands(count, seed):
+    rng = random.Random(seed)
+    feeds = [rng.uniform(5, 50) for _ in range(8)]
+    return [{
+        'X': rng.uniform(0, 100),
+        'Y': rng.uniform(0, 100),
+        'Z': rng.uniform(-5, 0),
+        'F': rng.choice(feeds),
+    } for _ in range(count)]
+
+def timed(fn, cmds):
+    start = time.perf_counter()
+    for params in cmds:
+        for k, v in params.items():
+            fn(k, v)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark post-processor unit conversion")
+    parser.add_argument('--commands', type=int, default=500000, help="Number of commands to convert.")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for command generation.")
+    args = parser.parse_args()
+
+    cmds = commands(args.commands, args.seed)
+    pp = post.MillenniumOSPostProcessor(args=post.parser.parse_args([]))
+
+    before = timed(quantity_param, cmds)
+    after = timed(lambda k, v: pp._parseparam(post.GCODES.LINEAR, k, v), cmds)
+
+    print("commands:            {}".format(args.commands))
+    print("quantity per param:  {:.0f}ns/command".format(before / args.commands * 1e9))
+    print("cached conversion:   {:.0f}ns/command".format(after / args.commands * 1e9))
+    print("speedup:             {:.1f}x".format(before / after))
+
+if __name__ == '__main__':
+    main()
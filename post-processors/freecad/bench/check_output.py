@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+# Behavioural checks of whole posts and the files they write.
+# Each check posts synthetic jobs through export(), as FreeCAD
+# does, and asserts properties of the returned gcode and of the
+# files written alongside it. Run with no arguments to run every
+# check, or name the checks to run.
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shlex
+import sys
+import tempfile
+import tracemalloc
+
+import standins
+
+post = standins.load_post()
+
+import jobs
+
+from standins import Fixture, Operation, ToolController
+
+# Lines of gcode, without the output time which changes
+# between posts.
+def lines(gcode):
+    return [line for line in gcode.split('\n') if not line.startswith('(Output Time')]
+
+# Post the objects as FreeCAD does, returning the gcode
+def export(objects, args='', filename='-'):
+    return post.export(objects, filename, '--no-show-editor ' + args)
+
+# Posts in the same process with different arguments must each
+# use their own arguments, including for operations formatted on
+# their own to be cached, and for operations formatted by worker
+# processes.
+def check_posts():
+    objects = jobs.job(['pocket', 'surface'], 3000)
+    settings = ['', '--simplify --simplify-dp --simplify-tolerance 0.5', '--precision roughing']
+    expected = [lines(export(objects, args)) for args in settings]
+    assert expected[0] != expected[1] != expected[2], "arguments do not change the output"
+
+    for mode in ('--cache-dir {}', '--parallel 2', '--parallel 2 --cache-dir {}'):
+        for args, want in zip(settings, expected):
+            with tempfile.TemporaryDirectory() as cache:
+                extra = mode.format(cache)
+                assert lines(export(objects, args + ' ' + extra)) == want, \
+                    "{} {}: output differs from a post on its own".format(args, extra)
+
+                # Reposting is served from the cache written above
+                assert lines(export(objects, args + ' ' + extra)) == want, \
+                    "{} {}: cached output differs from a post on its own".format(args, extra)
+
+# Post to a file in a new directory, returning the result of
+# export, the peak memory allocated while posting and the path
+# of the file written.
+def measured(objects, args, directory, name='job.gcode'):
+    filename = os.path.join(directory, name)
+    tracemalloc.start()
+    try:
+        out = export(objects, args, filename)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return out, peak, filename
+
+def read(path):
+    with open(path, encoding='utf-8', newline='') as fh:
+        return fh.read()
+
+def contents(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+# Streaming writes the same gcode as posting in memory, returns
+# nothing, and needs memory that does not grow with the output.
+# Both jobs write more than the spool buffer size, so buffers of
+# a fixed size are full in both.
+def check_stream():
+    sizes, peaks = [], []
+    for size in (80000, 240000):
+        objects = jobs.job(['surface'], size)
+        with tempfile.TemporaryDirectory() as a, tempfile.TemporaryDirectory() as b:
+            out, peak, streamed = measured(objects, '--stream', a)
+            text, _, written = measured(objects, '--checksum sha256', b)
+
+            assert out is None, "streaming returned the gcode"
+            assert text is not None and lines(read(written)) == lines(text), "file differs from the returned gcode"
+            assert lines(read(streamed)) == lines(read(written)), "streamed file differs from the file written in memory"
+            sizes.append(os.path.getsize(streamed))
+            peaks.append(peak)
+
+    growth = peaks[1] - peaks[0]
+    assert growth < (sizes[1] - sizes[0]) / 2, \
+        "peak memory grew by {} bytes for {} more bytes of output".format(growth, sizes[1] - sizes[0])
+
+# Conditional blocks that restore the machine state at each
+# resume point, by operation, as lists of their lines.
+def resumes(gcode):
+    blocks = {}
+    label, block = None, None
+    for line in gcode.split('\n'):
+        if block is not None:
+            if line.startswith('  '):
+                block.append(line.strip())
+                continue
+            blocks[label], block = block, None
+        if line.startswith('(Resume point'):
+            label = line.split(': ', 1)[1][:-1]
+        elif line.startswith('if {') and label is not None:
+            block = []
+    return blocks
+
+MOTION = re.compile(r'^G(0|1|2|3|73|81|83)( |$)')
+
+# Resume points restore the state of the machine without moving
+# the tool, whichever stages buffer moves, and leave the moves of
+# the job unchanged. A move still buffered by a stage when a
+# resume point is output is emitted before it.
+def check_resume():
+    objects = jobs.job(['pocket', 'drilling', 'adaptive', 'surface'], 2000)
+    for stages in ('', '--optimise-rapids --arc-fit --simplify --keep-tool-down safe', '--air-moves rapid --canned-cycles --merge-arcs --arc-fit'):
+        a = [line for line in lines(export(objects, stages)) if MOTION.match(line)]
+        out = export(objects, stages + ' --resume-points')
+        blocks = resumes(out)
+        assert list(blocks) == [o.Label for o in objects if isinstance(o, standins.Operation)], \
+            "{}: resume points are {}".format(stages, list(blocks))
+        for label, block in blocks.items():
+            assert 'G27' in block, "{}: {} does not park".format(stages, label)
+            moved = [line for line in block if MOTION.match(line)]
+            assert not moved, "{}: {} moves the tool with {}".format(stages, label, moved)
+        b = [line for line in lines(out) if MOTION.match(line)]
+        assert a == b, "{}: moves differ with resume points".format(stages)
+
+    class Buffered(post.MillenniumOSPostProcessor):
+        def resumepoint(self, label):
+            if self.operations > 1:
+                self.onmove(post.GCODES.LINEAR, {post.ARGS.X: 123.25})
+            super().resumepoint(label)
+
+    pp = Buffered(args=post.parser.parse_args(shlex.split('--resume-points --simplify')))
+    pp.parse(objects)
+    out = pp.output()
+    assert out.index('G1 X123.25') < out.index('(Resume point 2'), "buffered move was output after the resume point"
+
+# Lines of the restore block at the start of a part file, or None
+# if it restores nothing, and the lines of the rest of the part.
+def restored(gcode):
+    found = gcode.split('(Restore machine state)\n', 1)
+    if len(found) < 2:
+        return None, lines(gcode)
+    state, rest = found[1].split('\n\n', 1)
+    return state.split('\n'), lines(rest)
+
+# Split jobs are run by a master file calling each part in order,
+# and the parts hold every move of the job between them. A part
+# restores the state it starts in, except for the tool and spindle
+# if it changes tool before its first move.
+def check_split():
+    objects = jobs.job(['pocket', 'drilling', 'adaptive', 'surface'], 2000)
+    a = [line for line in lines(export(objects)) if MOTION.match(line)]
+    for args in ('--split-lines 3000', '--split-bytes 20000', '--split-lines 3000 --split-path 0:/gcodes/job/'):
+        with tempfile.TemporaryDirectory() as d:
+            master = export(objects, args, os.path.join(d, 'job.gcode'))
+            names = sorted(os.listdir(d))
+            path = args.split('--split-path ')[1] if '--split-path' in args else '0:/gcodes/'
+            calls = re.findall(r'^M98 P"(.*)"$', master, re.M)
+
+            assert len(names) > 1, "{}: job was not split".format(args)
+            assert names == ['job-{:03d}.gcode'.format(n) for n in range(1, len(names) + 1)], \
+                "{}: parts are {}".format(args, names)
+            assert calls == [path + name for name in names], "{}: master calls {}".format(args, calls)
+            assert not any(MOTION.match(line) for line in lines(master)), "{}: master moves the tool".format(args)
+
+            b = []
+            for name in names:
+                part = read(os.path.join(d, name))
+                moved = [line for line in lines(part) if MOTION.match(line)]
+                b.extend(moved)
+
+                state, rest = restored(part)
+                assert (state is None) == (name == names[0]), "{}: {} restore block is {}".format(args, name, state)
+                first = next(i for i, line in enumerate(rest) if MOTION.match(line))
+                if state is not None and any(re.match(r'^T\d+$', line) for line in rest[:first]):
+                    tools = [line for line in state if re.match(r'^(T\d+|M3\.9|M4\.9)', line)]
+                    assert not tools, "{}: {} restores {} before changing tool".format(args, name, tools)
+
+            assert a == b, "{}: parts do not hold the moves of the job".format(args)
+
+# Line stores hold the lines given to them in output order, with
+# prepended lines first, and serve any range of byte offsets of
+# the encoded output, as split files are written from. Spooled
+# stores can only be appended to.
+def check_store():
+    rng = random.Random(1)
+    words = ['G1', 'X1.5', 'Y-20', 'Z0.125', 'F300', '(Begin Operation: Pocket)', '(Tool: \u00d86 \u00b5m)', '']
+    for kind in (post.LineStore, post.SpoolStore):
+        store, head, tail = kind(), [], []
+        for _ in range(3000):
+            new = [' '.join(rng.choices(words, k=rng.randrange(3))) for _ in range(rng.randrange(1, 4))]
+            action = rng.choice(('append', 'extend', 'prepend') if kind is post.LineStore else ('append', 'extend'))
+            if action == 'append':
+                store.append(new[0])
+                tail.append(new[0])
+            elif action == 'extend':
+                store.extend(new)
+                tail.extend(new)
+            else:
+                store.prepend(new)
+                head[:0] = new
+
+        name = kind.__name__
+        expected = head + tail
+        data = ''.join(line + '\n' for line in expected).encode('utf-8')
+        assert list(store) == expected, "{}: lines differ".format(name)
+        assert len(store) == len(expected), "{}: holds {} lines, not {}".format(name, len(store), len(expected))
+        assert store.size == len(data), "{}: size is {}, not {}".format(name, store.size, len(data))
+        assert b''.join(store.buffers()) == data, "{}: buffers differ from the encoded lines".format(name)
+        for _ in range(500):
+            start, end = sorted(rng.randrange(len(data) + 1) for _ in range(2))
+            got = b''.join(store.buffers(start, end))
+            assert got == data[start:end], "{}: bytes {} to {} differ".format(name, start, end)
+
+WORD = re.compile(r'([A-Z])(-?\d+(?:\.\d*)?)')
+SETTINGS = ('G17', 'G20', 'G21', 'G90', 'G91', 'G94')
+
+# Extents of the moves of each operation, measured from the
+# output, and the WCS of each operation. Arcs are sampled along
+# their sweep, and canned cycles reach both their depth and
+# retract plane. The position is unknown after the machine parks
+# or changes WCS.
+def measure(gcode):
+    ops, wcss = {}, {}
+    label, wcs = None, None
+    pos = [None, None, None]
+    cycle = {}
+    for line in lines(gcode):
+        if line.startswith('(Begin Operation: '):
+            label = line[len('(Begin Operation: '):-1]
+            ops[label] = ([math.inf] * 3, [-math.inf] * 3)
+            wcss[label] = wcs
+            continue
+        motion = MOTION.match(line)
+        if not motion:
+            if re.match(r'^G5[4-9](\.\d)?$', line):
+                wcs = line
+            if line.startswith('G') and line.split()[0] not in SETTINGS:
+                pos = [None, None, None]
+            continue
+
+        code = int(motion.group(1))
+        words = {k: float(v) for k, v in WORD.findall(line[motion.end():])}
+        end = [words.get(axis, p) for axis, p in zip('XYZ', pos)]
+        points = [end]
+        if code in (2, 3) and None not in pos[:2]:
+            cx, cy = pos[0] + words.get('I', 0), pos[1] + words.get('J', 0)
+            r = math.hypot(pos[0] - cx, pos[1] - cy)
+            a0 = math.atan2(pos[1] - cy, pos[0] - cx)
+            a1 = math.atan2(end[1] - cy, end[0] - cx)
+            sweep = (a1 - a0) % (2 * math.pi) if code == 3 else -((a0 - a1) % (2 * math.pi))
+            if abs(sweep) < 1e-9:
+                sweep = 2 * math.pi if code == 3 else -2 * math.pi
+            points += [(cx + r * math.cos(a0 + sweep * i / 3600), cy + r * math.sin(a0 + sweep * i / 3600), None)
+                for i in range(3601)]
+        elif code not in (0, 1, 2, 3):
+            cycle.update((k, v) for k, v in words.items() if k in 'ZR')
+            end = [end[0], end[1], cycle['R']]
+            points = [(None, None, cycle['Z']), end]
+        pos = end
+
+        if label is not None:
+            lo, hi = ops[label]
+            for point in points:
+                for i, v in enumerate(point):
+                    if v is not None:
+                        lo[i], hi[i] = min(lo[i], v), max(hi[i], v)
+    return ops, wcss
+
+# Extents of each operation as reported in the preamble
+def reported(gcode):
+    found = re.findall(r'^\(    (.+?) +X (\S+) to (\S+), Y (\S+) to (\S+), Z (\S+) to (\S+)\)$', gcode, re.M)
+    return {label: ([float(v) for v in values[0::2]], [float(v) for v in values[1::2]]) for label, *values in found}
+
+# Post expecting the limits to be exceeded, returning the lines
+# of the error, or None if the post succeeds.
+def exceeded(objects, args):
+    try:
+        export(objects, '--check-limits ' + args)
+    except ValueError as e:
+        return str(e).split('\n')[1:]
+    return None
+
+# Limit checks report the extents of every operation, including
+# the arcs they sweep through, and fail only for the operations
+# that leave the soft limits, or WCSs whose moves cover more than
+# the machine travel.
+def check_limits():
+    objects = jobs.job(['pocket', 'drilling', 'adaptive', 'surface'], 2000)
+    out = export(objects, '--check-limits')
+    ops, wcss = measure(out)
+    extents = reported(out)
+    assert sorted(extents) == sorted(ops), "extents are reported for {}".format(list(extents))
+    for label, (lo, hi) in ops.items():
+        for axis, a, b in zip('XYZ', lo + hi, extents[label][0] + extents[label][1]):
+            assert abs(a - b) < 2e-3, "{}: {} extent is reported as {}, not {:.3f}".format(label, axis, b, a)
+
+    lo = [min(ops[label][0][i] for label in ops) for i in range(3)]
+    hi = [max(ops[label][1][i] for label in ops) for i in range(3)]
+    fits = ','.join('{}:{:.3f}:{:.3f}'.format(axis, l - 0.01, h + 0.01) for axis, l, h in zip('XYZ', lo, hi))
+    assert exceeded(objects, '--soft-limits ' + fits) is None, "moves within the soft limits failed"
+
+    for i, axis in enumerate('XYZ'):
+        for limit in (hi[i] - 0.5, lo[i] + 0.5):
+            low, high = (lo[i] - 0.01, limit) if limit < hi[i] else (limit, hi[i] + 0.01)
+            errors = exceeded(objects, '--soft-limits {}:{:.3f}:{:.3f}'.format(axis, low, high))
+            outside = {label for label, (olo, ohi) in ops.items() if olo[i] < low or ohi[i] > high}
+            named = {re.search(r'of operation (.+) \(', e).group(1) for e in errors or []}
+            assert named == outside, "{} {} to {}: failed for {}, not {}".format(axis, low, high, named, outside)
+
+    # Machine travel is checked against the moves in each WCS
+    spans = {}
+    for label, (olo, ohi) in ops.items():
+        l, h = spans.get(wcss[label], (math.inf, -math.inf))
+        spans[wcss[label]] = (min(l, olo[0]), max(h, ohi[0]))
+    with tempfile.TemporaryDirectory() as d:
+        for margin in (1.0, -1.0):
+            span = max(h - l for l, h in spans.values()) + margin
+            machine = os.path.join(d, 'machine.mch')
+            with open(machine, 'w', encoding='utf-8') as fh:
+                json.dump({'kinematics': {'default': {'parts': [{'id': 'X', 'min': 0, 'max': span}]}}}, fh)
+            errors = exceeded(objects, '--machine-file ' + machine)
+            if margin > 0:
+                assert errors is None, "moves within the machine travel failed: {}".format(errors)
+            else:
+                assert errors and all('more than the machine travel' in e for e in errors), \
+                    "moves beyond the machine travel gave {}".format(errors)
+
+# Checksum files list a digest of every file written, including
+# split parts and compressed copies, and compressed copies hold
+# the same gcode as the files they are copies of.
+def check_checksums():
+    objects = jobs.job(['pocket', 'surface'], 2000)
+    settings = ['--checksum sha256 --compress gzip', '--checksum md5', '--checksum sha256 --compress gzip --stream',
+        '--checksum sha256 --compress gzip --split-lines 3000 --index']
+    if post.zstd() is not None:
+        settings.append('--checksum sha256 --compress zstd')
+
+    for args in settings:
+        algorithm = args.split('--checksum ')[1].split()[0]
+        compress = args.split('--compress ')[1].split()[0] if '--compress' in args else None
+        with tempfile.TemporaryDirectory() as d:
+            out = export(objects, args, os.path.join(d, 'job.gcode'))
+            names = sorted(os.listdir(d))
+            gcode = [name for name in names if name.endswith('.gcode')]
+            copies = {'gzip': '.gz', 'zstd': '.zst'}
+            expected = sorted(gcode + [name + copies[compress] for name in gcode] if compress else gcode)
+
+            with open(os.path.join(d, 'job.' + algorithm), encoding='utf-8') as fh:
+                listed = dict(reversed(line.split('  ', 1)) for line in fh.read().splitlines())
+            assert sorted(listed) == expected, "{}: checksums are listed for {}".format(args, sorted(listed))
+            for name, digest in listed.items():
+                with open(os.path.join(d, name), 'rb') as fh:
+                    actual = hashlib.new(algorithm, fh.read()).hexdigest()
+                assert digest == actual, "{}: {} digest is {}, not {}".format(args, name, digest, actual)
+
+            for name in gcode if compress else []:
+                with open(os.path.join(d, name), 'rb') as fh:
+                    data = fh.read()
+                path = os.path.join(d, name + copies[compress])
+                zst = post.zstd()
+                if compress == 'gzip':
+                    opened = gzip.open(path)
+                elif hasattr(zst, 'ZstdFile'):
+                    opened = zst.ZstdFile(path)
+                else:
+                    opened = zst.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+                with opened as fh:
+                    copy = fh.read()
+                assert copy == data, "{}: {} differs from {}".format(args, name + copies[compress], name)
+
+            if out is not None:
+                assert lines(read(os.path.join(d, 'job.gcode'))) == lines(out), "{}: file differs from the returned gcode".format(args)
+
+# The operations of the output in order, each with the WCS and
+# tool it runs with, and its moves.
+def operations(gcode):
+    ops = []
+    wcs, tool = None, None
+    for line in lines(gcode):
+        if re.match(r'^G5[4-9](\.\d)?$', line):
+            wcs = line
+        elif re.match(r'^T\d+$', line):
+            tool = line
+        elif line.startswith('(Begin Operation: '):
+            ops.append((line[len('(Begin Operation: '):-1], wcs, tool, []))
+        elif ops and MOTION.match(line):
+            ops[-1][3].append(line)
+    return ops
+
+# Number of times the tool changes in the output
+def toolchanges(gcode):
+    tools = [line for line in lines(gcode) if re.match(r'^T\d+$', line)]
+    return sum(1 for a, b in zip(tools, tools[1:]) if a != b)
+
+# Grouping by tool runs the same operations, each in its own WCS
+# with its own tool and moves, with fewer tool changes. Operations
+# in the same WCS and operations that must follow others keep
+# their order.
+def check_tools():
+    kinds = itertools.cycle(['pocket', 'drilling', 'adaptive'])
+    def job(follows=None):
+        objects = []
+        for n, wcs in enumerate(('G54', 'G55', 'G56')):
+            objects.append(Fixture(wcs))
+            for tool in (1, 2, 3):
+                objects.append(ToolController(tool, 6.0 / tool, 18000))
+                label = '{}{}'.format(wcs, tool)
+                op = Operation(label, jobs.GENERATORS[next(kinds)](300, n * 3 + tool), None, jobs.SAFE)
+                if follows and label in follows:
+                    op.PostFollows = follows[label]
+                objects.append(op)
+        return objects
+
+    for follows in (None, {'G552': 'G543'}, {'G561': ['G553', 'G542']}):
+        objects = job(follows)
+        a, b = export(objects), export(objects, '--group-tools')
+        before, after = operations(a), operations(b)
+        report = re.search(r'^\(Operations grouped by tool: (\d+) tool changes, (\d+) saved\)$', b, re.M)
+
+        assert sorted(before) == sorted(after), "{}: operations differ when grouped".format(follows)
+        assert toolchanges(b) < toolchanges(a), "{}: tool changes were not reduced".format(follows)
+        assert report and int(report.group(1)) == toolchanges(b) + 1, "{}: report is {}".format(follows, report)
+        assert int(report.group(2)) == toolchanges(a) - toolchanges(b), "{}: report is {}".format(follows, report.group(0))
+
+        order = [label for label, *_ in after]
+        for wcs in ('G54', 'G55', 'G56'):
+            ran = [label for label in order if label.startswith(wcs)]
+            assert ran == sorted(ran), "{}: {} operations ran as {}".format(follows, wcs, ran)
+        for label, first in (follows or {}).items():
+            for other in [first] if isinstance(first, str) else first:
+                assert order.index(other) < order.index(label), "{}: {} ran before {}".format(follows, label, other)
+
+# WCS numbers probed, in order, and the WCS numbers in the order
+# the operations use them.
+def probes(gcode):
+    probed, used, wcs = [], [], None
+    for line in lines(gcode):
+        found = re.match(r'^G6600(?: W(\d+))?$', line)
+        if found:
+            probed.append(int(found.group(1)) if found.group(1) else wcs)
+        elif re.match(r'^G5[4-9]$', line):
+            wcs = int(line[1:]) - 53
+        elif line.startswith('(Begin Operation: '):
+            used.append(wcs)
+    return probed, used
+
+# Each WCS used is probed once. Probing at start probes every
+# WCS before the first operation, in the order they are first used
+# or, given their positions, working back from the first WCS used
+# to the nearest one not yet probed. Probing on change probes each
+# WCS when it is first switched to.
+def check_probes():
+    objects = []
+    for n, wcs in enumerate(('G56', 'G54', 'G57', 'G54', 'G55', 'G56')):
+        objects += [Fixture(wcs), ToolController(1, 6.0, 18000),
+            Operation('Op{}'.format(n), jobs.GENERATORS['pocket'](100, n), None, jobs.SAFE)]
+    positions = {1: (0, 0), 2: (300, 0), 3: (120, 0), 4: (190, 50)}
+
+    out = export(objects, '--probe-at-start')
+    probed, used = probes(out)
+    first = list(dict.fromkeys(used))
+    assert probed == first, "probed at start in the order {}, not {}".format(probed, first)
+    assert out.rindex('G6600') < out.index('(Begin Operation'), "probed at start after an operation"
+
+    out = export(objects, '--probe-at-start --wcs-positions ' + ','.join(
+        '{}:{}:{}'.format(wcs, x, y) for wcs, (x, y) in positions.items()))
+    probed, _ = probes(out)
+    assert sorted(probed) == sorted(first), "probed {} given positions".format(probed)
+    assert probed[-1] == first[0], "probing given positions ends at WCS {}".format(probed[-1])
+    for k in range(len(probed) - 1, 0, -1):
+        nearest = min(probed[:k], key=lambda w: math.dist(positions[w], positions[probed[k]]))
+        assert math.dist(positions[probed[k - 1]], positions[probed[k]]) == \
+            math.dist(positions[nearest], positions[probed[k]]), "WCS {} is not preceded by the nearest WCS".format(probed[k])
+
+    out = export(objects, '--probe-on-change')
+    probed, used = probes(out)
+    assert probed == first, "probed on change in the order {}, not {}".format(probed, first)
+    switches = re.findall(r'^G5([4-9])\n\n\((Probe origin in current WCS|WCS \d+ already probed)\)$', out, re.M)
+    assert len(switches) == len(used), "{} WCS switches for {} operations".format(len(switches), len(used))
+    seen = set()
+    for code, action in switches:
+        wcs = int(code) - 3
+        assert (action == 'Probe origin in current WCS') == (wcs not in seen), \
+            "WCS {} {} on change".format(wcs, 'was probed again' if wcs in seen else 'was not probed')
+        seen.add(wcs)
+
+    probed, _ = probes(export(objects, '--no-probe'))
+    assert not probed, "probed {} with probing disabled".format(probed)
+
+# Index entries point at the line that starts each operation,
+# tool change and WCS change, by line number and byte offset, in
+# whichever file holds it.
+def check_index():
+    objects = jobs.job(['pocket', 'drilling', 'adaptive', 'surface'], 2000)
+    labels = [o.Label for o in objects if isinstance(o, Operation)]
+    for args in ('--index', '--index --stream', '--index --resume-points --split-lines 3000',
+            '--index --checksum sha256 --compress gzip --split-bytes 40000'):
+        with tempfile.TemporaryDirectory() as d:
+            export(objects, args, os.path.join(d, 'job.gcode'))
+            with open(os.path.join(d, 'job.index.json'), encoding='utf-8') as fh:
+                index = json.load(fh)
+
+            assert index['file'] == 'job.gcode', "{}: index is of {}".format(args, index['file'])
+            assert index['resume_points'] == ('--resume-points' in args), "{}: resume points are {}".format(args, index['resume_points'])
+            entries = index['entries']
+            named = [entry['name'] for entry in entries if entry['type'] == 'operation']
+            assert named == labels, "{}: operations indexed are {}".format(args, named)
+            assert [entry['type'] for entry in entries] == ['wcs', 'tool', 'operation'] * len(labels), \
+                "{}: entries are {}".format(args, [entry['type'] for entry in entries])
+            files = [entry['file'] for entry in entries]
+            assert files == sorted(files), "{}: entries are out of file order".format(args)
+
+            for entry in entries:
+                data = contents(os.path.join(d, entry['file']))
+                offset = entry['offset']
+                assert offset == 0 or data[offset - 1:offset] == b'\n', "{}: {} is not at the start of a line".format(args, entry)
+                line = data[offset:].split(b'\n', 1)[0].decode('utf-8')
+                number = data[:offset].count(b'\n') + 1
+                assert entry['line'] == number, "{}: {} is on line {}".format(args, entry, number)
+
+                if entry['type'] == 'operation':
+                    assert line == '(Begin Operation: {})'.format(entry['name']), "{}: {} is at {}".format(args, entry, line)
+                elif entry['type'] == 'tool':
+                    assert line == 'T{}'.format(entry['tool']), "{}: {} is at {}".format(args, entry, line)
+                else:
+                    # A part may end with the park before a WCS
+                    # change, and the next part switch WCS.
+                    rest = data[offset:] + b''.join(contents(os.path.join(d, name))
+                        for name in sorted(os.listdir(d)) if name.endswith('.gcode') and name > entry['file'])
+                    switch = re.search(rb'^\(Switch to WCS (\d+)\)$', rest, re.M)
+                    assert line in ('(Park ready for WCS change)', '(Switch to WCS {})'.format(entry['wcs'])) and \
+                        int(switch.group(1)) == entry['wcs'], "{}: {} is at {}".format(args, entry, line)
+
+CHECKS = {
+    'posts': check_posts,
+    'stream': check_stream,
+    'resume': check_resume,
+    'split': check_split,
+    'store': check_store,
+    'limits': check_limits,
+    'checksums': check_checksums,
+    'tools': check_tools,
+    'probes': check_probes,
+    'index': check_index,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check whole posts and the files they write")
+    parser.add_argument('checks', nargs='*', help="Checks to run, from: {}. All by default.".format(', '.join(CHECKS)))
+    args = parser.parse_args()
+
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error("Unknown check {}".format(name))
+
+    failed = 0
+    for name in args.checks or CHECKS:
+        try:
+            CHECKS[name]()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL {}: {}".format(name, e))
+        else:
+            print("ok   {}".format(name))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,640 @@
+#!/usr/bin/env python3
+# Behavioural checks of the move pipeline stages. Each check posts
+# small synthetic operations with and without a stage enabled and
+# asserts properties of the output gcode that must hold whatever
+# the stage does to it, so regressions are caught rather than only
+# timed. Run with no arguments to run every check, or name the
+# checks to run.
+import argparse
+import collections
+import itertools
+import math
+import random
+import shlex
+import sys
+
+import standins
+
+post = standins.load_post()
+
+import jobs
+
+from standins import Command, Fixture, Job, Operation, ToolController
+
+CLEARANCE = 15.0
+SAFE      = 3.0
+EPSILON   = 1e-3
+
+CYCLES = (73, 81, 83)
+
+# A move parsed from the output, with the positions before and
+# after it. Canned cycle parameters left out of a cycle are filled
+# in from earlier cycles, as the cycle macros store them.
+Move = collections.namedtuple('Move', ['code', 'params', 'start', 'end'])
+
+# Post one operation with the given commands and post-processor
+# arguments, returning the output gcode.
+def run(commands, args='', safe=SAFE, stock=None, diameter=6.0):
+    job = Job(stock) if stock is not None else None
+    objects = [Fixture('G54'), ToolController(1, diameter, 18000), Operation('Op', commands, job, safe)]
+    pp = post.MillenniumOSPostProcessor(args=post.parser.parse_args(shlex.split(args)))
+    pp.parse(objects)
+    return pp.output()
+
+# Parse the moves of the output gcode
+def moves(gcode):
+    pos = {'X': None, 'Y': None, 'Z': None}
+    cycle = {}
+    out = []
+    for line in gcode.split('\n'):
+        words = line.split()
+        if not words or words[0][0] != 'G':
+            continue
+        code = float(words[0][1:])
+        if code not in (0, 1, 2, 3) + CYCLES:
+            continue
+
+        params = {w[0]: float(w[1:]) for w in words[1:]}
+        end = dict(pos)
+        for k in 'XYZ':
+            if k in params:
+                end[k] = params[k]
+        if code in CYCLES:
+            cycle.update((k, v) for k, v in params.items() if k in 'ZRQF')
+            params = dict(cycle, **params)
+            end['Z'] = params['R']
+        out.append(Move(code, params, pos, end))
+        pos = end
+    return out
+
+def distance(a, b):
+    return math.hypot(a['X'] - b['X'], a['Y'] - b['Y'])
+
+# Total XY distance of the rapid moves
+def travel(ms):
+    return sum(distance(m.start, m.end) for m in ms if m.code == 0 and None not in (m.start['X'], m.start['Y']))
+
+# Positions of the holes drilled by feed moves straight down to
+# the given depth, and by canned cycles, with the parameters of
+# each cycle.
+def holes(ms, depth=None):
+    found = []
+    for m in ms:
+        if m.code in CYCLES:
+            peck = m.params.get('Q') if m.code != 81 else None
+            found.append((m.end['X'], m.end['Y'], m.code, m.params['Z'], m.params['R'], peck, m.params.get('F')))
+        elif m.code == 1 and depth is not None and abs(m.end['Z'] - depth) < EPSILON and distance(m.start, m.end) < EPSILON:
+            found.append((m.end['X'], m.end['Y']))
+    return found
+
+# Start angle and signed sweep of an arc move in the XY plane.
+# Arcs that end where they start are full circles.
+def sweep(m):
+    cx, cy = centre(m)
+    a0 = math.atan2(m.start['Y'] - cy, m.start['X'] - cx)
+    a1 = math.atan2(m.end['Y'] - cy, m.end['X'] - cx)
+    turn = a1 - a0
+    if m.code == 2 and turn >= -EPSILON / 10:
+        turn -= 2 * math.pi
+    elif m.code == 3 and turn <= EPSILON / 10:
+        turn += 2 * math.pi
+    return a0, turn
+
+def centre(m):
+    return m.start['X'] + m.params.get('I', 0.0), m.start['Y'] + m.params.get('J', 0.0)
+
+def radii(m):
+    cx, cy = centre(m)
+    return math.hypot(m.start['X'] - cx, m.start['Y'] - cy), math.hypot(m.end['X'] - cx, m.end['Y'] - cy)
+
+# Segments of the path cut by the feed moves, or of the whole
+# path with rapids, with arcs split into segments of at most the
+# given angle.
+def segments(ms, step=math.radians(0.5), rapids=False):
+    out = []
+    for m in ms:
+        if m.code not in ((0, 1, 2, 3) if rapids else (1, 2, 3)) or None in m.start.values():
+            continue
+        start = (m.start['X'], m.start['Y'], m.start['Z'])
+        if m.code in (0, 1):
+            out.append((start, (m.end['X'], m.end['Y'], m.end['Z'])))
+            continue
+
+        (cx, cy), (r, _), (a0, turn) = centre(m), radii(m), sweep(m)
+        count = max(1, math.ceil(abs(turn) / step))
+        for i in range(1, count + 1):
+            a = a0 + turn * i / count
+            end = (cx + r * math.cos(a), cy + r * math.sin(a), m.start['Z'] + (m.end['Z'] - m.start['Z']) * i / count)
+            out.append((start, end))
+            start = end
+    return out
+
+def points(segs):
+    return [segs[0][0]] + [b for _, b in segs] if segs else []
+
+# Segments bucketed by the grid cells of the given size along
+# them in XY, so that points are only measured against the
+# segments near them.
+CELL = 1.0
+
+def cell(x, y, size):
+    return (math.floor(x / size), math.floor(y / size))
+
+def grid(segs, size=CELL):
+    cells = collections.defaultdict(set)
+    for a, b in segs:
+        count = max(1, math.ceil(math.dist(a[:2], b[:2]) / size))
+        for i in range(count + 1):
+            cells[cell(a[0] + (b[0] - a[0]) * i / count, a[1] + (b[1] - a[1]) * i / count, size)].add((a, b))
+    return size, cells
+
+# Distance from a point to the closest of the segments, in XYZ
+# or only in XY, or infinity if none are within half a cell.
+def offset(p, segs, axes=3):
+    size, cells = segs
+    cx, cy = cell(p[0], p[1], size)
+    best = math.inf
+    for dx, dy in itertools.product((-1, 0, 1), repeat=2):
+        for a, b in cells.get((cx + dx, cy + dy), ()):
+            ab = [b[i] - a[i] for i in range(axes)]
+            ap = [p[i] - a[i] for i in range(axes)]
+            length = sum(v * v for v in ab)
+            t = 0.0 if length == 0 else min(1.0, max(0.0, sum(ab[i] * ap[i] for i in range(axes)) / length))
+            best = min(best, math.dist(p[:axes], [a[i] + ab[i] * t for i in range(axes)]))
+    return best
+
+# Largest distance of either path from the other
+def deviation(a, b):
+    ga, gb = grid(a), grid(b)
+    return max(max(offset(p, gb) for p in points(a)), max(offset(p, ga) for p in points(b)))
+
+def report(gcode, prefix):
+    return [line for line in gcode.split('\n') if line.startswith('(' + prefix)]
+
+def scattered(count, seed=3, size=100.0):
+    rng = random.Random(seed)
+    return [(round(rng.uniform(0, size), 3), round(rng.uniform(0, size), 3)) for _ in range(count)]
+
+# Drilling as FreeCAD outputs it without canned cycles: down to the
+# safe height over the first hole, then each hole is plunged and
+# retracted to the safe height, and the tool only goes back up to
+# the clearance height at the end.
+def drilling(points, depth=-8.0):
+    x, y = points[0]
+    cmds = [Command('G0', {'Z': CLEARANCE}), Command('G0', {'X': x, 'Y': y}), Command('G0', {'Z': SAFE})]
+    for i, (x, y) in enumerate(points):
+        if i:
+            cmds.append(Command('G0', {'X': x, 'Y': y, 'Z': SAFE}))
+        cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': depth, 'F': 3.0}))
+        cmds.append(Command('G0', {'X': x, 'Y': y, 'Z': SAFE}))
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Drilling with canned cycles retracting to the safe height
+def cycles(points, code='G81', depth=-8.0):
+    cmds = [Command('G0', {'Z': CLEARANCE})]
+    for x, y in points:
+        cmds.append(Command('G0', {'X': x, 'Y': y}))
+        params = {'X': x, 'Y': y, 'Z': depth, 'R': SAFE, 'F': 3.0}
+        if code == 'G83':
+            params['Q'] = 2.0
+        cmds.append(Command(code, params))
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Lowest height of the rapids across the XY plane
+def lowest(ms):
+    return min((min(m.start['Z'], m.end['Z']) for m in ms if m.code == 0
+        and None not in (m.start['X'], m.start['Y']) and distance(m.start, m.end) > EPSILON), default=math.inf)
+
+# Reordered rapids must visit the same features, with less travel,
+# without travelling below the safe height between them.
+def check_rapids():
+    points = scattered(30)
+    for name, cmds, depth in (('drilling', drilling(points), -8.0), ('G81', cycles(points), None),
+            ('G83', cycles(points, 'G83'), None)):
+        before = run(cmds)
+        after = run(cmds, '--optimise-rapids')
+        a, b = moves(before), moves(after)
+
+        assert report(after, 'Optimised rapids'), "{}: features were not reordered".format(name)
+        assert holes(a, depth) != holes(b, depth), "{}: order is unchanged".format(name)
+        assert sorted(holes(a, depth)) == sorted(holes(b, depth)), "{}: holes differ".format(name)
+        assert travel(b) < travel(a), "{}: travel was not reduced".format(name)
+
+        low = lowest(b)
+        assert low >= SAFE - EPSILON, "{}: rapid across at Z{} below the safe height".format(name, low)
+
+    # Holes closer than the tool diameter must keep their order
+    pairs = [p for x, y in scattered(10, seed=5) for p in ((x, y), (round(x + 2.0, 3), y))]
+    b = moves(run(drilling(pairs), '--optimise-rapids'))
+    drilled = holes(b, -8.0)
+    for first, second in zip(pairs[::2], pairs[1::2]):
+        assert drilled.index(first) < drilled.index(second), "overlapping holes at {} were swapped".format(first)
+
+# Post with the largest number of moves buffered by the rapid
+# optimiser, returning the output gcode and that number.
+def buffered(cmds, args):
+    peak = 0
+    push = post.RapidOptimiser.push
+    def counted(self, move):
+        nonlocal peak
+        push(self, move)
+        peak = max(peak, len(self.moves))
+    post.RapidOptimiser.push = counted
+    try:
+        return run(cmds, args), peak
+    finally:
+        post.RapidOptimiser.push = push
+
+# Operations with more features than are buffered at once are
+# reordered in groups, and a feature too long to buffer is output
+# unchanged, while the rest are still reordered around it.
+def check_rapid_groups():
+    limit = post.RapidOptimiser.MAX_MOVES
+    points = scattered(2000, seed=7)
+    ring = polygon(50, 50, 60, 0, 2 * math.pi, limit + 1000)
+    ring.append(Command('G0', {'Z': SAFE}))
+    for name, cmds in (('holes', drilling(points)), ('long', drilling(points[:100]) + ring + drilling(points[100:200]))):
+        a = moves(run(cmds))
+        after, peak = buffered(cmds, '--optimise-rapids')
+        b = moves(after)
+
+        assert peak <= limit, "{}: {} moves were buffered".format(name, peak)
+        assert report(after, 'Optimised rapids'), "{}: features were not reordered".format(name)
+        assert sorted(holes(a, -8.0)) == sorted(holes(b, -8.0)), "{}: holes differ".format(name)
+        assert travel(b) < travel(a), "{}: travel was not reduced".format(name)
+        low = lowest(b)
+        assert low >= SAFE - EPSILON, "{}: rapid across at Z{} below the safe height".format(name, low)
+
+    # The long feature is cut as it was, between the same holes
+    cut = [m for m in a if m.code == 1 and m.end['Z'] == -1.0]
+    start = b.index(cut[0])
+    assert b[start:start + len(cut)] == cut, "long feature was changed"
+    before = {(m.end['X'], m.end['Y']) for m in b[:start] if m.code == 1}
+    assert before == set(points[:100]), "holes were moved across the long feature"
+
+# Feed moves around a circle, or a spiral if the radius grows,
+# as CAM outputs curved paths.
+def polygon(cx, cy, r, start, end, count, z=-1.0, growth=0.0):
+    pts = [(cx + (r + growth * i / count) * math.cos(a), cy + (r + growth * i / count) * math.sin(a))
+        for i, a in ((i, start + (end - start) * i / count) for i in range(count + 1))]
+    cmds = [Command('G0', {'Z': CLEARANCE}), Command('G0', {'X': pts[0][0], 'Y': pts[0][1]}),
+        Command('G1', {'Z': z, 'F': 5.0})]
+    cmds.extend(Command('G1', {'X': x, 'Y': y}) for x, y in pts[1:])
+    return cmds
+
+# Curved paths of both directions, and a spiral that only fits
+# short arcs, followed by a zigzag that must stay as linear moves.
+def curves():
+    cmds = polygon(50, 50, 20, 0, 2 * math.pi, 360)
+    cmds += polygon(20, 80, 8, math.pi, -math.pi / 3, 160)[2:]
+    cmds += polygon(80, 20, 10, 0, 2 * math.pi, 360, growth=10.0)
+    x, y = cmds[-1].Parameters['X'], cmds[-1].Parameters['Y']
+    cmds += [Command('G1', {'X': x + i, 'Y': y + (i % 2) * 3.0}) for i in range(1, 10)]
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Fitted arcs must follow the original path within tolerance,
+# and be true arcs once rounded to output precision.
+def check_arcs():
+    tolerance = 0.01
+    cmds = curves()
+    a = moves(run(cmds))
+    b = moves(run(cmds, '--arc-fit --arc-fit-tolerance {}'.format(tolerance)))
+    arcs = [m for m in b if m.code in (2, 3)]
+
+    assert arcs, "no arcs were fitted"
+    assert {m.code for m in arcs} == {2, 3}, "arcs were not fitted in both directions"
+    assert len(b) < len(a), "moves were not replaced"
+    assert a[-1].end == b[-1].end, "path ends at {} rather than {}".format(b[-1].end, a[-1].end)
+
+    for m in arcs:
+        r0, r1 = radii(m)
+        assert abs(r0 - r1) < EPSILON * 2, "arc to {} changes radius from {} to {}".format(m.end, r0, r1)
+
+    error = deviation(segments(a), segments(b))
+    assert error < tolerance + EPSILON, "fitted arcs are {:.4f} from the original path".format(error)
+
+# Feed of each feed move by the position it ends at
+def feeds(ms):
+    found = {}
+    feed = None
+    for m in ms:
+        feed = m.params.get('F', feed)
+        if m.code in (1, 2, 3):
+            found[tuple(m.end.values())] = feed
+    return found
+
+# Straight cuts with noise well within the tolerance, a curve,
+# moves that do not change the output position, and a change
+# of feed part way along a straight cut.
+def wobbly(tolerance, seed=7):
+    rng = random.Random(seed)
+    cmds = [Command('G0', {'Z': CLEARANCE}), Command('G0', {'X': 0.0, 'Y': 0.0}), Command('G1', {'Z': -1.0, 'F': 5.0})]
+    for i in range(1, 200):
+        params = {'X': i * 0.5, 'Y': rng.uniform(-0.2, 0.2) * tolerance}
+        if i == 120:
+            params['F'] = 4.0
+        cmds.append(Command('G1', params))
+        if i % 40 == 0:
+            cmds.append(Command('G1', dict(params, X=params['X'] + 1e-5)))
+    cmds += polygon(100, 30, 30, -math.pi / 2, math.pi / 2, 400)[2:]
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Simplified paths must stay within tolerance of the original
+# moves, keeping the feed of every point that is kept.
+def check_simplify():
+    tolerance = 0.05
+    cmds = wobbly(tolerance)
+    a = moves(run(cmds))
+    original = feeds(a)
+    for mode in ('--no-simplify-dp', '--simplify-dp'):
+        b = moves(run(cmds, '--simplify --simplify-tolerance {} {}'.format(tolerance, mode)))
+
+        assert len(b) < len(a), "{}: moves were not removed".format(mode)
+        assert a[-1].end == b[-1].end, "{}: path ends at {} rather than {}".format(mode, b[-1].end, a[-1].end)
+
+        error = deviation(segments(a), segments(b))
+        assert error < tolerance + EPSILON, "{}: simplified path is {:.4f} from the original".format(mode, error)
+
+        for end, feed in feeds(b).items():
+            assert end in original, "{}: new point {}".format(mode, end)
+            assert feed == original[end], "{}: feed to {} changed from {} to {}".format(mode, end, original[end], feed)
+
+# Holes drilled by a feed straight down followed by a rapid
+# straight back up, as G81 cycles retracting to that height.
+def plunges(ms):
+    found = []
+    feed = None
+    for m, n in zip(ms, ms[1:]):
+        feed = m.params.get('F', feed)
+        if (m.code == 1 and n.code == 0 and distance(m.start, m.end) < EPSILON and distance(n.start, n.end) < EPSILON
+                and m.end['Z'] < m.start['Z'] < n.end['Z'] + EPSILON):
+            found.append((m.end['X'], m.end['Y'], 81, m.end['Z'], n.end['Z'], None, feed))
+    return found
+
+# Feed moves across the stock, which are not part of any hole
+def cuts(ms):
+    return [(m.start, m.end) for m in ms if m.code == 1 and distance(m.start, m.end) > EPSILON]
+
+# Drilling with the depth, retract plane, peck and feed of
+# each hole chosen at random, so every cycle parameter both
+# changes and stays the same between holes. Expanded drilling
+# has a cut across the stock part way through, which must not
+# be converted.
+def drills(points, expanded, seed=11):
+    rng = random.Random(seed)
+    cmds = [Command('G0', {'Z': CLEARANCE})]
+    for i, (x, y) in enumerate(points):
+        code = 'G81' if expanded else rng.choice(['G73', 'G81', 'G83'])
+        depth, retract, feed = rng.choice([-8.0, -5.0]), rng.choice([SAFE, 2.0]), rng.choice([3.0, 2.0])
+        if expanded:
+            cmds.append(Command('G0', {'X': x, 'Y': y}))
+            cmds.append(Command('G0', {'Z': retract}))
+            cmds.append(Command('G1', {'Z': depth, 'F': feed}))
+            if i == len(points) // 2:
+                cmds.append(Command('G1', {'X': x + 5.0}))
+            cmds.append(Command('G0', {'Z': retract}))
+            continue
+
+        params = {'X': x, 'Y': y, 'Z': depth, 'R': retract, 'F': feed}
+        if code != 'G81':
+            params['Q'] = rng.choice([1.0, 2.0])
+        cmds.append(Command('G0', {'X': x, 'Y': y}))
+        cmds.append(Command(code, params))
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Canned cycles must drill the same holes with the same depth,
+# retract plane, peck and feed as the moves they replace, and
+# leave every other cut alone.
+def check_cycles():
+    points = scattered(20, seed=9)
+    for name, expanded in (('plunges', True), ('cycles', False)):
+        cmds = drills(points, expanded)
+        a = moves(run(cmds))
+        b = moves(run(cmds, '--canned-cycles'))
+
+        expected = plunges(a) if expanded else holes(a)
+        assert expected, "{}: no holes were drilled".format(name)
+        assert holes(b) == expected, "{}: cycles differ from the holes drilled\n{}\n{}".format(name, holes(b), expected)
+        assert cuts(b) == cuts(a), "{}: cuts differ".format(name)
+        assert a[-1].end == b[-1].end, "{}: path ends at {} rather than {}".format(name, b[-1].end, a[-1].end)
+        if expanded:
+            assert len(b) < len(a), "{}: plunges were not converted".format(name)
+
+# Quarter turn arcs as CAM outputs them: a helical ramp down
+# around one centre, then two full turns the other way around
+# another, with a change of feed part way round.
+def quarters():
+    cmds = [Command('G0', {'Z': CLEARANCE}), Command('G0', {'X': 60.0, 'Y': 50.0}), Command('G1', {'Z': 0.0, 'F': 5.0})]
+    x, y = 60.0, 50.0
+
+    def arc(code, cx, cy, r, a, params):
+        nonlocal x, y
+        end = (round(cx + r * math.cos(a), 6), round(cy + r * math.sin(a), 6))
+        cmds.append(Command(code, dict(params, X=end[0], Y=end[1], I=cx - x, J=cy - y)))
+        x, y = end
+
+    for i in range(1, 17):
+        arc('G3', 50, 50, 10, math.pi / 2 * i, {'Z': -0.25 * i})
+
+    cmds.append(Command('G1', {'X': 40.0}))
+    x = 40.0
+    for i in range(1, 9):
+        arc('G2', 30, 50, 10, -math.pi / 2 * i, {'F': 4.0} if i == 6 else {})
+
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Merged arcs must follow the same path around the same centres,
+# ending where arcs they replace ended, and turn at most once.
+def check_merge():
+    cmds = quarters()
+    a = moves(run(cmds))
+    b = moves(run(cmds, '--merge-arcs'))
+    before = [m for m in a if m.code in (2, 3)]
+    after = [m for m in b if m.code in (2, 3)]
+
+    assert len(after) < len(before), "arcs were not merged"
+    assert a[-1].end == b[-1].end, "path ends at {} rather than {}".format(b[-1].end, a[-1].end)
+
+    centres = {centre(m) for m in before}
+    ends = [m.end for m in before]
+    for m in after:
+        cx, cy = centre(m)
+        assert any(math.hypot(cx - x, cy - y) < EPSILON for x, y in centres), "arc to {} has a new centre".format(m.end)
+        assert m.end in ends, "arc ends at {}, which no original arc did".format(m.end)
+        assert abs(sweep(m)[1]) <= 2 * math.pi + EPSILON, "arc to {} turns more than once".format(m.end)
+        r0, r1 = radii(m)
+        assert abs(r0 - r1) < EPSILON * 2, "arc to {} changes radius from {} to {}".format(m.end, r0, r1)
+
+    error = deviation(segments(a), segments(b))
+    assert error < EPSILON * 2, "merged arcs are {:.4f} from the original path".format(error)
+    assert feeds(b).items() <= feeds(a).items(), "feeds changed"
+
+# Check if a move passes through a box, given as its lower and
+# upper corners, by clipping it to each axis in turn.
+def crosses(m, lo, hi):
+    t0, t1 = 0.0, 1.0
+    for i, k in enumerate('XYZ'):
+        a, b = m.start[k], m.end[k]
+        if abs(b - a) < 1e-12:
+            if not lo[i] < a < hi[i]:
+                return False
+            continue
+        u, v = sorted(((lo[i] - a) / (b - a), (hi[i] - a) / (b - a)))
+        t0, t1 = max(t0, u), min(t1, v)
+        if t0 >= t1:
+            return False
+    return True
+
+# Feed moves around the stock at random, after a path that
+# plunges beside it, cuts across it, cuts along its side with
+# the edge of the tool, ramps down into it from above and then
+# crosses above it.
+def around(stock, count=300, seed=13):
+    rng = random.Random(seed)
+    (x0, y0, z0, x1, y1, z1) = stock
+    cmds = [Command('G0', {'Z': CLEARANCE}), Command('G0', {'X': x0 - 20, 'Y': y0 + 10}),
+        Command('G1', {'Z': z1 - 5, 'F': 5.0}), Command('G1', {'X': x1 + 20}),
+        Command('G1', {'X': x1 + 1, 'Y': y0 - 20}), Command('G1', {'Y': y1 + 20}),
+        Command('G1', {'X': (x0 + x1) / 2, 'Z': z1 + 10}), Command('G1', {'Y': y0 + 20, 'Z': z1 - 2}),
+        Command('G1', {'Z': z1 + 4}), Command('G1', {'X': x1 + 20})]
+    for i in range(count):
+        cmds.append(Command('G1', {'X': rng.uniform(x0 - 20, x1 + 20), 'Y': rng.uniform(y0 - 20, y1 + 20),
+            'Z': rng.uniform(z0 - 5, z1 + 10)}))
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Moves sped up over air must stay clear of the stock, allowing
+# for the tool radius and the air margin, without changing the
+# path, and every other move must keep its programmed feed.
+def check_air():
+    stock = (0.0, 0.0, -10.0, 50.0, 50.0, 0.0)
+    radius, margin, fast = 3.0, 2.0, 3000.0
+    lo = (stock[0] - radius - margin + EPSILON, stock[1] - radius - margin + EPSILON, stock[2] + EPSILON)
+    hi = (stock[3] + radius + margin - EPSILON, stock[4] + radius + margin - EPSILON, stock[5] + margin - EPSILON)
+
+    cmds = around(stock)
+    a = moves(run(cmds, stock=stock, diameter=radius * 2))
+    original = feeds(a)
+    rapids = {(tuple(m.start.values()), tuple(m.end.values())) for m in a if m.code == 0}
+
+    for mode in ('feed', 'rapid'):
+        args = '--air-moves {} --air-margin {} --air-feed {}'.format(mode, margin, fast)
+        b = moves(run(cmds, args, stock=stock, diameter=radius * 2))
+        fed = feeds(b)
+        sped = [m for m in b if (m.code == 0 and (tuple(m.start.values()), tuple(m.end.values())) not in rapids)
+            or (m.code == 1 and fed[tuple(m.end.values())] == fast)]
+
+        assert sped, "{}: no moves were sped up".format(mode)
+        assert len(sped) < len([m for m in a if m.code == 1]), "{}: every move was sped up".format(mode)
+        for m in sped:
+            assert not crosses(m, lo, hi), "{}: move from {} to {} was sped up through the stock".format(mode, m.start, m.end)
+
+        for m in b:
+            end = tuple(m.end.values())
+            if m.code == 1 and fed[end] != fast and end in original:
+                assert fed[end] == original[end], "{}: feed to {} changed from {} to {}".format(mode, end, original[end], fed[end])
+
+        error = deviation(segments(a, rapids=True), segments(b, rapids=True))
+        assert error < EPSILON * 2, "{}: path moved by {:.4f}".format(mode, error)
+
+# Slots cut at random in levels, retracting to the clearance
+# height between every pass. Each level is cut from the start of
+# its slot, so the tool travels back over the level above, then
+# over uncut stock to the next slot. Every other slot ramps down
+# from the depth of the level above, so the level above is only
+# clear down to the top of its ramp.
+def slots(count=8, levels=3, seed=17):
+    rng = random.Random(seed)
+    cmds = []
+    for i in range(count):
+        x0, y0 = rng.uniform(0, 80), rng.uniform(0, 80)
+        a, length = rng.uniform(0, 2 * math.pi), rng.uniform(10, 30)
+        x1, y1 = x0 + length * math.cos(a), y0 + length * math.sin(a)
+        for level in range(1, levels + 1):
+            top = 1.0 - level if i % 2 else -level
+            cmds += [Command('G0', {'Z': CLEARANCE}), Command('G0', {'X': x0, 'Y': y0}), Command('G0', {'Z': SAFE}),
+                Command('G1', {'Z': top, 'F': 3.0}), Command('G1', {'X': x1, 'Y': y1, 'Z': -level, 'F': 10.0})]
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Points across the tool at a position: the centre and rings
+# at half and the full tool radius.
+def footprint(x, y, radius, count=16):
+    yield (x, y)
+    for r in (radius / 2, radius):
+        for i in range(count):
+            a = 2 * math.pi * i / count
+            yield (x + r * math.cos(a), y + r * math.sin(a))
+
+# Retracts that are kept down must only travel where the whole
+# tool passes over area already cut at or below its height.
+def check_keep_down():
+    radius = 3.0
+    cmds = slots() + jobs.pocket(200)
+    a = moves(run(cmds, diameter=radius * 2))
+    original = {(m.code, tuple(m.start.values()), tuple(m.end.values())) for m in a}
+
+    for mode in ('safe', 'feed'):
+        b = moves(run(cmds, '--keep-tool-down {}'.format(mode), diameter=radius * 2))
+        changed = [(m.code, tuple(m.start.values()), tuple(m.end.values())) not in original for m in b]
+        travel = [i for i, m in enumerate(b) if changed[i] and distance(m.start, m.end) > EPSILON]
+
+        assert travel, "{}: no retracts were kept down".format(mode)
+        assert any(m.code == 0 and m.start['Z'] == CLEARANCE and distance(m.start, m.end) > EPSILON for m in b), \
+            "{}: every retract was kept down".format(mode)
+        assert a[-1].end == b[-1].end, "{}: path ends at {} rather than {}".format(mode, b[-1].end, a[-1].end)
+
+        for i in travel:
+            m = b[i]
+            height = max(m.start['Z'], m.end['Z'])
+            cut = [c for j, c in enumerate(b[:i]) if not changed[j]]
+            cleared = grid([(p, q) for p, q in segments(cut) if max(p[2], q[2]) <= height + EPSILON], radius * 2)
+
+            steps = max(1, math.ceil(distance(m.start, m.end) / (radius / 8)))
+            for k in range(steps + 1):
+                x = m.start['X'] + (m.end['X'] - m.start['X']) * k / steps
+                y = m.start['Y'] + (m.end['Y'] - m.start['Y']) * k / steps
+                for p in footprint(x, y, radius):
+                    assert offset(p, cleared, axes=2) <= radius + EPSILON, \
+                        "{}: tool kept down at Z{} over uncut area at {}".format(mode, height, p)
+
+CHECKS = {
+    'rapids': check_rapids,
+    'rapid-groups': check_rapid_groups,
+    'arcs': check_arcs,
+    'simplify': check_simplify,
+    'cycles': check_cycles,
+    'merge': check_merge,
+    'air': check_air,
+    'keep-down': check_keep_down,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the behaviour of the move pipeline stages")
+    parser.add_argument('checks', nargs='*', help="Checks to run, from: {}. All by default.".format(', '.join(CHECKS)))
+    args = parser.parse_args()
+
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error("Unknown check {}".format(name))
+
+    failed = 0
+    for name in args.checks or CHECKS:
+        try:
+            CHECKS[name]()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL {}: {}".format(name, e))
+        else:
+            print("ok   {}".format(name))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# Synthetic job generators for benchmarking the post-processor.
+# Each generator returns the Path commands of one operation with
+# roughly the requested number of moves, in FreeCAD units (mm and
+# mm/s), shaped like the output of the matching FreeCAD operation.
+import math
+import random
+
+from standins import Command, Fixture, Job, Operation, ToolController
+
+CLEARANCE = 15.0
+SAFE      = 3.0
+
+def _start(x, y):
+    return [
+        Command('G0', {'Z': CLEARANCE}),
+        Command('G0', {'X': x, 'Y': y}),
+        Command('G0', {'Z': SAFE}),
+    ]
+
+# Zig-zag passes across the stock at a fixed depth
+def facing(size, seed=1, width=100.0, stepover=2.0):
+    cmds = _start(0.0, 0.0)
+    cmds.append(Command('G1', {'Z': -0.5, 'F': 5.0}))
+
+    y = 0.0
+    x = width
+    for _ in range(size // 2):
+        cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': -0.5, 'F': 25.0}))
+        y += stepover
+        cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': -0.5, 'F': 25.0}))
+        x = width - x
+
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Trochoidal clearing with a helical entry at each level,
+# mixing short linear moves, arcs and retracts.
+def adaptive(size, seed=1, levels=4):
+    rng = random.Random(seed)
+    cmds = _start(20.0, 10.0)
+
+    per_level = max(1, size // levels)
+    for level in range(levels):
+        z = -1.0 * (level + 1)
+
+        # Helical ramp down to depth
+        cmds.append(Command('G1', {'X': 20.0, 'Y': 10.0, 'Z': z + 1.0, 'F': 10.0}))
+        cmds.append(Command('G2', {'X': 20.0, 'Y': 10.0, 'Z': z + 0.5, 'I': -2.0, 'J': 0.0, 'K': 0.0, 'F': 10.0}))
+        cmds.append(Command('G2', {'X': 20.0, 'Y': 10.0, 'Z': z, 'I': -2.0, 'J': 0.0, 'K': 0.0, 'F': 10.0}))
+
+        x, y = 20.0, 10.0
+        for i in range(per_level):
+            k = rng.random()
+            if k < 0.6:
+                a = i * 0.05
+                x = round(40 + 20 * math.cos(a) + rng.uniform(-0.2, 0.2), 4)
+                y = round(40 + 20 * math.sin(a) + rng.uniform(-0.2, 0.2), 4)
+                cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': z, 'F': 30.0}))
+            elif k < 0.9:
+                code = 'G2' if k < 0.75 else 'G3'
+                cmds.append(Command(code, {'X': x + 1.0, 'Y': y, 'Z': z, 'I': 0.5, 'J': 0.0, 'K': 0.0, 'F': 30.0}))
+                x += 1.0
+            else:
+                cmds.append(Command('G0', {'X': x, 'Y': y, 'Z': SAFE}))
+                cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': z, 'F': 10.0}))
+
+        cmds.append(Command('G0', {'Z': SAFE}))
+
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Grid of holes drilled with peck drilling canned cycles
+def drilling(size, seed=1, pitch=5.0):
+    side = max(1, int(math.sqrt(size)))
+    cmds = [Command('G0', {'Z': CLEARANCE})]
+
+    for i in range(size):
+        x = (i % side) * pitch
+        y = (i // side) * pitch
+        cmds.append(Command('G0', {'X': x, 'Y': y}))
+        cmds.append(Command('G83', {'X': x, 'Y': y, 'Z': -8.0, 'R': SAFE, 'Q': 2.0, 'F': 3.0}))
+
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Parallel passes over a curved surface in short 3D segments
+def surface(size, seed=1, width=100.0, step=0.25, stepover=1.0):
+    cmds = _start(0.0, 0.0)
+
+    points = max(2, int(width / step))
+    passes = max(1, size // points)
+    for p in range(passes):
+        y = p * stepover
+        for i in range(points):
+            x = i * step if p % 2 == 0 else width - i * step
+            z = round(-2.0 + 1.5 * math.sin(x / 10) * math.cos(y / 15), 4)
+            cmds.append(Command('G1', {'X': round(x, 4), 'Y': round(y, 4), 'Z': z, 'F': 40.0}))
+
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+# Zig-zag clearing of a square pocket in thin levels, each
+# finished with a pass around the walls, retracting to the
+# clearance height and returning to the corner it started from
+# between levels.
+def pocket(size, seed=1, width=40.0, stepover=2.0, stepdown=0.05):
+    rows = int(width / stepover)
+    levels = max(1, size // (2 * rows + 5))
+    cmds = _start(0.0, 0.0)
+
+    for level in range(levels):
+        z = round(-stepdown * (level + 1), 4)
+        if level:
+            cmds.extend(_start(0.0, 0.0))
+        cmds.append(Command('G1', {'Z': z, 'F': 5.0}))
+
+        y = 0.0
+        x = width
+        for _ in range(rows):
+            cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': z, 'F': 25.0}))
+            y += stepover
+            cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': z, 'F': 25.0}))
+            x = width - x
+
+        for x, y in ((0.0, width), (0.0, 0.0), (width, 0.0), (width, width), (0.0, width)):
+            cmds.append(Command('G1', {'X': x, 'Y': y, 'Z': z, 'F': 25.0}))
+
+    cmds.append(Command('G0', {'Z': CLEARANCE}))
+    return cmds
+
+GENERATORS = {
+    'facing': facing,
+    'adaptive': adaptive,
+    'drilling': drilling,
+    'surface': surface,
+    'pocket': pocket,
+}
+
+# Build a job with one operation of each requested kind, each
+# with its own tool, alternating between two WCSs. Operations
+# belong to a job with the given stock bounds, if any, and
+# retract to the same safe height.
+def job(kinds, size, seed=1, stock=None):
+    parent = Job(stock)
+    objects = []
+    for n, kind in enumerate(kinds, 1):
+        objects.append(Fixture('G54' if n % 2 else 'G55'))
+        objects.append(ToolController(n, 6.0 / n, 18000))
+        objects.append(Operation(kind.capitalize(), GENERATORS[kind](size, seed + n), parent, SAFE))
+    return objects
@@ -0,0 +1,131 @@
+# Lightweight stand-ins for the FreeCAD modules imported by the
+# MillenniumOS post-processor, and for the job objects it is passed,
+# so that it can be imported and benchmarked outside of a FreeCAD
+# install. If FreeCAD itself is importable then the real modules
+# are used instead.
+import os
+import sys
+import types
+
+POST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# FreeCAD stores lengths in mm and velocities in mm/s internally.
+class Quantity:
+    FACTORS = {
+        'mm': 1.0,
+        'mm/s': 1.0,
+        'mm/min': 60.0,
+        'in': 1/25.4,
+        'in/min': 60/25.4,
+    }
+
+    def __init__(self, value=0.0, unit=None):
+        self.Value = float(value)
+        self.unit = unit
+
+    def getValueAs(self, unit):
+        return self.Value * self.FACTORS[unit]
+
+# Path commands store a name and a dict of parameters
+class Command:
+    def __init__(self, name, parameters=None):
+        self.Name = name
+        self.Parameters = dict(parameters or {})
+
+    def __repr__(self):
+        return 'Command({!r}, {!r})'.format(self.Name, self.Parameters)
+
+class Path:
+    def __init__(self, commands=None):
+        self.Commands = list(commands or [])
+
+# Objects are dispatched on the class name of their proxy
+def _proxy(name):
+    return type(name, (), {})()
+
+class Tool:
+    def __init__(self, label, diameter, shape='endmill', length=50.0, flutes=3):
+        self.Label = label
+        self.Diameter = Quantity(diameter, 'Length')
+        self.ShapeType = shape
+        self.Length = Quantity(length, 'Length')
+        self.CuttingEdgeHeight = Quantity(length / 2, 'Length')
+        self.FlatRadius = Quantity(0.0, 'Length')
+        self.Flutes = flutes
+
+class ToolController:
+    def __init__(self, number, diameter, rpm):
+        self.Proxy = _proxy('ToolController')
+        self.Label = 'TC: Endmill {}'.format(number)
+        self.Tool = Tool('Endmill {}'.format(number), diameter)
+        self.ToolNumber = number
+        self.Path = Path([Command('M6', {'T': number}), Command('M3', {'S': float(rpm)})])
+
+class Fixture:
+    def __init__(self, wcs):
+        self.Proxy = _proxy('Fixture')
+        self.Label = 'Fixture'
+        self.Path = Path([Command(wcs)])
+
+class Operation:
+    def __init__(self, label, commands, job=None, safe=None):
+        self.Proxy = _proxy('ObjectOp')
+        self.Label = label
+        self.Active = True
+        self.Path = Path(commands)
+        self.InList = [job] if job is not None else []
+        if safe is not None:
+            self.SafeHeight = Quantity(safe, 'Length')
+
+class BoundBox:
+    def __init__(self, xmin, ymin, zmin, xmax, ymax, zmax):
+        self.XMin, self.YMin, self.ZMin = xmin, ymin, zmin
+        self.XMax, self.YMax, self.ZMax = xmax, ymax, zmax
+
+# Jobs hold the stock their operations are cut from, given
+# as (xmin, ymin, zmin, xmax, ymax, zmax) in mm.
+class Job:
+    def __init__(self, stock=None):
+        self.Proxy = _proxy('ObjectJob')
+        self.Label = 'Job'
+        self.Stock = None
+        if stock is not None:
+            self.Stock = types.SimpleNamespace(Shape=types.SimpleNamespace(BoundBox=BoundBox(*stock)))
+
+def find_parent_job(obj):
+    return next((o for o in getattr(obj, 'InList', []) if isinstance(o, Job)), None)
+
+def _module(name, **attrs):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attrs)
+    sys.modules[name] = mod
+    return mod
+
+# Register the stand-in modules unless FreeCAD is available
+def install():
+    try:
+        import FreeCAD
+        return False
+    except ImportError:
+        pass
+
+    units = types.SimpleNamespace(Quantity=Quantity, Length='Length', Velocity='Velocity')
+    _module('FreeCAD', GuiUp=False, Units=units, Version=lambda: ['1', '0', '0'])
+
+    path = _module('Path', Command=Command, Path=Path)
+    path.Base = _module('Path.Base')
+    path.Base.Util = _module('Path.Base.Util', opProperty=lambda obj, prop: getattr(obj, prop, None))
+    path.Post = _module('Path.Post')
+    path.Post.Utils = _module('Path.Post.Utils', editor=lambda gcode: gcode)
+
+    scripts = _module('PathScripts')
+    scripts.PathUtils = _module('PathScripts.PathUtils', findParentJob=find_parent_job)
+    return True
+
+# Install stand-ins if necessary and import the post-processor
+def load_post():
+    install()
+    if POST_DIR not in sys.path:
+        sys.path.insert(0, POST_DIR)
+    import millennium_os_post
+    return millennium_os_post
@@ -20,9 +20,19 @@
 # - It is the responsibility of your macros and firmware to run any safety checks.
 
 import sys
-import argparse
+import os
 import shlex
 import re
+import time
+import decimal
+import json
+import marshal
+import functools
+import contextlib
+import itertools
+import math
+import collections
+from array import array
 from enum import Flag, auto
 
 if sys.version_info < (3, 11):
@@ -33,13 +43,39 @@ else:
     from enum import StrEnum, auto
 
 from contextlib import contextmanager
-import FreeCAD
-from FreeCAD import Units
-import Path.Base.Util as PathUtil
-import Path.Post.Utils as PostUtils
-import PathScripts.PathUtils as PathUtils
+from datetime import datetime, timezone, timedelta
+
+# Modules that are slow to import, and are only needed by
+# some options or once the post is run, are imported in the
+# functions that use them. This keeps importing the post
+# quick when it is loaded for every job, e.g. by batch
+# scripts running freecadcmd. This includes the FreeCAD
+# modules, so the post can be imported outside of FreeCAD.
+
+# NumPy is bundled with FreeCAD but is only required
+# for batch processing of moves. Returns None if it is
+# not available.
+@functools.cache
+def numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
 
-from datetime import datetime, timezone
+# zstd compression of output files is provided by the
+# standard library from Python 3.14, or the zstandard
+# package. Returns None if neither is available.
+@functools.cache
+def zstd():
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            import zstandard as zstd
+        except ImportError:
+            return None
+    return zstd
 
 class RELEASE:
     VERSION = "%%MOS_VERSION%%"
@@ -56,6 +92,9 @@ class GCODES:
     ARC_CW                  = 2
     ARC_CCW                 = 3
     DWELL                   = 4
+    DRILL_CHIPBREAK         = 73
+    DRILL                   = 81
+    DRILL_PECK              = 83
     ABSOLUTE                = 90
     RELATIVE                = 91
     INCHES                  = 20
@@ -99,6 +138,9 @@ class UNITS:
     FEED   = 'mm/min'
     LENGTH = 'mm'
 
+# Number of converted feed rates to cache
+FEED_CACHE_SIZE = 256
+
 # Well-known arguments
 # Used to reference arg values for
 # additional processing
@@ -113,6 +155,11 @@ class ARGS:
     ARC_Y = 'J'
     ARC_Z = 'K'
     ARC_R = 'R'
+    PECK  = 'Q'
+
+# Arguments that are lengths and must be
+# converted to machine units.
+LENGTH_ARGS = frozenset([ARGS.X, ARGS.Y, ARGS.Z, ARGS.ARC_X, ARGS.ARC_Y, ARGS.ARC_Z, ARGS.ARC_R, ARGS.PECK])
 
 # Define Output control flags
 class Control(Flag):
@@ -121,74 +168,512 @@ class Control(Flag):
     STRICT  = auto()
     NONZERO = auto()
 
-# User-configurable arguments.
-parser = argparse.ArgumentParser(prog="MillenniumOS {}".format(RELEASE.VERSION),
-    description="MillenniumOS {} Post Processor for FreeCAD".format(RELEASE.VERSION))
-
-parser.add_argument('--show-editor', action=argparse.BooleanOptionalAction, default=True,
-    help="Show gcode in FreeCAD Editor before saving to file.")
-
-parser.add_argument("--output-job-setup", action=argparse.BooleanOptionalAction, default=True,
-    help="""
-    When enabled, the post-processor will output supplemental commands to make sure the machine
-    is properly configured before starting a job. These commands include homing the machine,
-    probing and zeroing any used WCSs. Individual supplemental commands can be enabled,
-    disabled and configured separately but disabling this allows advanced operators to
-    setup the machine for the job using their own workflow, while still outputting
-    known-good operation gcode from this post.
-    """)
-
-parser.add_argument('--output-machine', action=argparse.BooleanOptionalAction, default=True,
-    help="Output machine settings header.")
-
-parser.add_argument('--output-version', action=argparse.BooleanOptionalAction, default=True,
-    help="Output version details header.")
-
-parser.add_argument('--output-tools', action=argparse.BooleanOptionalAction, default=True,
-    help="Output tool details. Disabling this will make tool changes much harder!")
-
-parser.add_argument('--home-before-start', action=argparse.BooleanOptionalAction, default=False,
-    help="When enabled, machine will home in X, Y and Z directions prior to executing any operations.")
-
-parser.add_argument('--allow-zero-rpm', action=argparse.BooleanOptionalAction, default=False,
-    help="""
-    When enabled, we will post-process jobs when the spindle is stationary.
-    This may be useful when using a drag-knife or similar tool but should
-    be left disabled for normal milling operations.
-    """)
-
-parser.add_argument('--version-check', action=argparse.BooleanOptionalAction, default=True,
-    help="""
-    When enabled, the post-processor will output a version check command
-    to make sure the post-processor version and MillenniumOS version installed
-    in RRF match.
-    """)
-probe_mode = parser.add_mutually_exclusive_group(required=False)
-probe_mode.add_argument('--probe-at-start', dest='probe_mode', action='store_const', const=PROBE.AT_START, default=PROBE.ON_CHANGE,
-    help="When enabled, MillenniumOS will probe a work-piece in each used WCS prior to executing any operations.")
-
-probe_mode.add_argument('--probe-on-change', dest='probe_mode', action='store_const', const=PROBE.ON_CHANGE,
-    help="When enabled, MillenniumOS will probe a work-piece just prior to switching into each used WCS.")
-
-probe_mode.add_argument('--no-probe', dest='probe_mode', action='store_const', const=PROBE.NONE)
-
-parser.add_argument(
-    "--vssc-period",
-    type=int,
-    default=4000,
-    help="Period over which RPM is varied up and down when VSSC is enabled, in milliseconds."
-)
-parser.add_argument(
-    "--vssc-variance",
-    type=int,
-    default=200,
-    help="Variance around target RPM to vary Spindle speed when VSSC is enabled, in RPM."
-)
-parser.add_argument('--vssc', action=argparse.BooleanOptionalAction, default=True,
-    help="""
-    When enabled, spindle speed is varied between an upper and lower limit surrounding the requested RPM
-    which helps to avoid harmonic resonance between tool and work piece.
-    """)
+# Machine limits, read from a Fusion 360 machine definition (.mch)
+# file if one is given. Limits passed as arguments take precedence
+# over the machine definition. Speeds are in mm/min, acceleration
+# in mm/s^2 and jerk (the maximum instantaneous change in speed)
+# in mm/min. Acceleration and jerk default to the RRF defaults.
+class Machine:
+    AXES         = (ARGS.X, ARGS.Y, ARGS.Z)
+    RAPID_RATE   = 5000
+    ACCELERATION = 500
+    JERK         = 900
+    INCH         = 25.4
+
+    def __init__(self, args):
+        self.rapid = dict.fromkeys(self.AXES)
+        self.max_feed = None
+        self.tool_change_time = None
+        self.limits = {}
+
+        path = getattr(args, 'machine_file', None)
+        if path:
+            self.load(path)
+
+        self.rapid = {axis: self.pick(args, 'rapid_rate', rate, self.RAPID_RATE) for axis, rate in self.rapid.items()}
+        self.max_feed = self.pick(args, 'max_feed_rate', self.max_feed, None)
+        self.acceleration = self.pick(args, 'acceleration', None, self.ACCELERATION)
+        self.jerk = self.pick(args, 'jerk', None, self.JERK)
+        self.tool_change_time = self.pick(args, 'tool_change_time', self.tool_change_time, 0)
+        self.soft_limits = self.parselimits(getattr(args, 'soft_limits', None) or '')
+
+    # Return the argument value if given, otherwise the
+    # configured value if set, otherwise the default.
+    @staticmethod
+    def pick(args, name, configured, default):
+        value = getattr(args, name, None)
+        if value is not None:
+            return value
+        if configured is not None:
+            return configured
+        return default
+
+    def load(self, path):
+        try:
+            with open(path, encoding='utf-8') as fh:
+                mch = json.load(fh)
+        except (OSError, ValueError) as e:
+            raise ValueError("Unable to read machine file {}: {}".format(path, e))
+
+        # Zero speeds in the machine definition are unset
+        controller = mch.get('controller', {}).get('default', {})
+        self.max_feed = controller.get('max_normal_speed') or None
+        for axis, part in controller.get('parts', {}).items():
+            if axis in self.rapid:
+                self.rapid[axis] = part.get('max_rapid_speed') or None
+
+        self.tool_change_time = mch.get('machining', {}).get('default', {}).get('tool_change_time')
+
+        # Axis travel limits are nested in the kinematic chain
+        kinematics = mch.get('kinematics', {}).get('default', {})
+        scale = self.INCH if kinematics.get('units', {}).get('length') == 'inch' else 1
+        parts = list(kinematics.get('parts', []))
+        while parts:
+            part = parts.pop()
+            if part.get('id') in self.rapid and 'min' in part and 'max' in part:
+                self.limits[part['id']] = (part['min'] * scale, part['max'] * scale)
+            parts.extend(part.get('parts', []))
+
+    # Parse soft limits given as comma-separated AXIS:MIN:MAX
+    # ranges, e.g. X:0:300,Z:-60:5
+    def parselimits(self, value):
+        limits = {}
+        for part in filter(None, value.replace(' ', '').split(',')):
+            try:
+                axis, low, high = part.split(':')
+                axis = axis.upper()
+                low, high = float(low), float(high)
+            except ValueError:
+                raise ValueError("Invalid soft limit {}, expected AXIS:MIN:MAX".format(part))
+            if axis not in self.AXES or low > high:
+                raise ValueError("Invalid soft limit {}".format(part))
+            limits[axis] = (low, high)
+        return limits
+
+    # Return the rapid rate in the given direction, limited by
+    # the rapid rate of each axis. Without a direction, returns
+    # the rapid rate in the XY plane.
+    def rapidrate(self, direction=None):
+        if direction is None:
+            return min(self.rapid[ARGS.X], self.rapid[ARGS.Y])
+        return min(self.rapid[axis] / abs(d) for axis, d in zip(self.AXES, direction) if abs(d) > 1e-9)
+
+    # Return the feed rate the machine will actually run at
+    def feedrate(self, feed):
+        if self.max_feed is not None and feed > self.max_feed:
+            return self.max_feed
+        return feed
+
+# Decimal places of lengths output by each precision profile
+class PRECISION:
+    FINISHING = 'finishing'
+    ROUGHING  = 'roughing'
+    PROFILES  = {FINISHING: 3, ROUGHING: 2}
+    DEFAULT   = FINISHING
+    AXES      = (ARGS.X, ARGS.Y, ARGS.Z, ARGS.ARC_X, ARGS.ARC_Y, ARGS.ARC_Z, ARGS.ARC_R)
+
+    # Operations can override the precision with a tag in
+    # their label, e.g. [precision=roughing]
+    TAG       = re.compile(r'\[precision\s*[=:]\s*([^\]]+)\]', re.IGNORECASE)
+
+# Parse a precision given as a comma-separated list of profile
+# names and per-axis decimal places, e.g. roughing,Z3. Axes that
+# are not given keep their precision from 'base', or the default
+# profile.
+def parse_precision(value, base=None):
+    digits = dict(base) if base is not None else dict.fromkeys(PRECISION.AXES, PRECISION.PROFILES[PRECISION.DEFAULT])
+    for part in filter(None, value.replace(' ', '').split(',')):
+        if part.lower() in PRECISION.PROFILES:
+            digits = dict.fromkeys(PRECISION.AXES, PRECISION.PROFILES[part.lower()])
+            continue
+
+        m = re.fullmatch(r'([A-Za-z])(\d)', part)
+        if m is None or m.group(1).upper() not in digits:
+            raise ValueError("Invalid precision {}, expected one of {} or an axis and decimal places, e.g. Z3".format(
+                part, ', '.join(PRECISION.PROFILES)))
+        digits[m.group(1).upper()] = int(m.group(2))
+    return digits
+
+# Parse approximate WCS origin positions given as comma-separated
+# WCS:X:Y entries in machine coordinates, e.g. 1:50:100,2:250:100
+def parse_positions(value):
+    positions = {}
+    for part in filter(None, value.replace(' ', '').split(',')):
+        try:
+            wcs, x, y = part.split(':')
+            positions[int(wcs)] = (float(x), float(y))
+        except ValueError:
+            raise ValueError("Invalid WCS position {}, expected WCS:X:Y".format(part))
+    return positions
+
+# User-configurable arguments. The parser is built on first
+# use, as it is only needed once the post is run.
+@functools.cache
+def argparser():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="MillenniumOS {}".format(RELEASE.VERSION),
+        description="MillenniumOS {} Post Processor for FreeCAD".format(RELEASE.VERSION))
+
+    parser.add_argument('--show-editor', action=argparse.BooleanOptionalAction, default=True,
+        help="Show gcode in FreeCAD Editor before saving to file.")
+
+    parser.add_argument("--output-job-setup", action=argparse.BooleanOptionalAction, default=True,
+        help="""
+        When enabled, the post-processor will output supplemental commands to make sure the machine
+        is properly configured before starting a job. These commands include homing the machine,
+        probing and zeroing any used WCSs. Individual supplemental commands can be enabled,
+        disabled and configured separately but disabling this allows advanced operators to
+        setup the machine for the job using their own workflow, while still outputting
+        known-good operation gcode from this post.
+        """)
+
+    parser.add_argument('--output-machine', action=argparse.BooleanOptionalAction, default=True,
+        help="Output machine settings header.")
+
+    parser.add_argument('--output-version', action=argparse.BooleanOptionalAction, default=True,
+        help="Output version details header.")
+
+    parser.add_argument('--output-tools', action=argparse.BooleanOptionalAction, default=True,
+        help="Output tool details. Disabling this will make tool changes much harder!")
+
+    parser.add_argument('--home-before-start', action=argparse.BooleanOptionalAction, default=False,
+        help="When enabled, machine will home in X, Y and Z directions prior to executing any operations.")
+
+    parser.add_argument('--allow-zero-rpm', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, we will post-process jobs when the spindle is stationary.
+        This may be useful when using a drag-knife or similar tool but should
+        be left disabled for normal milling operations.
+        """)
+
+    parser.add_argument('--version-check', action=argparse.BooleanOptionalAction, default=True,
+        help="""
+        When enabled, the post-processor will output a version check command
+        to make sure the post-processor version and MillenniumOS version installed
+        in RRF match.
+        """)
+    probe_mode = parser.add_mutually_exclusive_group(required=False)
+    probe_mode.add_argument('--probe-at-start', dest='probe_mode', action='store_const', const=PROBE.AT_START, default=PROBE.ON_CHANGE,
+        help="When enabled, MillenniumOS will probe a work-piece in each used WCS prior to executing any operations.")
+
+    probe_mode.add_argument('--probe-on-change', dest='probe_mode', action='store_const', const=PROBE.ON_CHANGE,
+        help="When enabled, MillenniumOS will probe a work-piece just prior to switching into each used WCS.")
+
+    probe_mode.add_argument('--no-probe', dest='probe_mode', action='store_const', const=PROBE.NONE)
+
+    parser.add_argument(
+        "--wcs-positions",
+        type=str,
+        default=None,
+        help="""
+        Approximate machine X and Y positions of the origin of each WCS, as comma-separated WCS:X:Y
+        entries numbered from 1 for G54, e.g. 1:50:100,2:250:100. When probing at start, each WCS is
+        followed by the nearest one, ending at the first WCS used by the job. Without positions, WCSs
+        are probed in the order they are first used. Each WCS is only probed once in either probing mode.
+        """)
+
+    parser.add_argument(
+        "--vssc-period",
+        type=int,
+        default=4000,
+        help="Period over which RPM is varied up and down when VSSC is enabled, in milliseconds."
+    )
+    parser.add_argument(
+        "--vssc-variance",
+        type=int,
+        default=200,
+        help="Variance around target RPM to vary Spindle speed when VSSC is enabled, in RPM."
+    )
+    parser.add_argument('--vssc', action=argparse.BooleanOptionalAction, default=True,
+        help="""
+        When enabled, spindle speed is varied between an upper and lower limit surrounding the requested RPM
+        which helps to avoid harmonic resonance between tool and work piece.
+        """)
+
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, operation gcode is spooled to a temporary file as it is generated and
+        the job is then written directly to the output file, rather than being built up in
+        memory. This keeps memory usage flat on very large jobs while posting. The gcode is
+        only written to the output file and is not returned to FreeCAD, so the FreeCAD gcode
+        editor preview is not available in this mode.
+        """)
+
+    parser.add_argument('--compress', choices=['gzip', 'zstd'], default=None,
+        help="""
+        Also write a compressed copy of the output, and of each split file, next to it with a .gz
+        or .zst extension, for archiving and transfer. zstd requires Python 3.14 or the zstandard
+        package. When this, --checksum or --index is enabled, the output file is written directly by
+        the post-processor, after the gcode editor if it is shown, so the sidecar files match it. The
+        gcode is still returned to FreeCAD, and is identical to the file written.
+        """)
+
+    parser.add_argument('--checksum', choices=['md5', 'sha1', 'sha256', 'sha512', 'blake2b'], default=None,
+        help="""
+        Hash the output files as they are written and write the checksums to a sidecar file named
+        after the output file with the algorithm as its extension, e.g. job.sha256, which can be
+        checked with sha256sum -c after upload.
+        """)
+
+    parser.add_argument(
+        "--split-lines",
+        type=int,
+        default=0,
+        help="""
+        Split the job into multiple files of at most this many lines, to reduce memory usage on
+        the controller. Files are only split where the machine is parked, at tool changes and WCS
+        changes, so a file may be larger if there is nowhere to split it. A master file calls each
+        file in turn using M98. Set to 0 to disable.
+        """)
+    parser.add_argument(
+        "--split-bytes",
+        type=int,
+        default=0,
+        help="As --split-lines, but limits the size of each file in bytes. Set to 0 to disable."
+    )
+    parser.add_argument(
+        "--split-path",
+        type=str,
+        default="0:/gcodes/",
+        help="Directory on the controller that split files will be uploaded to, used to call them from the master file."
+    )
+
+    parser.add_argument('--resume-points', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, a resume point is output at the start of each operation. It parks the machine and
+        restores the WCS, rotation compensation, tool, spindle, VSSC and movement configuration, so a job
+        can be restarted from any operation. The resume point is skipped when the machine is already in
+        that state, so running the job from the start is unchanged.
+        """)
+    parser.add_argument('--index', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, the line number and byte offset of each operation, tool change and WCS change are
+        written to a .index.json file next to the output file, so a job can be resumed or seeked without
+        scanning it. The output file is then written directly, and the index is not written if the
+        output is changed in the gcode editor.
+        """)
+
+    parser.add_argument('--arc-fit', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, runs of linear feed moves in the XY plane that lie on a circular arc are
+        replaced with a single G2 or G3 move. This reduces file size and the segment rate the
+        motion planner has to handle on 3D surfacing and adaptive operations.
+        """)
+    parser.add_argument(
+        "--arc-fit-tolerance",
+        type=float,
+        default=0.01,
+        help="Maximum deviation of a fitted arc from the original linear moves, in mm."
+    )
+
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default=PRECISION.DEFAULT,
+        help="""
+        Output precision of lengths, as a profile name ({}) or decimal places for each axis, e.g.
+        X2,Y2,Z3, or both, e.g. roughing,Z3. Values are compared at output precision, so moves that
+        do not change at this precision are not output. Operations can override the precision with a
+        PostPrecision property or a [precision=...] tag in their label.
+        """.format(', '.join('{} = {} places'.format(k, v) for k, v in PRECISION.PROFILES.items())))
+
+    parser.add_argument('--merge-arcs', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, runs of arcs around the same centre are merged into arcs of up to one full turn,
+        including helical ramps that descend at a constant rate. Arc end points are only output when
+        they change, but arc centre offsets are still output on every arc.
+        """)
+
+    parser.add_argument('--canned-cycles', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, drilling is output as MillenniumOS canned cycles. Plunges expanded into a feed
+        to depth and a rapid back out are converted to G81 cycles, rapids between holes at the retract
+        plane are folded into the following cycle, and cycle parameters are only output when they
+        change, as the cycle macros store them.
+        """)
+
+    parser.add_argument('--air-moves', choices=['feed', 'rapid'], default=None,
+        help="""
+        Speed up feed moves that only cut air, using the bounding box of the Job stock. Linear feed
+        moves above the stock, or beside it in X or Y allowing for the tool radius, each with a
+        safety margin, are output at --air-feed (feed) or as rapids (rapid). Plunges and ramps from
+        above the stock are split so the part above it is sped up. The estimated time saved is
+        output for each operation.
+        """)
+    parser.add_argument(
+        "--air-margin",
+        type=float,
+        default=2.0,
+        help="Distance moves must stay clear of the stock to be sped up by --air-moves, in mm."
+    )
+    parser.add_argument(
+        "--air-feed",
+        type=float,
+        default=None,
+        help="Feed rate of moves sped up by --air-moves=feed, in mm/min. Defaults to the maximum feed rate of the machine, or its rapid rate if unknown."
+    )
+
+    parser.add_argument('--optimise-rapids', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, independent features within an operation (e.g. drill holes, canned drilling
+        cycles or separate pockets) that are joined by rapid moves at the safe height are reordered to
+        minimise rapid travel, travelling between them at the safe height. Features that overlap keep
+        their original order. To bound memory use, operations with many features are reordered a group
+        of features at a time.
+        """)
+    parser.add_argument(
+        "--rapid-rate",
+        type=int,
+        default=None,
+        help="""
+        Rapid feed rate of the machine in mm/min, used to estimate time savings and cycle time.
+        Defaults to the rapid rate in the machine file, or 5000.
+        """)
+
+    parser.add_argument('--keep-tool-down', choices=['safe', 'feed'], default=None,
+        help="""
+        Shorten retracts between passes that only travel over area already cleared by the operation.
+        Retracts to the clearance height are lowered to the safe height of the operation (safe), or
+        replaced with a feed across at depth where that is faster, falling back to the safe height
+        (feed). Retracts without XY travel, such as pecks, are kept. The vertical travel removed is
+        output for each operation.
+        """)
+
+    parser.add_argument('--estimate-time', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, the output gcode is simulated using the machine limits to estimate the cycle
+        time, allowing for acceleration and cornering speed. The estimated time of each operation
+        and the total time are output in the preamble.
+        """)
+    parser.add_argument(
+        "--machine-file",
+        type=str,
+        default=None,
+        help="Fusion 360 machine definition (.mch) file to read machine limits from."
+    )
+    parser.add_argument(
+        "--max-feed-rate",
+        type=int,
+        default=None,
+        help="Maximum cutting feed rate of the machine in mm/min. Defaults to the machine file value, if any."
+    )
+    parser.add_argument(
+        "--acceleration",
+        type=float,
+        default=None,
+        help="Machine acceleration in mm/s^2, used to estimate cycle time. Defaults to {}.".format(Machine.ACCELERATION)
+    )
+    parser.add_argument(
+        "--jerk",
+        type=float,
+        default=None,
+        help="Machine jerk (maximum instantaneous speed change) in mm/min, used to estimate cycle time. Defaults to {}.".format(Machine.JERK)
+    )
+    parser.add_argument(
+        "--tool-change-time",
+        type=float,
+        default=None,
+        help="Time taken by each tool change in seconds. Defaults to the machine file value, or 0."
+    )
+
+    parser.add_argument('--check-limits', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, the extents of the output moves are tracked for each WCS and operation,
+        including the full extent of arcs, and output in the preamble. The post fails if the moves
+        in any WCS cover more than the machine travel from the machine file, or if any operation
+        leaves the soft limits.
+        """)
+    parser.add_argument(
+        "--soft-limits",
+        type=str,
+        default=None,
+        help="""
+        Soft limits that operations must stay within when checking limits, in work coordinates,
+        as comma-separated AXIS:MIN:MAX ranges, e.g. X:0:300,Y:0:200,Z:-60:5
+        """)
+
+    parser.add_argument('--simplify', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, linear moves that add no geometry are removed. Zero-length moves and moves
+        below the output resolution are dropped, and runs of collinear feed moves at the same feed
+        are merged into a single move.
+        """)
+    parser.add_argument(
+        "--simplify-tolerance",
+        type=float,
+        default=0.001,
+        help="Maximum deviation of a removed point from the simplified path, in mm."
+    )
+    parser.add_argument('--simplify-dp', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, runs of feed moves are simplified using the Douglas-Peucker algorithm,
+        which also removes points from curved paths as long as the path stays within the
+        simplify tolerance, rather than only merging collinear moves.
+        """)
+
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=0,
+        help="""
+        Number of worker processes used to format large operations in parallel. Tool, spindle
+        and WCS changes are still processed in order and the output is identical to the default
+        mode. Workers are started as new processes, so this only pays off on large jobs, and scripts
+        that post with this enabled must guard their top level code with if __name__ == '__main__'.
+        Ignored when estimating cycle time, or when run from the FreeCAD GUI. Set to 0 to disable.
+        """)
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="""
+        Directory to cache the formatted gcode of each operation in. When re-posting a job, the
+        cached gcode is reused for operations whose commands, tool and post-processor settings
+        have not changed. Ignored when estimating cycle time.
+        """)
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Maximum size of the operation cache in MiB. Least recently used operations are removed first."
+    )
+
+    parser.add_argument('--profile', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, the wall time and call counts of the post-processor hot paths are measured
+        for each operation and command type, with the number of commands suppressed as unchanged.
+        A summary is output at the end of the gcode and the full results are written to a
+        .profile.json file next to the output file. Operations formatted in worker processes
+        or reused from the cache are not measured.
+        """)
+
+    parser.add_argument('--group-tools', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, operations are reordered to reduce the number of tool changes. Operations in
+        the same WCS are kept in order, so this groups operations using the same tool across WCSs.
+        An operation can be kept after other operations by listing their labels in a PostFollows
+        property or a [follows=...] tag in its label. The number of tool changes saved is output
+        in the preamble.
+        """)
+
+    parser.add_argument('--batch', action=argparse.BooleanOptionalAction, default=False,
+        help="""
+        When enabled, runs of consecutive moves within an operation are converted, deduplicated
+        and formatted in vectorised passes using NumPy. This parses operations made of long runs
+        of moves, such as surfacing, several times faster, with less gain on operations made of
+        short runs, at the cost of more memory while parsing. Output is identical to the default
+        mode. Ignored if NumPy is not available.
+        """)
+
+    return parser
+
+# Provide the parser as a module attribute
+def __getattr__(name):
+    if name == 'parser':
+        return argparser()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 # RRF Strings are not allowed to contain certain characters and
@@ -196,6 +681,60 @@ parser.add_argument('--vssc', action=argparse.BooleanOptionalAction, default=Tru
 def rrf_safe_string(s):
     return re.sub(r'([^"0-9a-z\.:,=_\-\s])', "", s, flags=re.IGNORECASE).replace('"', '""')
 
+# Number of formatted values to cache per formatter
+FORMAT_CACHE_SIZE = 4096
+
+# Fixed-precision float format strings that can be compiled
+FIXED_FORMAT = re.compile(r'^\{:0?\.(\d+)f\}$')
+
+_formatters = {}
+
+# Compile a fixed-precision float format string into a function
+# that returns the formatted value with trailing zeroes removed.
+# Generic str.format() calls and trimming are slow, and axis
+# values are formatted millions of times on large jobs, so
+# recently formatted values are cached. Formatters are shared
+# between all Outputs using the same format string.
+# Returns None if the format string cannot be compiled.
+def compile_format(fmt):
+    if fmt in _formatters:
+        return _formatters[fmt]
+
+    m = FIXED_FORMAT.match(fmt)
+    if m is None:
+        _formatters[fmt] = None
+        return None
+
+    precision = int(m.group(1))
+    spec = '%.{}f'.format(precision)
+    cache = {}
+
+    def formatter(value):
+        out = cache.get(value)
+        if out is not None:
+            return out
+
+        try:
+            out = spec % value
+        except TypeError as e:
+            raise ValueError("Error formatting output for {}: {}".format(value, e))
+
+        if precision > 0:
+            out = out.rstrip('0').rstrip('.')
+
+        # Inexact floats can round to negative zero
+        if out == '-0':
+            out = '0'
+
+        if len(cache) >= FORMAT_CACHE_SIZE:
+            cache.clear()
+        cache[value] = out
+        return out
+
+    formatter.precision = precision
+    _formatters[fmt] = formatter
+    return formatter
+
 # Define output class. This is used to output both
 # commands and their nested variables. Output() instances
 # can be nested into other output instances inside the 'vars'
@@ -210,6 +749,8 @@ class Output:
             self.prefixStr = prefix
 
         self.typ = typ
+        self.formatter = compile_format(self.fmt) if fmt is not None else None
+        self.digits = self.formatter.precision if self.formatter is not None else None
 
         self.varFormats = {}
 
@@ -226,6 +767,7 @@ class Output:
                     self.varFormats[prefix] = [v,]
 
         self.ctrl = ctrl
+        self.force = Control.FORCE in ctrl
         self.lastVars = ()
         self.lastCode = None
 
@@ -256,6 +798,13 @@ class Output:
                 self.lastCode = None
                 self.lastVars = None
 
+    # Change the decimal places of a fixed-precision Output
+    def setdigits(self, digits):
+        self.fmt = '{{:0.{}f}}'.format(digits)
+        self.formatter = compile_format(self.fmt)
+        self.digits = digits
+        self.lastCode = None
+
     # Return the current prefix string
     def prefix(self):
         return self.prefixStr
@@ -268,49 +817,128 @@ class Output:
         if self.typ is not None and not isinstance(args[0], self.typ):
             return None
 
-        try:
-            out = self.fmt.format(*args, **kwargs)
-        except Exception as e:
-            raise ValueError("Error formatting output for {} ({}): {}".format(args, kwargs, e))
-
-        # This is crap. There's no way to remove
-        # trailing zeroes from a formatted float
-        # so we just strip them manually if a decimal
-        # separator exists in the string.
-        if '.' in out:
-            out = out.rstrip('0').rstrip('.')
-
-        # This is also crap, but with inexact
-        # floats we might end up with negative
-        # zero after formatting, so we need to
-        # fix before output.
-        if out == '-0':
-            out = '0'
+        # Use the compiled formatter if available, which
+        # trims and caches the formatted value.
+        if self.formatter is not None and len(args) == 1 and not kwargs:
+            out = self.formatter(args[0])
+        else:
+            try:
+                out = self.fmt.format(*args, **kwargs)
+            except Exception as e:
+                raise ValueError("Error formatting output for {} ({}): {}".format(args, kwargs, e))
+
+            # This is crap. There's no way to remove
+            # trailing zeroes from a formatted float
+            # so we just strip them manually if a decimal
+            # separator exists in the string.
+            if '.' in out:
+                out = out.rstrip('0').rstrip('.')
+
+            # This is also crap, but with inexact
+            # floats we might end up with negative
+            # zero after formatting, so we need to
+            # fix before output.
+            if out == '-0':
+                out = '0'
 
         if out == '0' and Control.NONZERO in ctrl:
             return None
 
         return self.prefix() + out
 
+    # Return a mask of the values in a NumPy array that format
+    # to zero and would not be output due to Control.NONZERO.
+    def zeromask(self, values):
+        np = numpy()
+        if Control.NONZERO not in self.ctrl:
+            return np.zeros(len(values), dtype=bool)
+
+        if self.formatter is None or self.typ is not None:
+            return np.array([self.format(v) is None for v in values.tolist()], dtype=bool)
+
+        # Values format to zero if their magnitude rounds down
+        # to zero at the formatter precision. The threshold is
+        # inclusive if the nearest float to it rounds down.
+        half = decimal.Decimal(5).scaleb(-(self.formatter.precision + 1))
+        threshold = float(half)
+        magnitude = np.abs(values)
+        if decimal.Decimal(threshold) <= half:
+            return magnitude <= threshold
+        return magnitude < threshold
+
+    # Format a list of single values as format() would,
+    # using the compiled formatter directly where possible.
+    def formatmany(self, values):
+        if self.formatter is None or self.typ is not None:
+            return [self.format(v) for v in values]
+
+        formatter = self.formatter
+        prefix = self.prefixStr
+        nonzero = Control.NONZERO in self.ctrl
+
+        out = []
+        for v in values:
+            f = formatter(v)
+            out.append(None if nonzero and f == '0' else prefix + f)
+        return out
+
+    # Process a single argument value and return the formatted
+    # value if it should be output. This is equivalent to calling
+    # an Output that has no nested vars or modals, but avoids the
+    # overhead of argument and modal handling for every axis word.
+    def arg(self, value):
+        if self.varFormats or self.modalindex:
+            out, _ = self(value)
+            return out[0] if out else None
+
+        # Compare values at output precision, so changes that
+        # would not be visible in the output are suppressed.
+        # Rounding gives the same result as formatting.
+        if self.digits is not None and type(value) is float:
+            value = round(value, self.digits)
+
+        if value == self.lastCode and not self.force:
+            return None
+
+        if self.formatter is None:
+            out = self.format(value)
+            if out is None:
+                return None
+        else:
+            if self.typ is not None and not isinstance(value, self.typ):
+                return None
+
+            out = self.formatter(value)
+            if out == '0' and Control.NONZERO in self.ctrl:
+                return None
+            out = self.prefixStr + out
+
+        self.lastCode = value
+        return out
+
     # When called, process the code and arguments
     # and output if necessary
     def __call__(self, code, **kwargs):
         ctrl = kwargs.pop('ctrl', self.ctrl)
+        force = Control.FORCE in ctrl
 
-        frozenvars = (code, frozenset(kwargs.items()))
+        # kwargs is a new dict on every call so it can be
+        # stored and compared directly, which is much
+        # cheaper than hashing a frozen copy.
+        lastVars = (code, kwargs)
 
         # If code and args are the same as last then suppress if
         # force is false.
-        if frozenvars == self.lastVars and not (Control.FORCE in ctrl):
+        if lastVars == self.lastVars and not force:
             return (None, None)
 
-        self.lastVars = frozenvars
+        self.lastVars = lastVars
 
         # If code has changed or force is enabled, output
         # the code.
         outCode = None
 
-        if code != self.lastCode or Control.FORCE in ctrl:
+        if code != self.lastCode or force:
             outCode = self.format(code, ctrl=ctrl)
 
             if outCode is None:
@@ -338,9 +966,9 @@ class Output:
         for k, v in kwargs.items():
             if k in self.varFormats:
                 for o in self.varFormats[k]:
-                    argOut, _ = o(v)
-                    if argOut is not None and len(argOut) > 0:
-                        outCmd.append(''.join(argOut[0]))
+                    argOut = o.arg(v)
+                    if argOut:
+                        outCmd.append(argOut)
                         # Store index in cmd list of changed key
                         # Necessary because we don't always output
                         # the command itself.
@@ -364,20 +992,2425 @@ class Output:
 
         return (outCmd, outChanged)
 
+# Vectorised equivalent of Output.arg() over a column of values.
+# 'present' marks values that exist and would format to something
+# outputtable, 'resets' marks indices where the Output is reset
+# before the value is processed and 'last' is the last output
+# value before the first index. Returns a mask of values that
+# would be output, and the last output value after the column.
+def modal_changes(values, present, resets, last):
+    np = numpy()
+    idx = np.arange(len(values))
+
+    # Index of the last present value up to and before each index
+    upto = np.maximum.accumulate(np.where(present, idx, -1))
+    prev = np.concatenate(([-1], upto[:-1]))
+
+    # A reset since the previous present value forces output
+    reset = np.maximum.accumulate(np.where(resets, idx, -1))
+    fresh = reset > prev
+
+    initial = np.ones(len(values), dtype=bool) if last is None else values != last
+    differs = np.where(prev >= 0, values != values[np.maximum(prev, 0)], initial)
+
+    if upto[-1] >= 0 and upto[-1] >= reset[-1]:
+        last = values[upto[-1]].item()
+    elif reset[-1] >= 0:
+        last = None
+
+    return present & (fresh | differs), last
+
+# Apply changes that reset their own Output. Given changes for a
+# column of values that are all present, and 'triggers' marking
+# indices that reset the Output when their value changes, returns
+# the changes that also account for those resets.
+def chained_changes(changes, triggers):
+    np = numpy()
+    idx = np.arange(len(changes))
+    lastChange = np.maximum.accumulate(np.where(changes, idx, -1))
+    lastStop = np.maximum.accumulate(np.where(~triggers, idx, -1))
+    lastStop = np.concatenate(([-1], lastStop[:-1]))
+    return (lastChange >= 0) & (lastChange > lastStop)
+
+# A move passed through the move pipeline, with the
+# resolved machine position before and after the move.
+class Move:
+    __slots__ = ('code', 'params', 'start', 'end')
+
+    def __init__(self, code, params, start, end):
+        self.code   = code
+        self.params = params
+        self.start  = start
+        self.end    = end
+
+# Move pipeline stages sit between command parsing and
+# output, and may buffer, rewrite or drop moves. Stages
+# pass moves to the next stage by calling out(), and must
+# pass on any buffered moves when flushed.
+class MoveStage:
+    def __init__(self):
+        self.out = None
+
+    def push(self, move):
+        self.out(move)
+
+    def flush(self):
+        pass
+
+    # Called at the start of each operation
+    def begin(self):
+        pass
+
+    # Return a summary of changes made since the last
+    # report, to be output as a comment.
+    def report(self):
+        return None
+
+# Distance from a point to the line segment between a and b
+def segment_distance(p, a, b):
+    ab = [b[i] - a[i] for i in range(3)]
+    ap = [p[i] - a[i] for i in range(3)]
+    length = sum(v*v for v in ab)
+    t = 0 if length == 0 else max(0, min(1, sum(ab[i] * ap[i] for i in range(3)) / length))
+    return math.dist(p, [a[i] + ab[i] * t for i in range(3)])
+
+# Removes moves that add no geometry. Linear moves that do not
+# change the position at output resolution are dropped, and runs
+# of linear feed moves at the same feed are merged where every
+# removed point lies within the tolerance of the merged path.
+# Runs are merged greedily into straight moves, or simplified
+# with Douglas-Peucker when 'dp' is set.
+class MoveSimplifier(MoveStage):
+    AXES      = (ARGS.X, ARGS.Y, ARGS.Z)
+    PARAMS    = frozenset([ARGS.X, ARGS.Y, ARGS.Z, ARGS.FEED])
+    MAX_MOVES = 256
+
+    def __init__(self, tolerance, dp=False, formats=None):
+        super().__init__()
+        self.tolerance = tolerance
+        self.dp = dp
+        # Returns the output formatter of an axis
+        self.formats = formats or (lambda axis: compile_format(FORMATS.AXES))
+        self.run = []
+        self.feed = None
+        self.removed = 0
+
+    def known(self, pos):
+        return None not in (pos[ARGS.X], pos[ARGS.Y], pos[ARGS.Z])
+
+    def point(self, pos):
+        return (pos[ARGS.X], pos[ARGS.Y], pos[ARGS.Z])
+
+    def push(self, move):
+        simple = (move.code in (GCODES.RAPID, GCODES.LINEAR)
+            and move.params.keys() <= self.PARAMS
+            and self.known(move.start))
+
+        if not simple:
+            self.flush()
+            self.emit(move)
+            return
+
+        # Drop moves that do not change the position once formatted,
+        # keeping any feed change for the next move.
+        fmt = self.formats
+        if all(fmt(k)(move.start[k]) == fmt(k)(move.end[k]) for k in self.AXES):
+            if ARGS.FEED in move.params:
+                self.feed = move.params[ARGS.FEED]
+            self.removed += 1
+            return
+
+        if move.code != GCODES.LINEAR:
+            self.flush()
+            self.emit(move)
+            return
+
+        if self.run and move.end[ARGS.FEED] != self.run[-1].end[ARGS.FEED]:
+            self.flush()
+
+        if self.dp:
+            self.run.append(move)
+            if len(self.run) >= self.MAX_MOVES:
+                self.flush()
+            return
+
+        # Extend the current run if the new point keeps every
+        # point within tolerance of a single straight move.
+        if self.run and len(self.run) < self.MAX_MOVES and self.straight(self.run + [move]):
+            self.run.append(move)
+            return
+
+        self.flush()
+        self.run = [move]
+
+    def straight(self, moves):
+        a, b = self.point(moves[0].start), self.point(moves[-1].end)
+        return all(segment_distance(self.point(m.end), a, b) <= self.tolerance for m in moves[:-1])
+
+    def flush(self):
+        run = self.run
+        self.run = []
+        if not run:
+            return
+
+        if not self.dp:
+            self.emit(self.merge(run))
+            return
+
+        # Douglas-Peucker over the points of the run, keeping
+        # the ends of the moves that are needed.
+        points = [self.point(run[0].start)] + [self.point(m.end) for m in run]
+        keep = [False] * len(points)
+        keep[0] = keep[-1] = True
+        stack = [(0, len(points) - 1)]
+        while stack:
+            first, last = stack.pop()
+            furthest, index = 0, None
+            for i in range(first + 1, last):
+                d = segment_distance(points[i], points[first], points[last])
+                if d > furthest:
+                    furthest, index = d, i
+            if index is not None and furthest > self.tolerance:
+                keep[index] = True
+                stack.append((first, index))
+                stack.append((index, last))
+
+        start = 0
+        for i in range(1, len(points)):
+            if keep[i]:
+                self.emit(self.merge(run[start:i]))
+                start = i
+
+    # Merge consecutive moves into a single move
+    def merge(self, moves):
+        if len(moves) == 1:
+            return moves[0]
+
+        self.removed += len(moves) - 1
+        start, end = moves[0].start, moves[-1].end
+        params = {k: end[k] for k in self.AXES if any(k in m.params for m in moves)}
+        if any(ARGS.FEED in m.params for m in moves):
+            params[ARGS.FEED] = end[ARGS.FEED]
+        return Move(moves[0].code, params, start, end)
+
+    # Pass a move on, adding any feed change from dropped moves
+    def emit(self, move):
+        if self.feed is not None and move.code != GCODES.RAPID:
+            if ARGS.FEED not in move.params:
+                move.params = {**move.params, ARGS.FEED: self.feed}
+            self.feed = None
+        self.out(move)
+
+    def report(self):
+        removed = self.removed
+        self.removed = 0
+        if removed:
+            return "Simplified path: removed {} moves".format(removed)
+        return None
+
+# Collects runs of linear feed moves in the XY plane at a
+# constant Z height and feed, and replaces runs of moves
+# whose points lie on a circular arc within the tolerance
+# with a single G2 or G3 move.
+class ArcFitter(MoveStage):
+    PARAMS       = frozenset([ARGS.X, ARGS.Y, ARGS.Z, ARGS.FEED])
+    MIN_MOVES    = 3
+    MAX_MOVES    = 128
+    MAX_RADIUS   = 5000
+
+    def __init__(self, tolerance):
+        super().__init__()
+        self.tolerance = tolerance
+        self.run = []
+
+    # Check if a move can be part of a fitted arc
+    def fittable(self, move):
+        start, end = move.start, move.end
+        return (move.code == GCODES.LINEAR
+            and move.params.keys() <= self.PARAMS
+            and None not in (start[ARGS.X], start[ARGS.Y], start[ARGS.Z])
+            and start[ARGS.Z] == end[ARGS.Z]
+            and (start[ARGS.X], start[ARGS.Y]) != (end[ARGS.X], end[ARGS.Y]))
+
+    def push(self, move):
+        if not self.fittable(move):
+            self.flush()
+            self.out(move)
+            return
+
+        if self.run and move.end[ARGS.FEED] != self.run[-1].end[ARGS.FEED]:
+            self.flush()
+
+        self.run.append(move)
+
+    def flush(self):
+        run = self.run
+        self.run = []
+
+        i = 0
+        while i < len(run):
+            arc = None
+            j = i + self.MIN_MOVES - 1
+
+            # Extend the arc one move at a time for as long
+            # as the points still fit.
+            while j < len(run) and j - i < self.MAX_MOVES:
+                fit = self.fit(run[i:j+1])
+                if fit is None:
+                    break
+                arc = (j, fit)
+                j += 1
+
+            if arc is None:
+                self.out(run[i])
+                i += 1
+                continue
+
+            j, (cx, cy, ccw) = arc
+            self.out(self.arc(run[i:j+1], cx, cy, ccw))
+            i = j + 1
+
+    # Fit a circle through the first, middle and last points of
+    # the moves. Returns the centre and direction if all points
+    # and chords are within tolerance of the arc, otherwise None.
+    def fit(self, moves):
+        points = [(moves[0].start[ARGS.X], moves[0].start[ARGS.Y])]
+        points.extend((m.end[ARGS.X], m.end[ARGS.Y]) for m in moves)
+
+        (ax, ay), (bx, by), (ex, ey) = points[0], points[len(points)//2], points[-1]
+        d = 2 * (ax * (by - ey) + bx * (ey - ay) + ex * (ay - by))
+        if d == 0:
+            return None
+
+        a2, b2, e2 = ax*ax + ay*ay, bx*bx + by*by, ex*ex + ey*ey
+        cx = (a2 * (by - ey) + b2 * (ey - ay) + e2 * (ay - by)) / d
+        cy = (a2 * (ex - bx) + b2 * (ax - ex) + e2 * (bx - ax)) / d
+        r = math.hypot(ax - cx, ay - cy)
+        if r > self.MAX_RADIUS:
+            return None
+
+        sweep = 0
+        last = math.atan2(ay - cy, ax - cx)
+        for k in range(1, len(points)):
+            px, py = points[k]
+            if abs(math.hypot(px - cx, py - cy) - r) > self.tolerance:
+                return None
+
+            # Chords deviate from the arc by their sagitta
+            chord = math.hypot(px - points[k-1][0], py - points[k-1][1])
+            if r - math.sqrt(max(0, r*r - chord*chord/4)) > self.tolerance:
+                return None
+
+            # Every move must turn in the same direction
+            angle = math.atan2(py - cy, px - cx)
+            delta = (angle - last + math.pi) % (2 * math.pi) - math.pi
+            if delta == 0 or (sweep != 0 and (delta > 0) != (sweep > 0)):
+                return None
+            sweep += delta
+            last = angle
+
+        if abs(sweep) >= 2 * math.pi:
+            return None
+
+        return (cx, cy, sweep > 0)
+
+    # Create an arc move replacing the given linear moves
+    def arc(self, moves, cx, cy, ccw):
+        start, end = moves[0].start, moves[-1].end
+        params = {
+            ARGS.X: end[ARGS.X],
+            ARGS.Y: end[ARGS.Y],
+            ARGS.Z: end[ARGS.Z],
+            ARGS.ARC_X: cx - start[ARGS.X],
+            ARGS.ARC_Y: cy - start[ARGS.Y],
+        }
+        if end[ARGS.FEED] is not None:
+            params[ARGS.FEED] = end[ARGS.FEED]
+
+        code = GCODES.ARC_CCW if ccw else GCODES.ARC_CW
+        return Move(code, params, start, end)
+
+# Return the start angle and signed sweep of an arc around the
+# given centre. Arcs that end where they start are full circles.
+def arc_sweep(code, start, end, cx, cy, epsilon=1e-9):
+    a0 = math.atan2(start[1] - cy, start[0] - cx)
+    a1 = math.atan2(end[1] - cy, end[0] - cx)
+    sweep = a1 - a0
+    if code == GCODES.ARC_CW and sweep >= -epsilon:
+        sweep -= 2 * math.pi
+    elif code == GCODES.ARC_CCW and sweep <= epsilon:
+        sweep += 2 * math.pi
+    return a0, sweep
+
+# Merges runs of arcs around the same centre, in the same direction
+# and at the same feed into as few arcs as possible. RRF cannot turn
+# more than once in a single move, so runs are merged into arcs of
+# up to one full turn. Helical arcs are merged if they descend at
+# the same rate, so helical ramps become one move per turn.
+class ArcMerger(MoveStage):
+    PARAMS    = frozenset([ARGS.X, ARGS.Y, ARGS.Z, ARGS.ARC_X, ARGS.ARC_Y, ARGS.FEED])
+    TOLERANCE = 1e-4
+    TURN      = 2 * math.pi
+
+    def __init__(self):
+        super().__init__()
+        self.run = []
+        self.sweep = 0.0
+        self.merged = 0
+        self.removed = 0
+
+    # Return the centre, radius, sweep and depth of an arc
+    # that can be merged, otherwise None.
+    def measure(self, move):
+        start, end = move.start, move.end
+        if move.code not in (GCODES.ARC_CW, GCODES.ARC_CCW) or not move.params.keys() <= self.PARAMS:
+            return None
+        if None in (start[ARGS.X], start[ARGS.Y], start[ARGS.Z]):
+            return None
+
+        cx = start[ARGS.X] + move.params.get(ARGS.ARC_X, 0)
+        cy = start[ARGS.Y] + move.params.get(ARGS.ARC_Y, 0)
+        p0, p1 = (start[ARGS.X], start[ARGS.Y]), (end[ARGS.X], end[ARGS.Y])
+        _, sweep = arc_sweep(move.code, p0, p1, cx, cy)
+        return (cx, cy, math.hypot(p0[0] - cx, p0[1] - cy), abs(sweep), end[ARGS.Z] - start[ARGS.Z])
+
+    # Check if an arc continues the run
+    def continues(self, move, arc):
+        first, last = self.run[0], self.run[-1]
+        cx, cy, radius, sweep, depth = arc
+        fx, fy, fradius, fsweep, fdepth = first[1]
+        return (move.code == first[0].code
+            and move.end[ARGS.FEED] == last[0].end[ARGS.FEED]
+            and abs(cx - fx) < self.TOLERANCE and abs(cy - fy) < self.TOLERANCE
+            and abs(radius - fradius) < self.TOLERANCE
+            and abs(depth - fdepth / fsweep * sweep) < self.TOLERANCE
+            and self.sweep + sweep <= self.TURN + self.TOLERANCE / max(radius, self.TOLERANCE))
+
+    def push(self, move):
+        arc = self.measure(move)
+        if arc is None:
+            self.flush()
+            self.out(move)
+            return
+
+        if self.run and not self.continues(move, arc):
+            self.flush()
+
+        self.run.append((move, arc))
+        self.sweep += arc[3]
+
+    def flush(self):
+        run = self.run
+        self.run = []
+        self.sweep = 0.0
+        if not run:
+            return
+        if len(run) == 1:
+            self.out(run[0][0])
+            return
+
+        first, last = run[0][0], run[-1][0]
+        cx, cy = run[0][1][:2]
+        params = {ARGS.X: last.end[ARGS.X], ARGS.Y: last.end[ARGS.Y]}
+        if any(ARGS.Z in m.params for m, _ in run):
+            params[ARGS.Z] = last.end[ARGS.Z]
+        params[ARGS.ARC_X] = cx - first.start[ARGS.X]
+        params[ARGS.ARC_Y] = cy - first.start[ARGS.Y]
+        if ARGS.FEED in first.params:
+            params[ARGS.FEED] = first.params[ARGS.FEED]
+
+        self.merged += 1
+        self.removed += len(run) - 1
+        self.out(Move(first.code, params, first.start, last.end))
+
+    def report(self):
+        merged, removed = self.merged, self.removed
+        self.merged, self.removed = 0, 0
+        if not merged:
+            return None
+        return "Merged arcs: {} arcs from {} segments, removed {} moves".format(merged, merged + removed, removed)
+
+# Outputs drilling as canned cycles. The MillenniumOS cycle macros
+# rapid to the retract plane, move above the hole and drill it, so
+# a plunge that was expanded into a feed down to depth followed by
+# a rapid back out can be replaced by a G81 cycle. Rapids between
+# holes at the retract plane are folded into the cycle that
+# follows them.
+class CycleCompactor(MoveStage):
+    CYCLES  = (GCODES.DRILL_CHIPBREAK, GCODES.DRILL, GCODES.DRILL_PECK)
+    PARAMS  = frozenset([ARGS.X, ARGS.Y, ARGS.Z, ARGS.FEED])
+    EPSILON = 1e-6
+
+    def __init__(self):
+        super().__init__()
+        self.moves = []
+        self.holes = 0
+        self.folded = 0
+
+    # Check if a move is a straight move between known points,
+    # vertical or in the XY plane as given.
+    def straight(self, move, vertical):
+        start, end = move.start, move.end
+        if move.code not in (GCODES.RAPID, GCODES.LINEAR) or not move.params.keys() <= self.PARAMS:
+            return False
+        if None in (start[ARGS.X], start[ARGS.Y], start[ARGS.Z]):
+            return False
+        if vertical:
+            return start[ARGS.X] == end[ARGS.X] and start[ARGS.Y] == end[ARGS.Y]
+        return abs(start[ARGS.Z] - end[ARGS.Z]) < self.EPSILON
+
+    # A rapid in the XY plane
+    def travel(self, move):
+        return (move.code == GCODES.RAPID and self.straight(move, False)
+            and (move.start[ARGS.X], move.start[ARGS.Y]) != (move.end[ARGS.X], move.end[ARGS.Y]))
+
+    # A rapid down towards the retract plane, or a rapid that
+    # does not move at all.
+    def approach(self, move):
+        return move.code == GCODES.RAPID and self.straight(move, True) and move.end[ARGS.Z] <= move.start[ARGS.Z] + self.EPSILON
+
+    def plunge(self, move):
+        return (move.code == GCODES.LINEAR and self.straight(move, True)
+            and move.end[ARGS.Z] < move.start[ARGS.Z] - self.EPSILON and move.end[ARGS.FEED] is not None)
+
+    def retract(self, move, plunge):
+        return (move.code == GCODES.RAPID and self.straight(move, True)
+            and move.end[ARGS.Z] >= plunge.start[ARGS.Z] - self.EPSILON)
+
+    # Check if a move can follow the buffered moves towards a hole
+    def extends(self, move):
+        moves = self.moves
+        if self.travel(move):
+            return not moves
+        if self.approach(move):
+            return not moves or (len(moves) == 1 and self.travel(moves[0]))
+        if self.plunge(move):
+            return not moves or not self.plunge(moves[-1])
+        return False
+
+    def push(self, move):
+        moves = self.moves
+        if moves and self.plunge(moves[-1]) and self.retract(move, moves[-1]):
+            self.drill(move)
+            return
+
+        if move.code in self.CYCLES:
+            self.cycle(move)
+            return
+
+        if not self.extends(move):
+            self.flush()
+            if not self.extends(move):
+                self.out(move)
+                return
+        self.moves.append(move)
+
+    # Return the buffered travel move if it is at the given
+    # height and ends at the given hole position, so it can be
+    # folded into a cycle there.
+    def foldable(self, height, x, y):
+        if not self.moves or not self.travel(self.moves[0]):
+            return None
+        travel = self.moves[0]
+        if abs(travel.end[ARGS.Z] - height) >= self.EPSILON:
+            return None
+        if (x is not None and x != travel.end[ARGS.X]) or (y is not None and y != travel.end[ARGS.Y]):
+            return None
+        return travel
+
+    # Replace the buffered plunge and the retract that follows
+    # it with a cycle.
+    def drill(self, retract):
+        plunge = self.moves.pop()
+        top = plunge.start[ARGS.Z]
+        feed = plunge.end[ARGS.FEED]
+        start = plunge.start
+        end = dict(plunge.start, F=feed)
+        params = {ARGS.Z: plunge.end[ARGS.Z], ARGS.ARC_R: top, ARGS.FEED: feed}
+
+        travel = self.foldable(top, None, None)
+        if travel is not None:
+            params[ARGS.X], params[ARGS.Y] = end[ARGS.X], end[ARGS.Y]
+            start = travel.start
+            self.moves = []
+            self.folded += 1
+        else:
+            # The cycle starts with a rapid to the retract plane
+            if self.moves and self.approach(self.moves[-1]):
+                start = self.moves.pop().start
+            self.flush()
+
+        self.holes += 1
+        self.out(Move(GCODES.DRILL, params, start, end))
+
+        if retract.end[ARGS.Z] > top + self.EPSILON:
+            self.out(Move(GCODES.RAPID, {ARGS.Z: retract.end[ARGS.Z]}, end, retract.end))
+
+    # Fold a travel move at the retract plane into a cycle
+    def cycle(self, move):
+        params = move.params
+        travel = None
+        if ARGS.ARC_R in params and len(self.moves) == 1:
+            travel = self.foldable(params[ARGS.ARC_R], params.get(ARGS.X), params.get(ARGS.Y))
+
+        if travel is None:
+            self.flush()
+            self.out(move)
+            return
+
+        self.moves = []
+        self.folded += 1
+        params = dict(params)
+        params[ARGS.X], params[ARGS.Y] = travel.end[ARGS.X], travel.end[ARGS.Y]
+        self.out(Move(move.code, params, travel.start, move.end))
+
+    def flush(self):
+        moves = self.moves
+        self.moves = []
+        for m in moves:
+            self.out(m)
+
+    def report(self):
+        holes, folded = self.holes, self.folded
+        self.holes, self.folded = 0, 0
+        if not holes and not folded:
+            return None
+        return "Canned cycles: converted {} plunges to cycles, folded {} rapids into cycles".format(holes, folded)
+
+# Speeds up linear feed moves that only cut air, given the
+# bounding box of the stock. Moves above the top of the stock,
+# and moves beside it in X or Y allowing for the tool radius,
+# each with a safety margin, are promoted to a faster feed rate,
+# or to rapids if no feed rate is given. Moves that cross the
+# plane above the stock, such as plunges from the safe height,
+# are split there so the part above it can be promoted. Moves
+# below the bottom of the stock are never promoted, as they may
+# be near fixtures.
+class AirMovePromoter(MoveStage):
+    EPSILON = 1e-6
+    AXES    = (ARGS.X, ARGS.Y, ARGS.Z)
+
+    def __init__(self, margin, feed, stock, radius, machine):
+        super().__init__()
+        self.margin = margin
+        self.feed = feed
+        self.stock = stock
+        self.radius = radius
+        self.machine = machine
+        # The next feed move must restore the programmed feed
+        self.restore = False
+        self.promoted = 0
+        self.saved = 0.0
+
+    def push(self, move):
+        stock = self.stock()
+        if (move.code != GCODES.LINEAR or stock is None or move.end[ARGS.FEED] is None
+                or None in (move.start[k] for k in self.AXES) or None in (move.end[k] for k in self.AXES)):
+            self.cut(move)
+            return
+
+        lo, hi = stock
+        top = hi[2] + self.margin
+        z0, z1 = move.start[ARGS.Z], move.end[ARGS.Z]
+        if min(z0, z1) >= top or self.beside(move, lo, hi):
+            self.promote(move)
+            return
+
+        # Split moves crossing the plane above the stock
+        if (z0 > top) != (z1 > top) and abs(z0 - top) > self.EPSILON and abs(z1 - top) > self.EPSILON:
+            t = (top - z0) / (z1 - z0)
+            mid = dict(move.end)
+            for k in self.AXES:
+                mid[k] = move.start[k] + (move.end[k] - move.start[k]) * t
+            axes = [k for k in self.AXES if k in move.params]
+            first = Move(GCODES.LINEAR, {k: mid[k] for k in axes}, move.start, mid)
+            second = Move(GCODES.LINEAR, {k: move.end[k] for k in axes}, mid, move.end)
+            if z0 > top:
+                self.promote(first)
+                self.cut(second)
+            else:
+                self.cut(first)
+                self.promote(second)
+            return
+
+        self.cut(move)
+
+    def report(self):
+        promoted, saved = self.promoted, self.saved
+        self.promoted, self.saved = 0, 0.0
+        if not promoted:
+            return None
+        return "Promoted {} air moves clear of the stock, saved ~{:.1f}s".format(promoted, saved)
+
+    # Check if a move is entirely beside the stock in X or Y,
+    # and not below it.
+    def beside(self, move, lo, hi):
+        if min(move.start[ARGS.Z], move.end[ARGS.Z]) < lo[2]:
+            return False
+        clearance = self.radius() + self.margin
+        for i, k in enumerate((ARGS.X, ARGS.Y)):
+            a, b = move.start[k], move.end[k]
+            if max(a, b) < lo[i] - clearance or min(a, b) > hi[i] + clearance:
+                return True
+        return False
+
+    # Output a move at its programmed feed rate
+    def cut(self, move):
+        if self.restore and move.code in (GCODES.LINEAR, GCODES.ARC_CW, GCODES.ARC_CCW) and move.end[ARGS.FEED] is not None:
+            self.restore = False
+            if ARGS.FEED not in move.params:
+                move = Move(move.code, dict(move.params, F=move.end[ARGS.FEED]), move.start, move.end)
+        self.out(move)
+
+    # Output a move at the promoted feed rate, or as a rapid
+    def promote(self, move):
+        length = math.dist([move.start[k] for k in self.AXES], [move.end[k] for k in self.AXES])
+        feed = self.machine.feedrate(move.end[ARGS.FEED])
+        if length < self.EPSILON or not feed:
+            self.cut(move)
+            return
+
+        axes = {k: v for k, v in move.params.items() if k != ARGS.FEED}
+        if self.feed is None:
+            rate = self.machine.rapidrate([(move.end[k] - move.start[k]) / length for k in self.AXES])
+            promoted = Move(GCODES.RAPID, axes, move.start, move.end)
+        else:
+            rate = self.machine.feedrate(self.feed)
+            if rate <= feed:
+                self.cut(move)
+                return
+            promoted = Move(GCODES.LINEAR, dict(axes, F=self.feed), move.start, dict(move.end, F=self.feed))
+
+        self.promoted += 1
+        self.saved += (length / feed - length / rate) * 60
+        self.restore = True
+        self.out(promoted)
+
+# Reorders independent features within a block of moves to
+# minimise rapid travel between them. Features are joined by
+# rapids at the travel plane, which is the safe height FreeCAD
+# retracts to between features: the lowest height of the rapids
+# in the XY plane that are above all cutting moves, and at or
+# above the safe height of the operation if it is known. A
+# feature is a run of moves that leaves the travel plane and
+# returns to it, and each canned cycle is a feature of its own.
+# Features are visited in any order at the travel plane, as
+# long as features that overlap in XY, allowing for the tool
+# radius, keep their original order. The travel into the first
+# feature and out of the last one keeps the height of the
+# original, which is usually the clearance height. Features are
+# ordered by nearest neighbour and then improved with 2-opt.
+# To bound the moves held in memory, when the safe height is
+# known, features are buffered in groups, each reordered on its
+# own, and features too long to buffer are output as they come.
+# Otherwise blocks too large to buffer are output unchanged.
+class RapidOptimiser(MoveStage):
+    MAX_MOVES    = 20000
+    MAX_FEATURES = 100
+    MAX_TWO_OPT = 500
+    MAX_PASSES  = 10
+    EPSILON     = 1e-6
+    MOTION      = (GCODES.RAPID, GCODES.LINEAR, GCODES.ARC_CW, GCODES.ARC_CCW)
+    CYCLES      = (GCODES.DRILL_CHIPBREAK, GCODES.DRILL, GCODES.DRILL_PECK)
+    # Canned cycle parameters, which are carried over from
+    # earlier cycles when not given.
+    CYCLE_PARAMS = (ARGS.Z, ARGS.ARC_R, ARGS.PECK, ARGS.FEED)
+
+    def __init__(self, rate, radius, safe=lambda: None):
+        super().__init__()
+        self.rate = rate
+        self.radius = radius
+        self.safe = safe
+        self.moves = []
+        self.passthrough = False
+        self.streaming = False
+        self.entry = None
+        self.buffered = 0
+        self.cycles = False
+        self.features = 0
+        self.saved = 0
+
+    def push(self, move):
+        if self.passthrough:
+            self.out(move)
+            return
+
+        # Blocks are only split into groups when the safe height
+        # is known, as the travel plane of each group is then at
+        # or above it, clear of the whole operation. Cycles are
+        # not split from each other, as their parameters are
+        # carried from one to the next.
+        safe = self.safe()
+        grouped = safe is not None and not self.cycles
+        travel = safe is not None and self.travel(move, safe)
+
+        # A feature too long to buffer is output as it comes
+        # until the tool is back at the safe height.
+        if self.streaming:
+            if not travel:
+                self.out(move)
+                return
+            self.streaming = False
+
+        self.moves.append(move)
+        if travel:
+            self.entry = None
+        elif self.entry is None or move.code in self.CYCLES:
+            self.entry = len(self.moves) - 1
+            self.buffered += 1
+            if grouped and self.buffered > self.MAX_FEATURES:
+                self.group(self.entry)
+            self.cycles = self.cycles or move.code in self.CYCLES
+
+        if len(self.moves) < self.MAX_MOVES:
+            return
+
+        if grouped:
+            self.group(len(self.moves) if self.entry is None else self.entry)
+            self.streaming = self.entry is not None
+        else:
+            self.passthrough = True
+        for m in self.moves:
+            self.out(m)
+        self.reset()
+
+    # Output the buffered moves before the nth as a group of
+    # their own, keeping the rest buffered. Feed rates are
+    # modal, so the first feed move of the rest must state its
+    # feed, as the group may end with a different feature.
+    def group(self, n):
+        for m in self.optimise(self.moves[:n]):
+            self.out(m)
+        self.moves = self.restate(self.moves[n:])
+        self.entry = 0 if self.moves and self.entry is not None else None
+        self.buffered = 1 if self.entry is not None else 0
+        self.cycles = any(m.code in self.CYCLES for m in self.moves)
+
+    def reset(self):
+        self.moves = []
+        self.entry = None
+        self.buffered = 0
+        self.cycles = False
+
+    def flush(self):
+        moves = self.moves
+        self.reset()
+        self.passthrough = False
+        self.streaming = False
+        for m in self.optimise(moves):
+            self.out(m)
+
+    # Whether a move is travel at or above the safe height, as
+    # judged while buffering before the travel plane is known.
+    def travel(self, m, safe):
+        return m.code == GCODES.RAPID and None not in (m.start[ARGS.Z], m.end[ARGS.Z]) \
+            and min(m.start[ARGS.Z], m.end[ARGS.Z]) >= safe - self.EPSILON
+
+    def report(self):
+        features, saved = self.features, self.saved
+        self.features, self.saved = 0, 0
+        if not features:
+            return None
+        return "Optimised rapids: reordered {} features, saved {:.1f}mm of travel (~{:.1f}s)".format(
+            features, saved, saved / self.rate * 60)
+
+    def vertical(self, m):
+        return m.start[ARGS.X] == m.end[ARGS.X] and m.start[ARGS.Y] == m.end[ARGS.Y]
+
+    # Return the travel plane of a block of moves, or None if
+    # there is no rapid in the XY plane above all cutting moves.
+    def plane(self, moves):
+        # Vertical moves only cut at the bottom, other moves may
+        # cut all the way along.
+        top = -math.inf
+        for m in moves:
+            if m.code in self.CYCLES:
+                top = max(top, m.params.get(ARGS.Z, -math.inf))
+            elif m.code != GCODES.RAPID:
+                z = (min if self.vertical(m) else max)(m.start[ARGS.Z], m.end[ARGS.Z])
+                top = max(top, z)
+
+        floor = top + self.EPSILON
+        safe = self.safe()
+        if safe is not None:
+            floor = max(floor, safe - self.EPSILON)
+
+        heights = [m.end[ARGS.Z] for m in moves if m.code == GCODES.RAPID and not self.vertical(m)
+            and abs(m.end[ARGS.Z] - m.start[ARGS.Z]) <= self.EPSILON and m.end[ARGS.Z] >= floor]
+        return min(heights, default=None)
+
+    # Return moves in an optimised order, or unchanged if
+    # they cannot be reordered or no travel is saved.
+    def optimise(self, moves):
+        if any(m.code not in self.MOTION and m.code not in self.CYCLES for m in moves):
+            return moves
+
+        # Moves until the position is fully known are kept as-is
+        p = 0
+        while p < len(moves) and None in (moves[p].start[ARGS.X], moves[p].start[ARGS.Y], moves[p].start[ARGS.Z]):
+            p += 1
+
+        prefix, body = moves[:p], moves[p:]
+        if not body:
+            return moves
+
+        plane = self.plane(body)
+        if plane is None:
+            return moves
+
+        def above(pos):
+            return pos[ARGS.Z] >= plane - self.EPSILON
+
+        features = []
+        lead = []
+        trailing = []
+        current = None
+        travelled = 0
+        cycle = {}
+
+        for m in body:
+            # Travel is rapids that stay at or above the plane
+            if m.code == GCODES.RAPID and above(m.start) and above(m.end):
+                if current is not None:
+                    features.append(current)
+                    current = None
+                trailing.append(m)
+                continue
+
+            if current is None:
+                if not above(m.start):
+                    return moves
+                travelled += sum(self.distance(t.start, t.end) for t in trailing)
+                if not features:
+                    lead = trailing
+                trailing = []
+                current = []
+
+            if m.code in self.CYCLES:
+                # Each cycle is its own feature, which starts
+                # above its hole with all parameters given.
+                if current:
+                    if not above(current[-1].end):
+                        return moves
+                    features.append(current)
+                    travelled += self.distance(current[-1].end, m.start)
+                if not above(m.end):
+                    return moves
+
+                cycle.update((k, v) for k, v in m.params.items() if k in self.CYCLE_PARAMS)
+                entry = dict(m.start)
+                entry[ARGS.X], entry[ARGS.Y] = m.end[ARGS.X], m.end[ARGS.Y]
+                travelled += self.distance(m.start, entry)
+                params = dict(m.params)
+                params[ARGS.X], params[ARGS.Y] = m.end[ARGS.X], m.end[ARGS.Y]
+                for k, v in cycle.items():
+                    params.setdefault(k, v)
+                features.append([Move(m.code, params, entry, m.end)])
+                current = None
+                continue
+
+            current.append(m)
+
+        # Blocks that do not end at the travel plane cannot be
+        # reordered.
+        if current is not None:
+            if not above(current[-1].end):
+                return moves
+            features.append(current)
+        if len(features) < 2:
+            return moves
+
+        anchor = body[0].start
+        order = self.order(features, anchor)
+
+        planned = self.distance(anchor, features[order[0]][0].start)
+        for a, b in zip(order, order[1:]):
+            planned += self.distance(features[a][-1].end, features[b][0].start)
+
+        if planned >= travelled - self.EPSILON:
+            return moves
+
+        self.features += len(features)
+        self.saved += travelled - planned
+
+        # Travel into the first feature at the highest point of
+        # the original travel into it. A move straight up to
+        # that height is kept even if the tool should already be
+        # there, as the machine may have been parked since.
+        height = max([anchor[ARGS.Z]] + [t.end[ARGS.Z] for t in lead])
+        rise = any(self.vertical(t) and abs(t.end[ARGS.Z] - height) <= self.EPSILON for t in lead)
+        out = list(prefix)
+        pos = anchor
+        for k in order:
+            feature = features[k]
+            entry = feature[0].start
+            out.extend(self.hop(pos, entry, max(height, entry[ARGS.Z]), rise))
+            out.extend(self.restate(feature))
+            pos = feature[-1].end
+            height = pos[ARGS.Z]
+            rise = False
+
+        # Trailing travel is kept but must start from the new
+        # last feature. Moves straight up or down stay above it,
+        # and the first other move is made explicit.
+        for i, t in enumerate(trailing):
+            if not self.vertical(t):
+                params = {ARGS.X: t.end[ARGS.X], ARGS.Y: t.end[ARGS.Y], ARGS.Z: t.end[ARGS.Z]}
+                out.append(Move(t.code, params, pos, t.end))
+                out.extend(self.restate(trailing[i+1:]))
+                break
+            end = dict(pos)
+            end[ARGS.Z] = t.end[ARGS.Z]
+            out.append(Move(t.code, {ARGS.Z: t.end[ARGS.Z]}, pos, end))
+            pos = end
+
+        return out
+
+    # Rapids from one position to another, travelling in the
+    # XY plane at the given height, optionally moving to that
+    # height even if already there.
+    def hop(self, pos, entry, height, rise=False):
+        out = []
+        if rise or pos[ARGS.Z] < height - self.EPSILON:
+            end = dict(pos)
+            end[ARGS.Z] = height
+            out.append(Move(GCODES.RAPID, {ARGS.Z: height}, pos, end))
+            pos = end
+        if self.distance(pos, entry) > 0:
+            end = dict(pos)
+            end[ARGS.X], end[ARGS.Y] = entry[ARGS.X], entry[ARGS.Y]
+            out.append(Move(GCODES.RAPID, {ARGS.X: entry[ARGS.X], ARGS.Y: entry[ARGS.Y]}, pos, end))
+            pos = end
+        if pos[ARGS.Z] > entry[ARGS.Z] + self.EPSILON:
+            out.append(Move(GCODES.RAPID, {ARGS.Z: entry[ARGS.Z]}, pos, dict(pos, **{ARGS.Z: entry[ARGS.Z]})))
+        return out
+
+    # Feed rates are modal, so the first feed move of a
+    # reordered feature must state its feed explicitly.
+    def restate(self, moves):
+        out = list(moves)
+        for i, m in enumerate(out):
+            if m.code != GCODES.RAPID:
+                if ARGS.FEED not in m.params and m.start[ARGS.FEED] is not None:
+                    out[i] = Move(m.code, {**m.params, ARGS.FEED: m.start[ARGS.FEED]}, m.start, m.end)
+                break
+        return out
+
+    def distance(self, a, b):
+        return math.hypot(a[ARGS.X] - b[ARGS.X], a[ARGS.Y] - b[ARGS.Y])
+
+    # XY bounds of a feature, expanded by the tool radius
+    def bounds(self, feature, radius):
+        xs, ys = [feature[0].start[ARGS.X]], [feature[0].start[ARGS.Y]]
+        for m in feature:
+            xs.append(m.end[ARGS.X])
+            ys.append(m.end[ARGS.Y])
+            if m.code in (GCODES.ARC_CW, GCODES.ARC_CCW):
+                cx = m.start[ARGS.X] + m.params.get(ARGS.ARC_X, 0)
+                cy = m.start[ARGS.Y] + m.params.get(ARGS.ARC_Y, 0)
+                r = math.hypot(m.start[ARGS.X] - cx, m.start[ARGS.Y] - cy)
+                xs.extend((cx - r, cx + r))
+                ys.extend((cy - r, cy + r))
+        return (min(xs) - radius, min(ys) - radius, max(xs) + radius, max(ys) + radius)
+
+    # Order features by nearest neighbour from the anchor, only
+    # visiting a feature once all overlapping features that came
+    # before it have been visited. Then improve with 2-opt.
+    def order(self, features, anchor):
+        n = len(features)
+        radius = self.radius()
+        bounds = sorted((self.bounds(f, radius), i) for i, f in enumerate(features))
+
+        before = [set() for _ in range(n)]
+        partners = [set() for _ in range(n)]
+        for a, ((ax1, ay1, ax2, ay2), i) in enumerate(bounds):
+            for (bx1, by1, bx2, by2), j in bounds[a+1:]:
+                if bx1 > ax2:
+                    break
+                if by1 <= ay2 and by2 >= ay1:
+                    first, second = min(i, j), max(i, j)
+                    before[second].add(first)
+                    partners[i].add(j)
+                    partners[j].add(i)
+
+        entries = [f[0].start for f in features]
+        exits = [f[-1].end for f in features]
+
+        waiting = [len(b) for b in before]
+        available = [i for i in range(n) if not waiting[i]]
+        order = []
+        pos = anchor
+        while available:
+            k = min(available, key=lambda i: (self.distance(pos, entries[i]), i))
+            available.remove(k)
+            order.append(k)
+            pos = exits[k]
+            for j in partners[k]:
+                if k in before[j]:
+                    waiting[j] -= 1
+                    if not waiting[j]:
+                        available.append(j)
+
+        if n <= self.MAX_TWO_OPT:
+            self.twoopt(order, anchor, entries, exits, partners)
+
+        return order
+
+    # Improve an open path of features in place by reversing
+    # segments of it, where no overlapping features are inside
+    # the reversed segment.
+    def twoopt(self, order, anchor, entries, exits, partners):
+        d = self.distance
+        n = len(order)
+        position = {k: i for i, k in enumerate(order)}
+
+        for _ in range(self.MAX_PASSES):
+            improved = False
+            for i in range(n - 1):
+                before = anchor if i == 0 else exits[order[i-1]]
+                forward = reverse = 0
+                for j in range(i + 1, n):
+                    a, b = order[j-1], order[j]
+                    if any(i <= position[p] < j for p in partners[b]):
+                        break
+
+                    # Cost of the segment between i and j in the
+                    # current and reversed order.
+                    forward += d(exits[a], entries[b])
+                    reverse += d(exits[b], entries[a])
+
+                    delta = d(before, entries[b]) + reverse - d(before, entries[order[i]]) - forward
+                    if j + 1 < n:
+                        after = entries[order[j+1]]
+                        delta += d(exits[order[i]], after) - d(exits[b], after)
+
+                    if delta < -self.EPSILON:
+                        order[i:j+1] = order[i:j+1][::-1]
+                        for k in range(i, j + 1):
+                            position[order[k]] = k
+                        improved = True
+                        break
+            if not improved:
+                break
+
+# Shortens retracts between passes that stay inside the area
+# already cleared by the operation. A retract is a rapid straight
+# up, rapids in the XY plane, rapids straight down and a feed
+# straight down to depth. If the tool would only pass over area
+# swept by earlier cuts of the operation at or below the height
+# it travels at, the sequence is replaced by a feed across at
+# depth where that is faster ('feed'), or the travel is lowered
+# to the safe height of the operation. Cuts only count as clear
+# down to their shallowest point, arcs are split into chords
+# inside them, and travel is checked across the tool every
+# eighth of the tool radius along it. Retracts without XY travel,
+# such as pecks, are kept.
+class RetractShortener(MoveStage):
+    EPSILON     = 1e-6
+    AXES        = (ARGS.X, ARGS.Y, ARGS.Z)
+    FEEDS       = (GCODES.LINEAR, GCODES.ARC_CW, GCODES.ARC_CCW)
+    PARAMS      = frozenset([ARGS.X, ARGS.Y, ARGS.Z, ARGS.FEED])
+    # Spacing of checks along travel, and the maximum error of
+    # chords of arcs, as fractions of the tool radius.
+    STEP        = 0.125
+    CHORD       = 0.05
+    # Travel needing more checks than this is kept
+    MAX_CHECKS  = 20000
+
+    # Parts of a retract, in the order they must appear
+    RETRACT, TRAVEL, APPROACH, PLUNGE = range(4)
+
+    def __init__(self, feed, safe, radius, machine):
+        super().__init__()
+        self.feed = feed
+        self.safe = safe
+        self.radius = radius
+        self.machine = machine
+        self.moves = []
+        # The next feed move must restore the programmed feed
+        self.restore = False
+        self.shortened = 0
+        self.removed = 0.0
+        self.begin()
+
+    # Cleared area is only known within an operation
+    def begin(self):
+        self.cuts = []
+        self.cells = {}
+        self.depths = {}
+        self.indexed = 0
+        self.size = None
+
+    def push(self, move):
+        part = self.part(move)
+        if part is not None and self.extends(part):
+            self.moves.append(move)
+            if part == self.PLUNGE:
+                self.shorten()
+            return
+
+        self.flush()
+        if part == self.RETRACT:
+            self.moves.append(move)
+        else:
+            self.emit(move)
+
+    def flush(self):
+        moves = self.moves
+        self.moves = []
+        for m in moves:
+            self.emit(m)
+
+    def report(self):
+        shortened, removed = self.shortened, self.removed
+        self.shortened, self.removed = 0, 0.0
+        if not shortened:
+            return None
+        return "Kept tool down: shortened {} retracts, removed {:.1f}mm of vertical travel".format(shortened, removed)
+
+    # Return which part of a retract a move can be, if any
+    def part(self, move):
+        start, end = move.start, move.end
+        if move.code not in (GCODES.RAPID, GCODES.LINEAR) or not move.params.keys() <= self.PARAMS:
+            return None
+        if None in (start[k] for k in self.AXES) or None in (end[k] for k in self.AXES):
+            return None
+
+        dz = end[ARGS.Z] - start[ARGS.Z]
+        if (start[ARGS.X], start[ARGS.Y]) != (end[ARGS.X], end[ARGS.Y]):
+            if move.code == GCODES.RAPID and abs(dz) < self.EPSILON:
+                return self.TRAVEL
+            return None
+        if move.code == GCODES.RAPID:
+            if dz > self.EPSILON:
+                return self.RETRACT
+            if dz < -self.EPSILON:
+                return self.APPROACH
+        elif dz < -self.EPSILON and end[ARGS.FEED] is not None:
+            return self.PLUNGE
+        return None
+
+    # Check if a part can follow the buffered moves. Retracts
+    # must travel in XY before descending again.
+    def extends(self, part):
+        if not self.moves:
+            return part == self.RETRACT
+        last = self.part(self.moves[-1])
+        return part >= last and not (last == self.RETRACT and part > self.TRAVEL)
+
+    # Replace a buffered retract with a shorter one if the
+    # travel is clear, or output it unchanged.
+    def shorten(self):
+        moves = self.moves
+        self.moves = []
+
+        first, plunge = moves[0], moves[-1]
+        path = [(first.start[ARGS.X], first.start[ARGS.Y])]
+        path.extend((m.end[ARGS.X], m.end[ARGS.Y]) for m in moves if self.part(m) == self.TRAVEL)
+        depth = max(first.start[ARGS.Z], plunge.end[ARGS.Z])
+        top = max(m.end[ARGS.Z] for m in moves)
+
+        shorter = None
+        if self.feed and self.cleared(path, depth):
+            shorter = self.across(moves, path, depth)
+            if self.duration(shorter) >= self.duration(moves):
+                shorter = None
+        if shorter is None:
+            safe = self.safe()
+            if safe is not None and depth <= safe < top - self.EPSILON and self.cleared(path, safe):
+                shorter = self.lowered(moves, path, safe)
+
+        if shorter is None:
+            for m in moves:
+                self.emit(m)
+            return
+
+        self.shortened += 1
+        self.removed += self.vertical(moves) - self.vertical(shorter)
+        for m in shorter:
+            self.emit(m)
+        self.restore = True
+
+    # Feed across at depth, rising first if the next pass is
+    # shallower.
+    def across(self, moves, path, depth):
+        first, plunge = moves[0], moves[-1]
+        feed = first.start[ARGS.FEED] or plunge.end[ARGS.FEED]
+        out = []
+        pos = first.start
+        if pos[ARGS.Z] < depth - self.EPSILON:
+            pos = self.to(out, pos, GCODES.LINEAR, {ARGS.Z: depth, ARGS.FEED: feed})
+        for x, y in path[1:]:
+            pos = self.to(out, pos, GCODES.LINEAR, {ARGS.X: x, ARGS.Y: y, ARGS.FEED: feed})
+        if plunge.end[ARGS.Z] < depth - self.EPSILON:
+            self.to(out, pos, GCODES.LINEAR, {ARGS.Z: plunge.end[ARGS.Z], ARGS.FEED: plunge.end[ARGS.FEED]})
+        return out
+
+    # Travel at the safe height instead
+    def lowered(self, moves, path, safe):
+        first, plunge = moves[0], moves[-1]
+        out = []
+        pos = first.start
+        if pos[ARGS.Z] < safe - self.EPSILON:
+            pos = self.to(out, pos, GCODES.RAPID, {ARGS.Z: safe})
+        for x, y in path[1:]:
+            pos = self.to(out, pos, GCODES.RAPID, {ARGS.X: x, ARGS.Y: y})
+        if plunge.start[ARGS.Z] < safe - self.EPSILON:
+            pos = self.to(out, pos, GCODES.RAPID, {ARGS.Z: plunge.start[ARGS.Z]})
+        self.to(out, pos, GCODES.LINEAR, dict(plunge.params))
+        return out
+
+    # Append a move from a position to the given axes, and
+    # return the position it ends at.
+    def to(self, out, start, code, params):
+        end = dict(start)
+        end.update(params)
+        out.append(Move(code, params, start, end))
+        return end
+
+    def vertical(self, moves):
+        return sum(abs(m.end[ARGS.Z] - m.start[ARGS.Z]) for m in moves)
+
+    # Time taken by straight moves, ignoring acceleration
+    def duration(self, moves):
+        total = 0.0
+        for m in moves:
+            delta = [m.end[k] - m.start[k] for k in self.AXES]
+            length = math.hypot(*delta)
+            if length < self.EPSILON:
+                continue
+            if m.code == GCODES.RAPID:
+                total += length / self.machine.rapidrate([d / length for d in delta])
+            else:
+                total += length / self.machine.feedrate(m.end[ARGS.FEED])
+        return total
+
+    # Output a move, recording the area it cuts
+    def emit(self, move):
+        if move.code in self.FEEDS and move.end[ARGS.FEED] is not None:
+            if self.restore and ARGS.FEED not in move.params:
+                move = Move(move.code, dict(move.params, F=move.end[ARGS.FEED]), move.start, move.end)
+            self.restore = False
+            self.record(move)
+        self.out(move)
+
+    # Record the path of a cut as segments, each with the
+    # distance around it that is cleared, and the depth it is
+    # cleared to.
+    def record(self, move):
+        start, end = move.start, move.end
+        if None in (start[k] for k in self.AXES) or None in (end[k] for k in self.AXES):
+            return
+        radius = self.radius()
+        depth = max(start[ARGS.Z], end[ARGS.Z])
+        if move.code == GCODES.LINEAR:
+            self.cuts.append(((start[ARGS.X], start[ARGS.Y], end[ARGS.X], end[ARGS.Y], radius), depth))
+            return
+
+        if ARGS.ARC_X not in move.params and ARGS.ARC_Y not in move.params:
+            return
+        cx = start[ARGS.X] + move.params.get(ARGS.ARC_X, 0)
+        cy = start[ARGS.Y] + move.params.get(ARGS.ARC_Y, 0)
+        r = math.hypot(start[ARGS.X] - cx, start[ARGS.Y] - cy)
+        a0, sweep = arc_sweep(move.code, (start[ARGS.X], start[ARGS.Y]), (end[ARGS.X], end[ARGS.Y]), cx, cy)
+
+        # Chords stay within the error of the arc
+        error = self.CHORD * radius
+        n = 1
+        if r > error:
+            n = max(1, math.ceil(abs(sweep) / (2 * math.acos(1 - error / r))))
+        else:
+            error = 2 * r
+        points = [(cx + r * math.cos(a0 + sweep * i / n), cy + r * math.sin(a0 + sweep * i / n)) for i in range(n + 1)]
+        for (ax, ay), (bx, by) in zip(points, points[1:]):
+            self.cuts.append(((ax, ay, bx, by, radius - error), depth))
+
+    # Add cuts recorded since the last check to a grid of
+    # cells of twice the tool radius, in every cell they
+    # clear any part of. Passes repeated at several depths
+    # are only added once, at the deepest.
+    def index(self, radius):
+        if self.size is None:
+            self.size = 2 * radius
+        size = self.size
+        cells, depths = self.cells, self.depths
+        for cut, depth in self.cuts[self.indexed:]:
+            known = depths.get(cut)
+            if known is not None:
+                depths[cut] = min(known, depth)
+                continue
+            depths[cut] = depth
+            ax, ay, bx, by, r = cut
+            if r <= 0:
+                continue
+            for i in range(math.floor((min(ax, bx) - r) / size), math.floor((max(ax, bx) + r) / size) + 1):
+                for j in range(math.floor((min(ay, by) - r) / size), math.floor((max(ay, by) + r) / size) + 1):
+                    cells.setdefault((i, j), []).append(cut)
+        self.indexed = len(self.cuts)
+
+    # Return the interval of a line, in distances from a point
+    # along it, that a cut clears, or None if it misses.
+    def span(self, cut, x, y, dx, dy):
+        ax, ay, bx, by, r = cut
+        lo, hi = math.inf, -math.inf
+
+        # Discs around the ends
+        for px, py in ((ax, ay), (bx, by)):
+            ox, oy = x - px, y - py
+            b = ox * dx + oy * dy
+            c = ox * ox + oy * oy - r * r
+            if b * b >= c:
+                root = math.sqrt(b * b - c)
+                lo, hi = min(lo, -b - root), max(hi, -b + root)
+
+        # Band along the cut between them
+        ex, ey = bx - ax, by - ay
+        length = math.hypot(ex, ey)
+        if length > self.EPSILON:
+            ex, ey = ex / length, ey / length
+            ox, oy = x - ax, y - ay
+            t0, t1 = -math.inf, math.inf
+            for offset, rate, low, high in ((ox * ex + oy * ey, dx * ex + dy * ey, 0, length),
+                    (ox * ey - oy * ex, dx * ey - dy * ex, -r, r)):
+                if abs(rate) < self.EPSILON:
+                    if not low <= offset <= high:
+                        t0, t1 = math.inf, -math.inf
+                    continue
+                a, b = (low - offset) / rate, (high - offset) / rate
+                t0, t1 = max(t0, min(a, b)), min(t1, max(a, b))
+            if t0 <= t1:
+                lo, hi = min(lo, t0), max(hi, t1)
+
+        return (lo, hi) if lo <= hi else None
+
+    # Check if the tool can follow a path in the XY plane at
+    # the given height without leaving the cleared area. Lines
+    # across the path are checked at intervals along it, each
+    # covered by the cuts it crosses.
+    def cleared(self, path, height):
+        radius = self.radius()
+        if radius <= self.EPSILON:
+            return False
+
+        step = self.STEP * radius
+        if sum(math.dist(a, b) + 2 * radius for a, b in zip(path, path[1:])) / step > self.MAX_CHECKS:
+            return False
+
+        self.index(radius)
+        size, depths = self.size, self.depths
+        height += self.EPSILON
+        hit = None
+        for (ax, ay), (bx, by) in zip(path, path[1:]):
+            length = math.hypot(bx - ax, by - ay)
+            if length < self.EPSILON:
+                continue
+            dx, dy = (bx - ax) / length, (by - ay) / length
+
+            n = math.ceil((length + 2 * radius) / step)
+            for i in range(n + 1):
+                u = -radius + (length + 2 * radius) * i / n
+                ox, oy = ax + u * dx, ay + u * dy
+                w = radius * radius - (u - max(0, min(length, u))) ** 2
+                w = math.sqrt(w) if w > 0 else 0
+
+                # Cover the line across the tool from one side
+                v = -w
+                while v < w - self.EPSILON:
+                    x, y = ox - v * dy, oy + v * dx
+                    cell = self.cells.get((math.floor(x / size), math.floor(y / size)), ())
+                    reach = None
+                    for cut in itertools.chain((hit,) if hit else (), reversed(cell)):
+                        if depths[cut] > height:
+                            continue
+                        interval = self.span(cut, ox, oy, -dy, dx)
+                        if interval is not None and interval[0] <= v + self.EPSILON and interval[1] > v + self.EPSILON:
+                            reach, hit = interval[1], cut
+                            break
+                    if reach is None:
+                        return False
+                    v = reach
+        return True
+
+# Estimates the run time of the output gcode by simulating moves
+# as they are output. Each move is a segment with a trapezoidal
+# speed profile limited by the machine acceleration. The speed at
+# the junction between segments is limited by the machine jerk,
+# and is planned over a window of segments like the firmware
+# motion planner. Times are in seconds and collected for each
+# operation.
+class CycleTimer:
+    LOOKAHEAD = 16
+    EPSILON   = 1e-9
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.accel = machine.acceleration
+        self.jerk = machine.jerk / 60
+        self.position = [None, None, None]
+        self.feed = None
+        self.queue = []
+        self.direction = None
+        self.speed = 0.0
+        self.entry = 0.0
+        self.operations = []
+        self.toolchanges = 0
+
+    # Start timing a new operation
+    def begin(self, label):
+        self.flush()
+        self.operations.append([label, 0.0])
+
+    def add(self, seconds):
+        if not self.operations:
+            self.operations.append(['Setup', 0.0])
+        self.operations[-1][1] += seconds
+
+    # The machine position is unknown after parking,
+    # probing or switching WCS.
+    def reset(self):
+        self.flush()
+        self.position = [None, None, None]
+
+    def toolchange(self):
+        self.toolchanges += 1
+
+    # RRF dwell times are in milliseconds (P) or seconds (S)
+    def dwell(self, params):
+        self.flush()
+        self.add(params.get('P', 0) / 1000 + params.get('S', 0))
+
+    def move(self, code, params):
+        if ARGS.FEED in params and code != GCODES.RAPID:
+            self.feed = params[ARGS.FEED]
+
+        start = self.position
+        end = [params.get(axis, p) for axis, p in zip(Machine.AXES, start)]
+        self.position = end
+
+        if None in start or None in end:
+            return
+
+        if code in (GCODES.ARC_CW, GCODES.ARC_CCW) and (ARGS.ARC_X in params or ARGS.ARC_Y in params):
+            self.arc(code, start, end, params)
+        elif code in (GCODES.RAPID, GCODES.LINEAR, GCODES.ARC_CW, GCODES.ARC_CCW):
+            self.linear(start, end, code == GCODES.RAPID)
+        else:
+            self.cycle(code, start, end, params)
+
+    def feedrate(self):
+        if self.feed is None:
+            return self.machine.rapidrate()
+        return max(self.machine.feedrate(self.feed), 1)
+
+    def linear(self, start, end, rapid):
+        dx, dy, dz = end[0] - start[0], end[1] - start[1], end[2] - start[2]
+        length = math.sqrt(dx * dx + dy * dy + dz * dz)
+        if length < self.EPSILON:
+            return
+        direction = (dx / length, dy / length, dz / length)
+        rate = self.machine.rapidrate(direction) if rapid else self.feedrate()
+        self.segment(length, rate / 60, direction, direction)
+
+    # Time a move between two points that starts and ends
+    # at rest, without planning.
+    def stroke(self, start, end, rapid):
+        dx, dy, dz = end[0] - start[0], end[1] - start[1], end[2] - start[2]
+        length = math.sqrt(dx * dx + dy * dy + dz * dz)
+        if length < self.EPSILON:
+            return 0.0
+        rate = self.machine.rapidrate((dx / length, dy / length, dz / length)) if rapid else self.feedrate()
+        return self.trapezoid(length, 0.0, 0.0, rate / 60)
+
+    # Arcs are limited by centripetal acceleration as well
+    # as the feed rate. Arcs that end where they start are
+    # full circles.
+    def arc(self, code, start, end, params):
+        cx = start[0] + params.get(ARGS.ARC_X, 0)
+        cy = start[1] + params.get(ARGS.ARC_Y, 0)
+        radius = math.hypot(start[0] - cx, start[1] - cy)
+        a0 = math.atan2(start[1] - cy, start[0] - cx)
+        a1 = math.atan2(end[1] - cy, end[0] - cx)
+
+        sweep = a1 - a0
+        if code == GCODES.ARC_CW and sweep >= -self.EPSILON:
+            sweep -= 2 * math.pi
+        elif code == GCODES.ARC_CCW and sweep <= self.EPSILON:
+            sweep += 2 * math.pi
+
+        dz = end[2] - start[2]
+        planar = abs(sweep) * radius
+        length = math.hypot(planar, dz)
+        if length < self.EPSILON:
+            return
+
+        sign = 1 if code == GCODES.ARC_CCW else -1
+        xy, z = planar / length, dz / length
+        tangent = lambda a: [-sign * math.sin(a) * xy, sign * math.cos(a) * xy, z]
+
+        rate = min(self.feedrate() / 60, math.sqrt(self.accel * radius))
+        self.segment(length, rate, tangent(a0), tangent(a0 + sweep))
+
+    # Canned drilling cycles move to the hole above the current
+    # height, rapid to the retract plane and feed to depth,
+    # retracting to the retract plane between pecks on G83.
+    # Every move in a cycle starts and ends at rest.
+    def cycle(self, code, start, end, params):
+        self.flush()
+
+        retract = params.get(ARGS.ARC_R, start[2])
+        above = (end[0], end[1], start[2])
+        top = (end[0], end[1], retract)
+        bottom = (end[0], end[1], end[2])
+
+        seconds = self.stroke(start, above, True) + self.stroke(above, top, True)
+
+        depth = retract - end[2]
+        peck = params.get(ARGS.PECK, 0)
+        if code == GCODES.DRILL_PECK and 0 < peck < depth:
+            # Each peck but the last retracts to the retract plane
+            # and rapids back down to the depth already drilled.
+            reached = top
+            for n in range(1, math.ceil(depth / peck)):
+                hole = (end[0], end[1], retract - n * peck)
+                seconds += self.stroke(reached, hole, False) + 2 * self.stroke(hole, top, True)
+                reached = hole
+            seconds += self.stroke(reached, bottom, False)
+        else:
+            seconds += self.stroke(top, bottom, False)
+        seconds += self.stroke(bottom, top, True)
+
+        self.add(seconds)
+        self.position = list(top)
+
+    # Add a segment of the given length in mm, with a maximum
+    # speed in mm/s, starting and ending in the given directions.
+    def segment(self, length, speed, start, end):
+        junction = 0.0
+        if self.direction is not None:
+            # The speed change at a junction of angle theta
+            # between two segments at speed v is 2v.sin(theta/2)
+            d = self.direction
+            cos = d[0] * start[0] + d[1] * start[1] + d[2] * start[2]
+            sin = math.sqrt(max(0.0, (1 - cos) / 2))
+            junction = min(speed, self.speed)
+            if sin > self.EPSILON:
+                junction = min(junction, self.jerk / (2 * sin))
+
+        self.queue.append((length, speed, junction))
+        self.direction = end
+        self.speed = speed
+
+        if len(self.queue) >= 2 * self.LOOKAHEAD:
+            self.plan(len(self.queue) - self.LOOKAHEAD)
+
+    # Plan the queued segments assuming the machine stops after
+    # the last one, and commit the given number of them.
+    def plan(self, count):
+        queue = self.queue
+        a2 = 2 * self.accel
+
+        # Backward pass: the highest exit speed of each segment
+        # that still allows the machine to stop in time.
+        exits = [0.0] * len(queue)
+        v = 0.0
+        for i in range(len(queue) - 1, -1, -1):
+            exits[i] = v
+            length, _, junction = queue[i]
+            v = min(junction, math.sqrt(v * v + a2 * length))
+
+        # Forward pass: the exit speed of each segment reachable
+        # from its entry speed.
+        entry = self.entry
+        for i in range(count):
+            length, speed, _ = queue[i]
+            exit = min(exits[i], math.sqrt(entry * entry + a2 * length))
+            self.add(self.trapezoid(length, entry, exit, speed))
+            entry = exit
+
+        self.entry = entry
+        del queue[:count]
+
+    # Time to travel a segment accelerating from the entry speed
+    # towards the maximum speed and decelerating to the exit speed.
+    def trapezoid(self, length, entry, exit, speed):
+        a = self.accel
+        accel = (speed * speed - entry * entry) / (2 * a)
+        decel = (speed * speed - exit * exit) / (2 * a)
+        if accel + decel <= length:
+            return (2 * speed - entry - exit) / a + (length - accel - decel) / speed
+
+        # Maximum speed is not reached
+        peak = math.sqrt((a * 2 * length + entry * entry + exit * exit) / 2)
+        if peak <= max(entry, exit):
+            return length / max(entry, exit)
+        return (2 * peak - entry - exit) / a
+
+    # Plan and commit all queued segments. The machine stops
+    # after the last one.
+    def flush(self):
+        if self.queue:
+            self.plan(len(self.queue))
+        self.entry = 0.0
+        self.direction = None
+        self.speed = 0.0
+
+    # Return the estimate as (label, seconds) rows
+    def report(self):
+        self.flush()
+        rows = [(label, seconds) for label, seconds in self.operations]
+        if self.toolchanges and self.machine.tool_change_time:
+            rows.append(("{} tool changes".format(self.toolchanges), self.toolchanges * self.machine.tool_change_time))
+        rows.append(("Total", sum(seconds for _, seconds in rows)))
+        return rows
+
+# Tracks the extents of the output moves in each operation, in
+# work coordinates. Arc extents include any axis extremes the arc
+# passes through, not just its end points. Extents are merged per
+# WCS when reported, so moves are only measured once.
+class MoveBounds:
+    # Angles at which an arc reaches an X or Y extreme
+    EXTREMES = ((0.0, 0, 1), (math.pi / 2, 1, 1), (math.pi, 0, -1), (3 * math.pi / 2, 1, -1))
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.position = [None, None, None]
+        self.wcs = None
+        self.operations = []
+        self.begin('Setup')
+
+    # Start measuring a new operation
+    def begin(self, label):
+        self.lo = [math.inf] * 3
+        self.hi = [-math.inf] * 3
+        self.operations.append([label, self.wcs, self.lo, self.hi])
+
+    # Moves after a WCS change are measured separately, and
+    # the machine position is unknown until the next move.
+    def switch(self, wcs):
+        self.wcs = wcs
+        self.position = [None, None, None]
+        label, _, lo, _ = self.operations[-1]
+        if lo == [math.inf] * 3:
+            self.operations[-1][1] = wcs
+        else:
+            self.begin(label)
+
+    # The machine position is unknown after parking or probing
+    def reset(self):
+        self.position = [None, None, None]
+
+    def point(self, point):
+        lo, hi = self.lo, self.hi
+        for i, v in enumerate(point):
+            if v is None:
+                continue
+            if v < lo[i]:
+                lo[i] = v
+            if v > hi[i]:
+                hi[i] = v
+
+    def move(self, code, params):
+        start = self.position
+        end = [params.get(axis, p) for axis, p in zip(Machine.AXES, start)]
+        self.position = end
+        self.point(end)
+
+        if code in (GCODES.ARC_CW, GCODES.ARC_CCW):
+            if None not in start[:2] and (ARGS.ARC_X in params or ARGS.ARC_Y in params):
+                self.arc(code, start, end, params)
+        elif code not in (GCODES.RAPID, GCODES.LINEAR) and ARGS.ARC_R in params:
+            # Canned cycles also reach the retract plane
+            self.point((None, None, params[ARGS.ARC_R]))
+            self.position = [end[0], end[1], params[ARGS.ARC_R]]
+
+    # Add the X and Y extremes that an arc sweeps through
+    def arc(self, code, start, end, params):
+        cx = start[0] + params.get(ARGS.ARC_X, 0)
+        cy = start[1] + params.get(ARGS.ARC_Y, 0)
+        radius = math.hypot(start[0] - cx, start[1] - cy)
+        a0 = math.atan2(start[1] - cy, start[0] - cx)
+        a1 = math.atan2(end[1] - cy, end[0] - cx)
+
+        # Sweep counter-clockwise from the lower angle
+        if code == GCODES.ARC_CW:
+            a0, a1 = a1, a0
+        sweep = (a1 - a0) % (2 * math.pi)
+        if sweep <= CycleTimer.EPSILON:
+            sweep = 2 * math.pi
+
+        centre = (cx, cy)
+        for angle, axis, sign in self.EXTREMES:
+            if (angle - a0) % (2 * math.pi) <= sweep:
+                point = [None, None, None]
+                point[axis] = centre[axis] + sign * radius
+                self.point(point)
+
+    # Return the extents of each WCS and of the operations in
+    # it, as (wcs, lo, hi, [(label, lo, hi), ...]) rows, in
+    # the order each WCS is first used.
+    def extents(self):
+        rows = {}
+        for label, wcs, lo, hi in self.operations:
+            if lo == [math.inf] * 3:
+                continue
+            row = rows.setdefault(wcs, [wcs, [math.inf] * 3, [-math.inf] * 3, []])
+            row[1] = [min(a, b) for a, b in zip(row[1], lo)]
+            row[2] = [max(a, b) for a, b in zip(row[2], hi)]
+            row[3].append((label, lo, hi))
+        return list(rows.values())
+
+    # Return a message for each axis where the moves in a WCS
+    # cover more than the machine travel, or an operation
+    # leaves the soft limits.
+    def violations(self):
+        errors = []
+        for wcs, lo, hi, operations in self.extents():
+            name = 'WCS {}'.format(wcs) if wcs is not None else 'the current WCS'
+            for i, axis in enumerate(Machine.AXES):
+                if axis in self.machine.limits and lo[i] <= hi[i]:
+                    travel = self.machine.limits[axis][1] - self.machine.limits[axis][0]
+                    if hi[i] - lo[i] > travel:
+                        errors.append("{} moves in {} cover {:.3f}mm, more than the machine travel of {:.3f}mm".format(
+                            axis, name, hi[i] - lo[i], travel))
+
+                if axis in self.machine.soft_limits:
+                    low, high = self.machine.soft_limits[axis]
+                    for label, olo, ohi in operations:
+                        if olo[i] < low or ohi[i] > high:
+                            errors.append("{} moves in {} of operation {} ({:.3f} to {:.3f}) exceed the soft limits of {:.3f} to {:.3f}".format(
+                                axis, name, label, olo[i], ohi[i], low, high))
+        return errors
+
+# An operation to be scheduled, with the objects output before
+# it other than tool controllers, and the tool controller, tool
+# number, WCS and object selecting that WCS it was posted with
+# in document order.
+ScheduledOp = collections.namedtuple('ScheduledOp', ['op', 'lead', 'tc', 'tool', 'wcs', 'fixture'])
+
+# Reorders operations to reduce the number of tool changes.
+# Operations in the same WCS are kept in order, and operations
+# with must follow hints are kept after the operations they
+# name. Otherwise ready operations using the active tool are
+# run first, preferring the active WCS, and when the tool has
+# to change, the tool that can run the most operations in a
+# row is chosen. Ties are broken by document order.
+class ToolScheduler:
+    TAG = re.compile(r'\[follows\s*[=:]\s*([^\]]+)\]', re.IGNORECASE)
+
+    def __init__(self, wcs_codes):
+        self.wcs_codes = set(wcs_codes)
+        self.before = 0
+        self.after = 0
+
+    # Labels of the operations an operation must follow, from
+    # its PostFollows property or a [follows=...] label tag.
+    def follows(self, op):
+        value = getattr(op, 'PostFollows', None)
+        if not value:
+            m = self.TAG.search(getattr(op, 'Label', ''))
+            value = m.group(1) if m else None
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = value.split(',')
+        return [label.strip() for label in value if label.strip()]
+
+    # Return the WCS code selected by an object, if any
+    def selects(self, obj):
+        wcs = None
+        for c in obj.Path.Commands:
+            name = c.Name
+            if name[:1].upper() == 'G' and name[1:].replace('.', '', 1).isdigit() and float(name[1:]) in self.wcs_codes:
+                wcs = float(name[1:])
+        return wcs
+
+    # Split objects into operations and the objects after the
+    # last operation.
+    def split(self, objects):
+        ops = []
+        lead = []
+        tc, wcs, fixture = None, None, None
+        for o in objects:
+            proxy = type(o.Proxy).__name__ if hasattr(o, 'Proxy') else None
+            if proxy == 'ToolController':
+                tc = o
+            elif proxy in (None, 'Comment', 'Fixture'):
+                if self.selects(o) is not None:
+                    wcs, fixture = self.selects(o), o
+                lead.append(o)
+            else:
+                ops.append(ScheduledOp(o, lead, tc, tc.ToolNumber if tc is not None else None, wcs, fixture))
+                lead = []
+        return ops, lead
+
+    # Count the tool changes needed to run operations in order
+    @staticmethod
+    def changes(ops):
+        count, tool = 0, None
+        for op in ops:
+            if op.tool is not None and op.tool != tool:
+                count += 1
+                tool = op.tool
+        return count
+
+    # Number of operations that could be run in a row with a
+    # tool, starting from the ready operations.
+    def run(self, tool, ops, ready, waiting, after):
+        waiting = waiting.copy()
+        stack = [i for i in ready if ops[i].tool == tool]
+        count = 0
+        while stack:
+            i = stack.pop()
+            count += 1
+            for j in after[i]:
+                waiting[j] -= 1
+                if not waiting[j] and ops[j].tool == tool:
+                    stack.append(j)
+        return count
+
+    # Return the operations in the order to run them
+    def order(self, ops):
+        labels = {op.op.Label: i for i, op in enumerate(ops)}
+        after = [set() for _ in ops]
+        last = {}
+        for i, op in enumerate(ops):
+            if op.wcs in last:
+                after[last[op.wcs]].add(i)
+            last[op.wcs] = i
+            for label in self.follows(op.op):
+                if label not in labels:
+                    raise ValueError("Operation {} must follow unknown operation {}".format(op.op.Label, label))
+                after[labels[label]].add(i)
+
+        waiting = [0] * len(ops)
+        for successors in after:
+            for j in successors:
+                waiting[j] += 1
+        ready = {i for i, count in enumerate(waiting) if not count}
+
+        order = []
+        tool, wcs = None, None
+        while ready:
+            same = [i for i in ready if ops[i].tool == tool]
+            if not same:
+                tools = {ops[i].tool for i in ready}
+                tool = max(tools, key=lambda t: (self.run(t, ops, ready, waiting, after),
+                    -min(i for i in ready if ops[i].tool == t)))
+                same = [i for i in ready if ops[i].tool == tool]
+
+            i = min(same, key=lambda i: (ops[i].wcs != wcs, i))
+            ready.remove(i)
+            order.append(i)
+            wcs = ops[i].wcs
+            for j in after[i]:
+                waiting[j] -= 1
+                if not waiting[j]:
+                    ready.add(j)
+
+        if len(order) < len(ops):
+            stuck = [ops[i].op.Label for i, count in enumerate(waiting) if count]
+            raise ValueError("Unable to order operations with circular must follow hints: {}".format(', '.join(stuck)))
+
+        return [ops[i] for i in order]
+
+    # Return the objects reordered to reduce tool changes. Tool
+    # controllers are output before operations whenever the tool
+    # changes, and after their fixtures, as fixtures stop the
+    # spindle.
+    def schedule(self, objects):
+        ops, trailing = self.split(objects)
+        ordered = self.order(ops)
+        self.before = self.changes(ops)
+        self.after = self.changes(ordered)
+        if self.after > self.before:
+            ordered = ops
+            self.after = self.before
+
+        out = []
+        tool, wcs = None, None
+        for op in ordered:
+            switches = any(self.selects(o) is not None for o in op.lead)
+            lead = op.lead
+            if op.wcs != wcs and not switches and op.fixture is not None:
+                lead = [op.fixture] + lead
+                switches = True
+            out.extend(lead)
+            if op.tc is not None and (op.tool != tool or switches):
+                out.append(op.tc)
+                tool = op.tool
+            out.append(op.op)
+            wcs = op.wcs
+        out.extend(trailing)
+        return out
+
+# On-disk cache of the formatted output of operations, keyed by
+# a hash of everything the output depends on. Each entry is a
+# JSON file, and the least recently used entries are removed
+# once the cache is larger than its size limit. Entries written
+# by a different post-processor version are removed when the
+# cache is opened.
+class BodyCache:
+    SUFFIX       = '.json'
+    VERSION_FILE = 'VERSION'
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+        try:
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, self.VERSION_FILE), encoding='utf-8') as fh:
+                version = fh.read()
+        except OSError:
+            version = None
+
+        if version != RELEASE.VERSION:
+            self.clear()
+            with open(os.path.join(path, self.VERSION_FILE), 'w', encoding='utf-8') as fh:
+                fh.write(RELEASE.VERSION)
+
+    # Return the path of each cache entry
+    def entries(self):
+        return [e.path for e in os.scandir(self.path) if e.name.endswith(self.SUFFIX)]
+
+    def clear(self):
+        for path in self.entries():
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    # Marshal keeps the order of parameter dicts, which affects
+    # the output, and stores floats exactly. Version 2 does not
+    # share references, so equal values always serialise the same.
+    def key(self, *parts):
+        import hashlib
+        return hashlib.sha256(marshal.dumps(parts, 2)).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.path, key + self.SUFFIX)
+        try:
+            with open(path, encoding='utf-8') as fh:
+                entry = json.load(fh)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, value):
+        path = os.path.join(self.path, key + self.SUFFIX)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w', encoding='utf-8') as fh:
+                json.dump(value, fh, separators=(',', ':'))
+            os.replace(tmp, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+    # Remove least recently used entries until the cache
+    # is within its size limit.
+    def evict(self):
+        entries = []
+        for path in self.entries():
+            with contextlib.suppress(OSError):
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.size:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
+
+# Measures wall time and call counts of the post-processor hot
+# paths, per operation and per command type, by wrapping them
+# for the duration of a post. Times are inclusive of nested
+# calls. Nothing is wrapped unless profiling is enabled.
+class Profiler:
+    OTHER = 'Other'
+
+    def __init__(self):
+        self.operation = self.OTHER
+        self.command = self.OTHER
+        self.functions = {}
+        self.operations = {}
+        self.commands = {}
+        # Operation labels and command names are counted
+        # separately, as an operation may be named like a command.
+        self.suppressed_by_operation = {}
+        self.suppressed_by_command = {}
+        self.lines = {}
+        self.wrapped = []
+
+    # Wrap hot paths while in this context
+    @contextmanager
+    def enabled(self):
+        self.wrap(MillenniumOSPostProcessor, 'output', self.timed)
+        self.wrap(MillenniumOSPostProcessor, 'write', self.timed)
+        self.wrap(MillenniumOSPostProcessor, '_parseobj', self.timedobj)
+        self.wrap(MillenniumOSPostProcessor, '_parsecmd', self.timedcmd)
+        self.wrap(MillenniumOSPostProcessor, '_parsebatch', self.timed)
+        self.wrap(MillenniumOSPostProcessor, '_parseparam', self.timed)
+        self.wrap(MillenniumOSPostProcessor, 'onmove', self.timed)
+        self.wrap(Output, 'format', self.timed)
+        self.wrap(Output, '__call__', self.timedoutput)
+        try:
+            yield self
+        finally:
+            for owner, name, original in reversed(self.wrapped):
+                setattr(owner, name, original)
+            self.wrapped = []
+
+    # Wrap a method on the class that defines it
+    def wrap(self, cls, name, wrapper):
+        owner = next(c for c in cls.__mro__ if name in c.__dict__)
+        original = owner.__dict__[name]
+        self.wrapped.append((owner, name, original))
+        setattr(owner, name, wrapper(name, original))
+
+    def record(self, name, elapsed):
+        for scope, key in ((self.functions, None), (self.operations, self.operation), (self.commands, self.command)):
+            stats = scope if key is None else scope.setdefault(key, {})
+            entry = stats.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def timed(self, name, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return wrapper
+
+    # Attribute calls to the object being parsed, and count
+    # the lines it outputs.
+    def timedobj(self, name, fn):
+        timed = self.timed(name, fn)
+        def wrapper(pp, obj):
+            previous = self.operation
+            self.operation = obj.Label
+            before = len(getattr(pp, Section.RUN))
+            try:
+                return timed(pp, obj)
+            finally:
+                self.lines[obj.Label] = self.lines.get(obj.Label, 0) + len(getattr(pp, Section.RUN)) - before
+                self.operation = previous
+        return wrapper
+
+    # Attribute calls to the command being parsed
+    def timedcmd(self, name, fn):
+        timed = self.timed(name, fn)
+        def wrapper(pp, cmd):
+            previous = self.command
+            self.command = cmd.Name
+            try:
+                return timed(pp, cmd)
+            finally:
+                self.command = previous
+        return wrapper
+
+    # Count commands suppressed by modal deduplication
+    def timedoutput(self, name, fn):
+        timed = self.timed(name, fn)
+        def wrapper(*args, **kwargs):
+            out = timed(*args, **kwargs)
+            if out[0] is None:
+                self.suppressed_by_operation[self.operation] = self.suppressed_by_operation.get(self.operation, 0) + 1
+                self.suppressed_by_command[self.command] = self.suppressed_by_command.get(self.command, 0) + 1
+            return out
+        return wrapper
+
+    def results(self):
+        def entries(stats):
+            return {name: {'calls': calls, 'time': elapsed} for name, (calls, elapsed) in stats.items()}
+
+        return {
+            'functions': entries(self.functions),
+            'operations': {op: {
+                'lines': self.lines.get(op, 0),
+                'suppressed': self.suppressed_by_operation.get(op, 0),
+                'functions': entries(stats),
+            } for op, stats in self.operations.items()},
+            'commands': {cmd: {
+                'suppressed': self.suppressed_by_command.get(cmd, 0),
+                'functions': entries(stats),
+            } for cmd, stats in self.commands.items()},
+        }
+
+    # Return summary lines of the time spent in each function,
+    # and parsing each operation and command type.
+    def summary(self):
+        lines = []
+
+        def table(title, rows):
+            if not rows:
+                return
+            width = max(len(r[0]) for r in rows)
+            lines.append(title)
+            for label, *counts, elapsed in sorted(rows, key=lambda r: -r[-1]):
+                lines.append("  {} {} {:>9.3f}s".format(label.ljust(width), ' '.join('{:>9}'.format(c) for c in counts), elapsed))
+
+        table("Profile: function, calls, time",
+            [(name, calls, elapsed) for name, (calls, elapsed) in self.functions.items()])
+
+        table("Profile: object, lines, suppressed, time",
+            [(op, self.lines.get(op, 0), self.suppressed_by_operation.get(op, 0), stats['_parseobj'][1])
+                for op, stats in self.operations.items() if '_parseobj' in stats])
+
+        # FreeCAD comments are not output
+        table("Profile: command, calls, suppressed, time",
+            [(cmd, stats['_parsecmd'][0], self.suppressed_by_command.get(cmd, 0), stats['_parsecmd'][1])
+                for cmd, stats in self.commands.items() if '_parsecmd' in stats and not cmd.startswith('(')])
+
+        return lines
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump(self.results(), fh, indent=2)
+
 # Define post-processor sections
 class Section(StrEnum):
     PRE  = auto()
     RUN  = auto()
     POST = auto()
 
+# Section line stores. Every emitted line is appended to
+# the store of the active section. The default store packs
+# the encoded lines into a single growable buffer with an
+# index of line end offsets, which takes a fraction of the
+# memory of a list of strings. Prepended lines are appended
+# to the buffer too, and only the order of line ranges is
+# changed, so the buffer is never spliced.
+class LineStore:
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('Q')
+        # Line ranges in output order, followed by the
+        # lines from tail onwards.
+        self.order = []
+        self.tail = 0
+
+    def append(self, line):
+        self.data += line.encode('utf-8')
+        self.data += b'\n'
+        self.ends.append(len(self.data))
+
+    def extend(self, lines):
+        encoded = [line.encode('utf-8') for line in lines]
+        if not encoded:
+            return
+        ends = itertools.accumulate((len(b) + 1 for b in encoded), initial=len(self.data))
+        self.ends.extend(itertools.islice(ends, 1, None))
+        self.data += b'\n'.join(encoded)
+        self.data += b'\n'
+
+    # Insert lines before all existing lines
+    def prepend(self, lines):
+        count = len(self.ends)
+        if self.tail < count:
+            self.order.append((self.tail, count))
+        self.extend(lines)
+        self.tail = len(self.ends)
+        self.order.insert(0, (count, self.tail))
+
+    # Line ranges in output order
+    def ranges(self):
+        yield from self.order
+        if self.tail < len(self.ends):
+            yield (self.tail, len(self.ends))
+
+    # Byte offset of the start of the given line
+    def start(self, index):
+        return self.ends[index - 1] if index else 0
+
+    # Yield views of the encoded lines in output order,
+    # optionally limited to a range of output byte offsets.
+    def buffers(self, start=0, end=None):
+        view = memoryview(self.data)
+        offset = 0
+        for first, last in self.ranges():
+            lo, hi = self.start(first), self.ends[last - 1]
+            a = max(lo, lo + start - offset)
+            b = hi if end is None else min(hi, lo + end - offset)
+            if a < b:
+                yield view[a:b]
+            offset += hi - lo
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def __iter__(self):
+        data, ends = self.data, self.ends
+        for first, last in self.ranges():
+            start = self.start(first)
+            for i in range(first, last):
+                end = ends[i]
+                # Strip the line separator
+                yield data[start:end - 1].decode('utf-8')
+                start = end
+
+    def __len__(self):
+        return len(self.ends)
+
+# Spooled line store. Lines are written through a large
+# buffer into an anonymous temporary file as they are
+# emitted, so memory usage stays flat no matter how many
+# lines a job contains. Lines can only be appended, so this
+# is only suitable for the RUN section.
+class SpoolStore:
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self):
+        import tempfile
+        self.fh = tempfile.TemporaryFile(buffering=self.BUFFER_SIZE)
+        self.count = 0
+        self.size = 0
+
+    def append(self, line):
+        data = line.encode('utf-8')
+        self.fh.write(data)
+        self.fh.write(b'\n')
+        self.count += 1
+        self.size += len(data) + 1
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def prepend(self, lines):
+        raise ValueError("Unable to prepend lines to a spooled section!")
+
+    # Yield chunks of the spooled lines, optionally limited
+    # to a range of byte offsets.
+    def buffers(self, start=0, end=None):
+        self.fh.flush()
+        self.fh.seek(start)
+        remaining = (self.size if end is None else end) - start
+        while remaining > 0:
+            chunk = self.fh.read(min(remaining, self.BUFFER_SIZE))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        self.fh.flush()
+        self.fh.seek(0)
+        for line in self.fh:
+            # Strip the line separator added on write
+            yield line[:-1].decode('utf-8')
+
+    def __len__(self):
+        return self.count
+
+# Open a compressed stream that writes to a file object,
+# without closing it when the stream is closed.
+def compressor(kind, fh, name):
+    if kind == 'gzip':
+        import gzip
+        return gzip.GzipFile(filename=name, mode='wb', compresslevel=6, fileobj=fh)
+    zst = zstd()
+    if zst is None:
+        raise ValueError("zstd compression requires Python 3.14 or the zstandard package!")
+    if hasattr(zst, 'ZstdFile'):
+        return zst.ZstdFile(fh, mode='wb')
+    return zst.ZstdCompressor().stream_writer(fh, closefd=False)
+
+# File written through a large buffer, hashing the bytes
+# written to it if given a checksum algorithm.
+class HashedFile:
+    def __init__(self, path, checksum=None):
+        import hashlib
+        self.path = path
+        self.hash = hashlib.new(checksum) if checksum else None
+        self.fh = open(path, 'wb', buffering=SpoolStore.BUFFER_SIZE)
+
+    def write(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+        return self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+# Output file, with an optional compressed copy written
+# alongside it from the same buffers.
+class OutputFile:
+    SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, compress=None, checksum=None):
+        self.files = [HashedFile(path, checksum)]
+        self.compressed = None
+        if compress:
+            self.files.append(HashedFile(path + self.SUFFIXES[compress], checksum))
+            self.compressed = compressor(compress, self.files[-1], os.path.basename(path))
+
+    def write(self, data):
+        self.files[0].write(data)
+        if self.compressed is not None:
+            self.compressed.write(data)
+
+    def close(self):
+        if self.compressed is not None:
+            self.compressed.close()
+        for f in self.files:
+            f.close()
+
+    # Path and hex digest of each file written, if hashed
+    def digests(self):
+        return [(f.path, f.hash.hexdigest()) for f in self.files if f.hash is not None]
+
+# Class attribute built by a function on first use, which
+# then replaces it on the class so later lookups are as fast
+# as any other class attribute.
+class LazyClassAttribute:
+    def __init__(self, build):
+        self.build = build
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        value = self.build()
+        setattr(self.owner, self.name, value)
+        return value
+
+# Instance attribute built by a function on first use, which
+# then replaces it on the instance. Used for formatters whose
+# settings can be changed by an instance, so they are not
+# shared with other instances.
+class LazyAttribute:
+    def __init__(self, build):
+        self.build = build
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = self.build()
+        setattr(obj, self.name, value)
+        return value
+
 # Implements a generalised post-processor
 class PostProcessor:
     name      = "FreeCAD Post-Processor"
     vendor    = "Unknown"
-    version   = FreeCAD.Version()
 
 
-    def __init__(self, name=None, vendor=None, args={}):
+    def __init__(self, name=None, vendor=None, args={}, stream=False):
+        import FreeCAD
+        self.version = FreeCAD.Version()
+
         if name is not None:
             self.name = name
         if vendor is not None:
@@ -386,9 +3419,12 @@ class PostProcessor:
         # Set args
         self.args  = args
 
-        setattr(self, Section.RUN, [])
-        setattr(self, Section.PRE, [])
-        setattr(self, Section.POST, [])
+        # When streaming, RUN lines are spooled to disk as they
+        # are generated. PRE and POST are generated once parsing
+        # is complete and are always small, so they stay in memory.
+        setattr(self, Section.RUN, SpoolStore() if stream else LineStore())
+        setattr(self, Section.PRE, LineStore())
+        setattr(self, Section.POST, LineStore())
 
         # Set default section
         self.oldSection = Section.RUN
@@ -396,6 +3432,7 @@ class PostProcessor:
         self.additions  = []
         # Set default action
         self.prepend    = False
+        self.finalised  = False
 
         # Switch to PRE section
         with self.Section(Section.PRE):
@@ -406,18 +3443,22 @@ class PostProcessor:
 
     @contextmanager
     def Section(self, section, prepend=False):
+        oldAdditions = self.additions
         self.oldSection = self.curSection
         self.curSection = section
-        self.additions = []
         self.prepend = prepend
+
+        # Appended lines are written straight to the section
+        # store. Prepended lines must be collected first so
+        # they can be inserted in order.
+        self.additions = [] if prepend else getattr(self, section)
         try:
             yield
         finally:
-            if not self.prepend:
-                getattr(self, self.curSection).extend(self.additions)
-            else:
-                getattr(self, self.curSection)[:0] = self.additions
+            if self.prepend:
+                getattr(self, self.curSection).prepend(self.additions)
 
+            self.additions = oldAdditions
             self.curSection = self.oldSection
             self.oldSection = Section.RUN
 
@@ -425,20 +3466,26 @@ class PostProcessor:
 
     def parse(self, objects, skip_inactive=True):
         with self.Section(Section.RUN):
-            for o in objects:
-                # Recurse over compound objects
-                if hasattr(o, 'Group'):
-                    for p in o.Group:
-                        self.parse(p, skip_inactive=False)
+            for o in self.objects(objects, skip_inactive):
+                self._parseobj(o)
 
-                # Skip non-path objects
-                if not hasattr(o, 'Path'):
-                    continue
+    # Yield the objects to parse in order
+    def objects(self, objects, skip_inactive=True):
+        from Path.Base.Util import opProperty
+        for o in objects:
+            # Recurse over compound objects
+            if hasattr(o, 'Group'):
+                for p in o.Group:
+                    yield from self.objects(p, skip_inactive=False)
 
-                # Skip inactive operations
-                if skip_inactive and PathUtil.opProperty(o, 'Active') is False:
-                    continue
-                self._parseobj(o)
+            # Skip non-path objects
+            if not hasattr(o, 'Path'):
+                continue
+
+            # Skip inactive operations
+            if skip_inactive and opProperty(o, 'Active') is False:
+                continue
+            yield o
 
 
     # Default object parsing just outputs a 'begin operation'
@@ -461,7 +3508,11 @@ class PostProcessor:
                 case _:
                     self.onoperation(obj)
 
-        for c in obj.Path.Commands:
+        self._parsecmds(obj.Path.Commands)
+
+    # Default command list parsing parses each command in turn
+    def _parsecmds(self, cmds):
+        for c in cmds:
             self._parsecmd(c)
 
     # Default parameter parsing just outputs a key value pair
@@ -493,12 +3544,46 @@ class PostProcessor:
     def brk(self):
         self.additions.append('')
 
+    # Called once when parsing is complete, before the
+    # sections are output. Allows output of commands
+    # that depend on all objects having been parsed.
+    def finalise(self):
+        pass
+
+    # Generate the lines of each section in order
+    def lines(self):
+        if not self.finalised:
+            self.finalise()
+            self.finalised = True
+
+        for section in (Section.PRE, Section.RUN, Section.POST):
+            yield from getattr(self, section)
+
+    # Yield the encoded contents of each section in order
+    def buffers(self):
+        if not self.finalised:
+            self.finalise()
+            self.finalised = True
+
+        for section in (Section.PRE, Section.RUN, Section.POST):
+            yield from getattr(self, section).buffers()
+
     # Concat and output the sections
     def output(self):
-        out = getattr(self, Section.PRE)
-        out.extend(getattr(self, Section.RUN))
-        out.extend(getattr(self, Section.POST))
-        return '\n'.join(out)
+        # Drop the separator after the last line
+        return b''.join(self.buffers())[:-1].decode('utf-8')
+
+    # Write the sections to a file opened in binary mode,
+    # dropping the separator after the last line as output()
+    # does.
+    def write(self, fh):
+        last = None
+        for buf in self.buffers():
+            if last is not None:
+                fh.write(last)
+            last = buf
+        if last is not None:
+            fh.write(last[:-1])
 
 class MillenniumOSPostProcessor(PostProcessor):
     _RAPID_MOVES           = [0]
@@ -511,9 +3596,30 @@ class MillenniumOSPostProcessor(PostProcessor):
     _WCS_CHANGES           = [54, 55, 56, 57, 58, 59, 59.1, 59.2, 59.3]
     _CANNED_CYCLES         = [73, 81, 83]
     _UNSUPPORTED           = [98, 99]
-
-    # Define command output formatters
-    _G   = Output(fmt=FORMATS.CMD, prefix='G', vars = [
+    _MODAL_SETTINGS        = [GCODES.ABSOLUTE, GCODES.MILLIMETERS, GCODES.FEED_PER_MIN]
+
+    # Moves that can be batch processed, by command name
+    _BATCH_MOVES           = {'G0': 0, 'G00': 0, 'G1': 1, 'G01': 1, 'G2': 2, 'G02': 2, 'G3': 3, 'G03': 3}
+    _BATCH_PARAMS          = (ARGS.X, ARGS.Y, ARGS.Z, ARGS.ARC_X, ARGS.ARC_Y, ARGS.ARC_Z, ARGS.FEED)
+    _BATCH_MIN             = 64
+
+    # Operations with fewer commands than this are not worth
+    # formatting in a worker process, or caching.
+    _PARALLEL_MIN          = 2000
+    _CACHE_MIN             = 100
+
+    # Arguments that do not affect the output of operations
+    _CACHE_IGNORED_ARGS    = frozenset(['show_editor', 'stream', 'parallel', 'batch', 'cache_dir', 'cache_size',
+                                        'split_lines', 'split_bytes', 'split_path', 'compress', 'checksum',
+                                        'group_tools', 'resume_points', 'index'])
+    _PARALLEL_PARAMS       = LENGTH_ARGS | {ARGS.FEED, 'P', 'L'}
+
+    # Define command output formatters. These are built on
+    # first use and shared by all instances, except for those
+    # whose precision is set per instance.
+    @LazyAttribute
+    def _G():
+        return Output(fmt=FORMATS.CMD, prefix='G', vars = [
             Output(prefix=ARGS.X, fmt=FORMATS.AXES),
             Output(prefix=ARGS.Y, fmt=FORMATS.AXES),
             Output(prefix=ARGS.Z, fmt=FORMATS.AXES),
@@ -527,7 +3633,9 @@ class MillenniumOSPostProcessor(PostProcessor):
         ], ctrl=Control.FORCE)
 
 
-    _M   = Output(fmt=FORMATS.CMD, prefix='M', vars = [
+    @LazyClassAttribute
+    def _M():
+        return Output(fmt=FORMATS.CMD, prefix='M', vars = [
             Output(prefix='I', ctrl=Control.FORCE),
             Output(prefix='P', typ=str, fmt=FORMATS.STR, ctrl=Control.FORCE),
             Output(prefix='P', fmt=FORMATS.TOOLS, ctrl=Control.FORCE),
@@ -544,20 +3652,132 @@ class MillenniumOSPostProcessor(PostProcessor):
             Output(prefix='V', fmt=FORMATS.RPM, ctrl=Control.FORCE),
         ], ctrl=Control.FORCE)
 
-    _T   = Output(fmt=FORMATS.CMD, prefix='T', ctrl=Control.FORCE)
+    @LazyClassAttribute
+    def _T():
+        return Output(fmt=FORMATS.CMD, prefix='T', ctrl=Control.FORCE)
+
+    # Canned cycle parameters are stored by the cycle macros, so
+    # are always output when given, even if zero.
+    _CYCLE_PARAMS = (ARGS.Z, ARGS.ARC_R, ARGS.PECK, ARGS.FEED)
+
+    @LazyAttribute
+    def _CYCLE():
+        return Output(fmt=FORMATS.CMD, prefix='G', vars = [
+            Output(prefix=ARGS.Z, fmt=FORMATS.AXES, ctrl=Control.FORCE),
+            Output(prefix=ARGS.ARC_R, fmt=FORMATS.AXES, ctrl=Control.FORCE),
+            Output(prefix=ARGS.PECK, fmt=FORMATS.AXES, ctrl=Control.FORCE),
+            Output(prefix=ARGS.FEED, fmt=FORMATS.FEED, ctrl=Control.FORCE),
+        ], ctrl=Control.FORCE)
 
     def __init__(self, args={}):
         post_name = "MillenniumOS {}".format(RELEASE.VERSION)
 
-        super().__init__(post_name, vendor=RELEASE.VENDOR, args=args)
+        super().__init__(post_name, vendor=RELEASE.VENDOR, args=args, stream=getattr(args, 'stream', False))
         self._MOVES           = self._LINEAR_MOVES + self._ARC_MOVES + self._CANNED_CYCLES
         self._SPINDLE_ACTIONS = self._SPINDLE_ACTIONS_START + self._SPINDLE_ACTIONS_STOP
         self.active_wcs      = False
         self.used_wcs        = []
         self.tools           = {}
+        self.tool            = None
         self.xy_seen         = False
         self.delayed_z       = None
         self.spindle_started = False
+        self.wcs             = None
+        self.spindle         = None
+        self.boundaries      = []
+        self.operations      = 0
+        self.profiler        = None
+        self.machine         = Machine(args)
+        self.cycles          = getattr(args, 'canned_cycles', False)
+        self.cycle           = None
+        # Checksums of the files written, for the sidecar
+        self.digests         = []
+        # Index entries in the RUN section, and entries
+        # resolved to the files they were written to.
+        self.marks           = []
+        self.indexed         = []
+        # Optional reordering of operations by tool
+        self.scheduler       = ToolScheduler(self._WCS_CHANGES) if getattr(args, 'group_tools', False) else None
+
+        # Fail before parsing if the output cannot be compressed
+        if getattr(args, 'compress', None) == 'zstd' and zstd() is None:
+            raise ValueError("zstd compression requires Python 3.14 or the zstandard package!")
+
+        # Approximate WCS positions, used to order probing
+        self.wcs_positions   = parse_positions(getattr(args, 'wcs_positions', None) or '')
+
+        # Output precision of lengths, which operations can override
+        self.precision       = parse_precision(getattr(args, 'precision', None) or '')
+        self.setprecision(self.precision)
+
+        # The unit schema is fixed for the whole post, so lengths
+        # are converted with a single scale factor. Feed rates are
+        # truncated after conversion so they are converted exactly
+        # via FreeCAD, but repeat heavily so are cached.
+        import FreeCAD
+        self.length_scale    = float(FreeCAD.Units.Quantity(1.0, FreeCAD.Units.Length).getValueAs(UNITS.LENGTH))
+        self.feedrate        = functools.lru_cache(maxsize=FEED_CACHE_SIZE)(self._feedrate)
+
+        # Optional move pipeline stages, in order
+        self.position        = {ARGS.X: None, ARGS.Y: None, ARGS.Z: None, ARGS.FEED: None}
+        self.stages          = []
+        # Stock bounding box of the current operation
+        self.stock           = None
+        self.air_moves       = getattr(args, 'air_moves', None)
+        if self.air_moves:
+            feed = None
+            if self.air_moves == 'feed':
+                feed = args.air_feed or self.machine.max_feed or self.machine.rapidrate()
+            self.stages.append(AirMovePromoter(args.air_margin, feed, lambda: self.stock, self.toolradius, self.machine))
+        # Safe height of the current operation
+        self.safe_height     = None
+        self.optimise_rapids = getattr(args, 'optimise_rapids', False)
+        if self.optimise_rapids:
+            self.stages.append(RapidOptimiser(self.machine.rapidrate(), self.toolradius, lambda: self.safe_height))
+        self.keep_tool_down  = getattr(args, 'keep_tool_down', None)
+        if self.keep_tool_down:
+            self.stages.append(RetractShortener(self.keep_tool_down == 'feed', lambda: self.safe_height,
+                self.toolradius, self.machine))
+        if getattr(args, 'simplify', False):
+            self.stages.append(MoveSimplifier(args.simplify_tolerance, dp=args.simplify_dp, formats=self.axisformat))
+        if getattr(args, 'arc_fit', False):
+            self.stages.append(ArcFitter(args.arc_fit_tolerance))
+        self.merge_arcs      = getattr(args, 'merge_arcs', False)
+        if self.merge_arcs:
+            self.stages.append(ArcMerger())
+        if self.cycles:
+            self.stages.append(CycleCompactor())
+
+        for stage, following in zip(self.stages, self.stages[1:]):
+            stage.out = following.push
+        if self.stages:
+            self.stages[-1].out = self._emitmove
+
+        # Optional cycle time estimate of the output moves
+        self.timer           = CycleTimer(self.machine) if getattr(args, 'estimate_time', False) else None
+
+        # Optional tracking of the extents of the output moves
+        self.bounds          = MoveBounds(self.machine) if getattr(args, 'check_limits', False) else None
+        measured             = self.timer is not None or self.bounds is not None
+
+        # Moves can only be batched if they are output directly
+        self.batch           = getattr(args, 'batch', False) and numpy() is not None and not self.stages and not measured
+
+        # Operations can only be formatted in parallel if their
+        # moves are not measured. Workers are started as new
+        # processes, which is not possible inside the FreeCAD GUI
+        # as they would start FreeCAD itself.
+        self.parallel        = 0 if measured or FreeCAD.GuiUp else getattr(args, 'parallel', 0)
+
+        # Formatted operations can be cached if they can be
+        # formatted on their own.
+        self.cache           = None
+        if getattr(args, 'cache_dir', None) and not measured:
+            self.cache       = BodyCache(args.cache_dir, args.cache_size << 20)
+
+        # Post-processor formatting operations on their own in
+        # this process, created when first needed.
+        self.bodyformatter   = None
 
         with self.Section(Section.PRE):
             # Warn operator
@@ -567,6 +3787,54 @@ class MillenniumOSPostProcessor(PostProcessor):
             self.comment("You are solely responsible for any injuries or damage caused by not heeding this warning!")
             self.brk()
 
+    # Set the decimal places of each length output
+    def setprecision(self, digits):
+        for k, places in digits.items():
+            for out in (self._G, self._CYCLE):
+                for o in out.varFormats.get(k, ()):
+                    if o.digits is not None and o.digits != places:
+                        o.setdigits(places)
+
+    # Return the output precision of an operation, which can be
+    # overridden by a PostPrecision property or a tag in its label.
+    def opprecision(self, op):
+        value = getattr(op, 'PostPrecision', None)
+        if not value:
+            m = PRECISION.TAG.search(getattr(op, 'Label', ''))
+            value = m.group(1) if m else None
+        if not value:
+            return self.precision
+        try:
+            return parse_precision(value, self.precision)
+        except ValueError as e:
+            raise ValueError("Operation {}: {}".format(op.Label, e))
+
+    # Return the stock bounding box of the job an operation
+    # belongs to as its lower and upper XYZ corners, or None if
+    # the operation is not in a job with stock.
+    def stockbounds(self, op):
+        import PathScripts.PathUtils as PathUtils
+        job = PathUtils.findParentJob(op)
+        stock = getattr(job, 'Stock', None)
+        if stock is None:
+            return None
+        box = stock.Shape.BoundBox
+        scale = self.length_scale
+        return ((box.XMin * scale, box.YMin * scale, box.ZMin * scale),
+                (box.XMax * scale, box.YMax * scale, box.ZMax * scale))
+
+    # Return the safe height of an operation, or None if it
+    # does not have one.
+    def safeheight(self, op):
+        height = getattr(op, 'SafeHeight', None)
+        if height is None:
+            return None
+        return height.Value * self.length_scale
+
+    # Return the formatter of an axis at the current precision
+    def axisformat(self, axis):
+        return self._G.varFormats[axis][0].formatter
+
     def _forceFeed(self):
         self._G.reset([ARGS.FEED,])
 
@@ -582,12 +3850,18 @@ class MillenniumOSPostProcessor(PostProcessor):
     def _forceLinearParams(self):
         self._G.reset([ARGS.X, ARGS.Y, ARGS.Z])
 
+    # Forget the parameters stored by the canned cycle macros,
+    # so they are output in full by the next cycle.
+    def _forceCycle(self):
+        self.cycle = None
+
     def _forceAll(self):
         self._forceFeed()
         self._forceTool()
         self._forceSpindle()
         self._forceArcParams()
         self._forceLinearParams()
+        self._forceCycle()
 
     def T(self, code):
         cmd, _ = self._T(code)
@@ -600,6 +3874,11 @@ class MillenniumOSPostProcessor(PostProcessor):
         if code in self._UNSUPPORTED:
             return None
 
+        # Moves buffered in the pipeline must be output
+        # before any other command.
+        if code not in self._MOVES:
+            self.flushmoves()
+
         # Reset tools, feed and spindle on park
         if code == GCODES.PARK:
             self.onpark(code, params)
@@ -619,7 +3898,17 @@ class MillenniumOSPostProcessor(PostProcessor):
 
             self.cmd(' '.join(cmd))
 
+            if self.timer:
+                if code == GCODES.DWELL:
+                    self.timer.dwell(params)
+                elif code not in self._MODAL_SETTINGS:
+                    self.timer.reset()
+
+            if self.bounds and code not in self._MODAL_SETTINGS and code != GCODES.DWELL:
+                self.bounds.reset()
+
     def M(self, code, **params):
+        self.flushmoves()
 
         # If code is a tool change, send the T command
         # and return so the M6 is not output.
@@ -643,6 +3932,29 @@ class MillenniumOSPostProcessor(PostProcessor):
             self.G(GCODES.PROBE_OPERATOR, W=wcsOffset)
         self.brk()
 
+    # Return the used WCSs in the order to probe them at start.
+    # With positions, WCSs are ordered by working back from the
+    # first WCS used to the nearest WCS not yet ordered, so
+    # probing ends where the job starts. Otherwise they are
+    # probed in the order they are first used.
+    def probeorder(self):
+        positions = self.wcs_positions
+        if not positions or not self.used_wcs:
+            return list(self.used_wcs)
+
+        for wcs in self.used_wcs:
+            if wcs not in positions:
+                raise ValueError("No position given for WCS {}".format(wcs))
+
+        order = [self.used_wcs[0]]
+        remaining = set(self.used_wcs[1:])
+        while remaining:
+            x, y = positions[order[-1]]
+            nearest = min(remaining, key=lambda wcs: (math.hypot(positions[wcs][0] - x, positions[wcs][1] - y), wcs))
+            order.append(nearest)
+            remaining.remove(nearest)
+        return order[::-1]
+
     # Add tool index, name and params to tool info
     def addtool(self, index, name, params):
         if index in self.tools and name != self.tools[index]['name']:
@@ -657,6 +3969,12 @@ class MillenniumOSPostProcessor(PostProcessor):
     def toolinfo(self):
         return self.tools
 
+    # Return the radius of the active tool, or 0 if unknown
+    def toolradius(self):
+        if self.tool not in self.tools:
+            return 0
+        return self.tools[self.tool]['params']['radius']
+
     # Note: these functions are called based on the object type - these
     # do not refer to indivudal gcode commands, but are triggered at the
     # start of each new object.
@@ -676,9 +3994,20 @@ class MillenniumOSPostProcessor(PostProcessor):
             return None
         self.cmd(' '.join(cmd))
 
+        if self.timer:
+            self.timer.reset()
+        if self.bounds:
+            self.bounds.reset()
+
+        # The machine is parked so output can be split here
+        self.boundary()
+
     def onwcs(self, code, params):
         wcsOffset = int(code - (self._WCS_CHANGES[0]-1))
-        self.used_wcs.append(wcsOffset)
+        self.mark(type='wcs', wcs=wcsOffset)
+        probed = wcsOffset in self.used_wcs
+        if not probed:
+            self.used_wcs.append(wcsOffset)
 
         if self.active_wcs:
             self.comment("Park ready for WCS change")
@@ -692,6 +4021,12 @@ class MillenniumOSPostProcessor(PostProcessor):
             return None
         self.cmd(' '.join(cmd))
 
+        if self.timer:
+            self.timer.reset()
+        if self.bounds:
+            self.bounds.switch(wcsOffset)
+
+        self.wcs = code
         self.active_wcs = True
         self.brk()
 
@@ -699,10 +4034,15 @@ class MillenniumOSPostProcessor(PostProcessor):
         # compensation commands without a WCS offset - they default
         # to the active WCS.
 
-        # Only probe inline if probe_on_change is set
+        # Only probe inline if probe_on_change is set, and only
+        # the first time the WCS is used.
         if self.args.probe_mode == PROBE.ON_CHANGE:
-            self.probe()
-            self.spindle_started = False
+            if probed:
+                self.comment("WCS {} already probed".format(wcsOffset))
+                self.brk()
+            else:
+                self.probe()
+                self.spindle_started = False
 
 
         self.comment("Enable rotation compensation if necessary")
@@ -710,7 +4050,46 @@ class MillenniumOSPostProcessor(PostProcessor):
 
         return None
 
+    # Pass moves through the pipeline stages, if any, tracking
+    # the machine position so stages know where each move starts.
     def onmove(self, code, params):
+        if not self.stages:
+            return self._emitmove(Move(code, params, None, None))
+
+        start = self.position
+        end = start.copy()
+        for k in end:
+            if k in params:
+                end[k] = params[k]
+
+        # Canned cycles end at the retract plane
+        if code in self._CANNED_CYCLES and ARGS.ARC_R in params:
+            end[ARGS.Z] = params[ARGS.ARC_R]
+        self.position = end
+
+        self.stages[0].push(Move(code, params, start, end))
+
+    # Output any moves buffered in the pipeline stages
+    def flushmoves(self):
+        for stage in self.stages:
+            stage.flush()
+
+        # The machine stops before any other command
+        if self.timer:
+            self.timer.flush()
+
+    # Output a summary of changes made by each pipeline stage
+    def reportmoves(self):
+        for stage in self.stages:
+            msg = stage.report()
+            if msg:
+                self.comment(msg)
+
+    def _emitmove(self, move):
+        code, params = move.code, move.params
+
+        if self.cycles and code in self._CANNED_CYCLES:
+            return self._emitcycle(move)
 
         # Make sure the first arc move after a linear move
         # contains the right parameters.
@@ -718,9 +4097,14 @@ class MillenniumOSPostProcessor(PostProcessor):
             self._forceArcParams()
 
         # Make sure the first linear move after an arc move
-        # contains the right parameters.
+        # contains the right parameters. Arc centre offsets are
+        # not modal, so must be output on every arc move. When
+        # merging arcs, end points that did not change are left
+        # out, as RRF defaults them to the current position.
         if code in self._ARC_MOVES:
-            self._forceLinearParams()
+            if not self.merge_arcs:
+                self._forceLinearParams()
+            self._forceArcParams()
 
         cmd, changed = self._G(code, **params)
         if not cmd or not changed:
@@ -749,7 +4133,7 @@ class MillenniumOSPostProcessor(PostProcessor):
             # And Z has been changed
             if ARGS.Z in changed:
                 # Then store the Z height for later
-                self.delayed_z = [cmd, changed]
+                self.delayed_z = [cmd, changed, move]
                 return
 
             if ARGS.X in changed or ARGS.Y in changed:
@@ -758,18 +4142,296 @@ class MillenniumOSPostProcessor(PostProcessor):
         # Otherwise if we have seen an X/Y move and there is a delayed Z,
         # then output the delayed move.
         elif self.delayed_z is not None:
-            dcmd, _ = self.delayed_z
-            self.brk()
-            self.comment("Delayed Z move following XY")
-            self.cmd(' '.join(dcmd))
-            self.delayed_z = None
-            self.brk()
+            self._emitdelayed()
 
         self.cmd(' '.join(cmd))
 
+        if self.timer:
+            self.timer.move(code, params)
+        if self.bounds:
+            self.bounds.move(code, params)
+
+    # Output the Z move delayed until after the first XY move
+    def _emitdelayed(self):
+        dcmd, _, dmove = self.delayed_z
+        self.brk()
+        self.comment("Delayed Z move following XY")
+        self.cmd(' '.join(dcmd))
+        self.delayed_z = None
+        self.brk()
+
+        if self.timer:
+            self.timer.move(dmove.code, dmove.params)
+        if self.bounds:
+            self.bounds.move(dmove.code, dmove.params)
+
+    # Output a canned cycle. The cycle macros store their
+    # parameters, so only parameters that differ from those
+    # stored by the last cycle of the same type are output.
+    def _emitcycle(self, move):
+        code, params = move.code, move.params
+
+        given = {k: params[k] for k in self._CYCLE_PARAMS if k in params}
+        if self.cycle is not None and self.cycle[0] == code:
+            stored = self.cycle[1]
+            changed = {k: v for k, v in given.items() if stored.get(k) != v}
+            stored.update(given)
+        else:
+            changed = given
+            self.cycle = (code, given)
+
+        # The cycle moves above the hole itself
+        if self.delayed_z is not None:
+            self._emitdelayed()
+        self.xy_seen = True
+
+        xy = {k: params[k] for k in (ARGS.X, ARGS.Y) if k in params}
+        cmd, _ = self._G(code, **xy)
+        words, _ = self._CYCLE(code, **changed)
+        self.cmd(' '.join((cmd or words[:1]) + words[1:]))
+
+        # The cycle ends at the retract plane, at its own feed
+        self._G.reset([ARGS.Z, ARGS.FEED])
+
+        if self.timer:
+            self.timer.move(code, params)
+        if self.bounds:
+            self.bounds.move(code, params)
+
+    # Record a point in the RUN section where output can be split
+    # into a new file, with the state that must be restored at the
+    # start of the new file, optionally leaving out the tool.
+    # Leaving out the tool also leaves it out of boundaries since
+    # the last operation began, such as the park before a WCS
+    # change, as nothing between them uses the tool.
+    def boundary(self, tool=True):
+        if self.curSection != Section.RUN:
+            return
+
+        if not tool:
+            for i in range(len(self.boundaries) - 1, -1, -1):
+                line, size, operations, (wcs, _, _) = self.boundaries[i]
+                if operations != self.operations:
+                    break
+                self.boundaries[i] = (line, size, operations, (wcs, None, None))
+
+        spindle = self.spindle if self.spindle_started else None
+        run = getattr(self, Section.RUN)
+        self.boundaries.append((len(run), run.size, self.operations, (self.wcs, self.tool if tool else None, spindle)))
+
+    # Record the line and byte offsets of an entry for the index
+    # at the current point in the RUN section.
+    def mark(self, **entry):
+        if not self.args.index or self.curSection != Section.RUN:
+            return
+
+        run = getattr(self, Section.RUN)
+        self.marks.append((len(run), run.size, entry))
+
+    # Resolve the recorded index entries to a file, given the
+    # line and byte offsets in it of the start of the RUN
+    # section, or of the given range of the RUN section.
+    def resolve(self, filename, line, offset, start=(0, 0), end=None):
+        marks = []
+        for index, size, entry in self.marks:
+            if size < start[1] or (end is not None and size >= end):
+                marks.append((index, size, entry))
+                continue
+            self.indexed.append(dict(entry, file=os.path.basename(filename),
+                line=line + index - start[0] + 1, offset=offset + size - start[1]))
+        self.marks = marks
+
+    # Output commands that restore the given machine state
+    def restore(self, state):
+        wcs, tool, spindle = state
+
+        self.comment("Restore machine state")
+        self.G(GCODES.ABSOLUTE)
+        self.G(GCODES.MILLIMETERS)
+        self.G(GCODES.FEED_PER_MIN)
+
+        if wcs is not None:
+            cmd, _ = self._G(wcs)
+            self.cmd(' '.join(cmd))
+            self.M(MCODES.ENABLE_ROTATION_COMPENSATION)
+
+        if tool is not None:
+            self.T(tool)
+
+        if spindle is not None:
+            code, rpm = spindle
+            cmd, _ = self._M(code + self._SPINDLE_WAIT_SUFFIX, S=rpm)
+            self.cmd(' '.join(cmd))
+
+        if self.args.vssc:
+            self.M(MCODES.VSSC_ENABLE, P=self.args.vssc_period, V=self.args.vssc_variance)
+        self.brk()
+
+    # Output a block that parks the machine and restores the
+    # current machine state, so the job can be restarted here.
+    # The block only runs if the machine is not already in that
+    # state, so it does not interrupt a job run from the start.
+    def resumepoint(self, label):
+        spindle = self.spindle if self.spindle_started else None
+
+        checks = []
+        if self.wcs is not None:
+            checks.append('move.workplaceNumber != {}'.format(self._WCS_CHANGES.index(self.wcs)))
+        if self.tool is not None:
+            checks.append('state.currentTool != {}'.format(FORMATS.TOOLS.format(self.tool)))
+        if spindle is not None:
+            # Spindle speed is negative when running counter-clockwise
+            cw = spindle[0] == self._SPINDLE_ACTIONS_START[0]
+            checks.append('spindles[global.mosSID].current {} 0'.format('<=' if cw else '>='))
+        if self.args.vssc:
+            checks.append('!global.mosVSEnabled')
+
+        # Moves still buffered in the pipeline belong before the
+        # resume point, not inside its conditional block.
+        self.flushmoves()
+
+        additions, self.additions = self.additions, []
+        try:
+            if checks:
+                self.comment("Park")
+                cmd, _ = self._G(GCODES.PARK)
+                self.cmd(' '.join(cmd))
+            self.restore((self.wcs, self.tool, spindle))
+        finally:
+            lines, self.additions = self.additions, additions
+
+        self.comment('Resume point {}: {}'.format(self.operations, label))
+        if checks:
+            self.cmd('if { ' + ' || '.join(checks) + ' }')
+            lines = ['  ' + line for line in lines if line]
+        self.additions.extend(lines)
+        self.brk()
+
+    # Choose the boundaries to split the RUN section at, so each
+    # part is within the line and byte limits where possible and
+    # contains at least one operation. Returns a list of
+    # (line offset, byte offset, state) tuples.
+    def splits(self, max_lines, max_bytes):
+        # Boundaries hold the line and byte offsets at which
+        # they were recorded.
+        boundaries = self.boundaries
+        run = getattr(self, Section.RUN)
+        total = (len(run), run.size)
+
+        def fits(start, index, size, *_):
+            return (not max_lines or index - start[0] <= max_lines) and (not max_bytes or size - start[1] <= max_bytes)
+
+        chosen = []
+        start = (0, 0, 0)
+        i = 0
+        while not fits(start, *total):
+            # Split at the last boundary that fits, or the
+            # first one after it if none do.
+            best = None
+            while i < len(boundaries) and (best is None or fits(start, *boundaries[i])):
+                if boundaries[i][2] > start[2]:
+                    best = boundaries[i]
+                i += 1
+            if best is None:
+                break
+            chosen.append((best[0], best[1], best[3]))
+            start = best
+
+        return chosen
+
+    # Split the RUN section into separate files next to the
+    # output file, replacing it with calls to each file in order.
+    # Returns the number of files written.
+    def split(self, filename, max_lines=0, max_bytes=0):
+        chosen = self.splits(max_lines, max_bytes)
+        if not chosen:
+            return 0
+
+        run = getattr(self, Section.RUN)
+        starts = [(0, 0)] + [(line, offset) for line, offset, _ in chosen]
+        ends = [offset for _, offset in starts[1:]] + [run.size]
+        states = [None] + [state for _, _, state in chosen]
+
+        base, ext = os.path.splitext(filename)
+        path = self.args.split_path.rstrip('/') + '/'
+        names = []
+
+        for part, (start, end, state) in enumerate(zip(starts, ends, states), 1):
+            partname = '{}-{:03d}{}'.format(base, part, ext)
+            names.append(os.path.basename(partname))
+
+            header = LineStore()
+            setattr(self, Section.RUN, header)
+            with self.Section(Section.RUN):
+                self.comment('Part {} of {}: {}'.format(part, len(starts), os.path.basename(filename)))
+                self.brk()
+                if state is not None:
+                    self.restore(state)
+
+            with self.sink(partname) as fh:
+                for buf in itertools.chain(header.buffers(), run.buffers(start[1], end)):
+                    fh.write(buf)
+            self.resolve(partname, len(header), header.size, start, end)
+
+        setattr(self, Section.RUN, LineStore())
+        with self.Section(Section.RUN):
+            self.brk()
+            for part, name in enumerate(names, 1):
+                self.comment('Run part {} of {}'.format(part, len(names)))
+                self.M(MCODES.CALL_MACRO, P='{}{}'.format(path, name).replace('"', '""'))
+
+        return len(names)
+
+    # Open an output file, with a compressed copy if enabled,
+    # recording the checksums of the files once written.
+    @contextmanager
+    def sink(self, path):
+        out = OutputFile(path, self.args.compress, self.args.checksum)
+        try:
+            yield out
+        finally:
+            out.close()
+        self.digests.extend(out.digests())
+
+    # Write the output, or the given text in its place, to a
+    # file, followed by the checksum and index sidecars if
+    # enabled. The index is only written if the text is the
+    # generated output, as its offsets do not hold otherwise.
+    def save(self, filename, text=None, index=True):
+        with self.sink(filename) as fh:
+            if text is None:
+                self.write(fh)
+            else:
+                fh.write(text.encode('utf-8'))
+
+        if self.args.checksum:
+            sidecar = '{}.{}'.format(os.path.splitext(filename)[0], self.args.checksum)
+            with open(sidecar, 'w', encoding='utf-8') as fh:
+                for path, digest in self.digests:
+                    fh.write('{}  {}\n'.format(digest, os.path.basename(path)))
+
+        if self.args.index and index:
+            # Entries in the RUN section follow the PRE section
+            pre = getattr(self, Section.PRE)
+            self.resolve(filename, len(pre), pre.size)
+            with open(os.path.splitext(filename)[0] + '.index.json', 'w', encoding='utf-8') as fh:
+                json.dump({'file': os.path.basename(filename), 'resume_points': self.args.resume_points,
+                    'entries': self.indexed}, fh, indent=2)
+
     def ontoolchange(self, _, params):
-        self.T(params[ARGS.TOOL])
+        self.mark(type='tool', tool=params[ARGS.TOOL])
+
+        # The tool change parks the machine and stops the
+        # spindle so output can be split before it. A part that
+        # starts here selects its own tool, so neither the tool
+        # nor the spindle is restored.
         self.spindle_started = False
+        self.boundary(tool=False)
+
+        self.tool = params[ARGS.TOOL]
+        self.T(params[ARGS.TOOL])
+        if self.timer:
+            self.timer.toolchange()
         self.brk()
         return False
 
@@ -777,6 +4439,7 @@ class MillenniumOSPostProcessor(PostProcessor):
         if ARGS.RPM in params and code in self._SPINDLE_ACTIONS_START:
             self.comment("Start spindle at requested RPM and wait for it to accelerate")
             self.spindle_started = True
+            self.spindle = (code, params[ARGS.RPM])
         if code in self._SPINDLE_ACTIONS_STOP:
             self.comment("Stop spindle and wait for it to decelerate")
             self.spindle_started = False
@@ -798,12 +4461,29 @@ class MillenniumOSPostProcessor(PostProcessor):
 
 
     def onoperation(self, op):
+        self.mark(type='operation', name=op.Label)
         self.comment('Begin Operation: {}'.format(op.Label))
+        self.operations += 1
+        self.setprecision(self.opprecision(op))
+        if self.air_moves:
+            self.stock = self.stockbounds(op)
+        if self.keep_tool_down or self.optimise_rapids:
+            self.safe_height = self.safeheight(op)
+        for stage in self.stages:
+            stage.begin()
+
+        if self.timer:
+            self.timer.begin(op.Label)
+        if self.bounds:
+            self.bounds.begin(op.Label)
 
         # Make sure spindle is started unless we allow zero RPM
         if not self.spindle_started and not self.args.allow_zero_rpm:
             raise ValueError("Spindle not started before operation {}".format(op.Label))
 
+        if self.args.resume_points:
+            self.resumepoint(op.Label)
+
         # Some FreeCAD operations will output a Z
         # move to the clearance height at the start of the operation
         # rather than moving to XY first and then down to the clearance
@@ -824,6 +4504,10 @@ class MillenniumOSPostProcessor(PostProcessor):
 
     def ontoolcontroller(self, tc):
         self.comment('TC: {}'.format(tc.Tool.Label))
+        self.addtool(tc.ToolNumber, tc.Label.strip("TC: "), self.toolparams(tc))
+
+    # Return the parameters of a tool controller's tool
+    def toolparams(self, tc):
         radius = float(tc.Tool.Diameter.getValueAs(UNITS.LENGTH))/2
 
         # Corner radius is a pain here because there's no
@@ -853,14 +4537,13 @@ class MillenniumOSPostProcessor(PostProcessor):
         tl = float(tc.Tool.Length.getValueAs(UNITS.LENGTH))
         fl = float(tc.Tool.CuttingEdgeHeight.getValueAs(UNITS.LENGTH)) if hasattr(tc.Tool, 'CuttingEdgeHeight') else tl
 
-        tool_params = {
+        return {
             "flutes": tc.Tool.Flutes,
             "radius": radius,
             "tool_length": tl,
             "flute_length": fl,
             "corner_radius": cr
         }
-        self.addtool(tc.ToolNumber, tc.Label.strip("TC: "), tool_params)
 
     def _parsecmd(self, cmd):
         ctype = cmd.Name[0].upper()
@@ -891,28 +4574,422 @@ class MillenniumOSPostProcessor(PostProcessor):
     # Convert necessary parameters based on FreeCAD units.
     def _parseparam(self, code, key, value):
         match key:
-            # Convert FreeCAD feed-rate to machine feed rate and store
-            # as an integer. Point something RPM is not necessary,
-            # and if we store these as floats then we have to deal with
-            # floating point errors during comparison.
+            # Convert FreeCAD feed-rate to machine feed rate.
             case ARGS.FEED:
-                rate = Units.Quantity(value, FreeCAD.Units.Velocity)
-                return int(rate.getValueAs(UNITS.FEED))
-            # Convert all other floats to machine lengths
-            case float():
-                val = Units.Quantity(value, FreeCAD.Units.Length)
-                return float(val.getValueAs(UNITS.LENGTH))
-            # Return all other values as-is (likely strings)
+                return self.feedrate(value)
+            # Convert lengths to machine lengths
+            case _ if key in LENGTH_ARGS and isinstance(value, float):
+                return value * self.length_scale
+            # Return all other values as-is
             case _:
                 return value
 
+    # Convert FreeCAD feed-rate to machine feed rate and store
+    # as an integer. Point something RPM is not necessary,
+    # and if we store these as floats then we have to deal with
+    # floating point errors during comparison.
+    def _feedrate(self, value):
+        import FreeCAD
+        rate = FreeCAD.Units.Quantity(value, FreeCAD.Units.Velocity)
+        return int(rate.getValueAs(UNITS.FEED))
+
+    # In batch mode, collect runs of consecutive moves and
+    # process each run in one go. Everything else, and moves
+    # before the delayed Z move at the start of an operation
+    # has been output, are parsed one at a time.
+    def _parsecmds(self, cmds):
+        if not self.batch:
+            super()._parsecmds(cmds)
+            self.flushmoves()
+            self.reportmoves()
+            return
+
+        moves = self._BATCH_MOVES
+        params = frozenset(self._BATCH_PARAMS)
+        run = []
+
+        # Only commands parsed one at a time can change whether
+        # moves can be batched.
+        ready = self.xy_seen and self.delayed_z is None
+
+        for c in cmds:
+            if ready:
+                code = moves.get(c.Name)
+                if code is not None:
+                    p = c.Parameters
+                    if params.issuperset(p):
+                        run.append((code, p, c))
+                        continue
+
+            self._parsebatch(run)
+            run = []
+            self._parsecmd(c)
+            ready = self.xy_seen and self.delayed_z is None
+
+        self._parsebatch(run)
+
+    # Process a run of moves using vectorised passes. This
+    # must output exactly what calling onmove() for each move
+    # would, and leave the _G Output in the same state.
+    def _parsebatch(self, run):
+        # Short runs are not worth vectorising
+        if len(run) < self._BATCH_MIN:
+            for _, _, c in run:
+                self._parsecmd(c)
+            return
+
+        np = numpy()
+        n = len(run)
+        codes = np.fromiter((r[0] for r in run), dtype=np.int8, count=n)
+        params = [r[1] for r in run]
+
+        arcs = (codes == GCODES.ARC_CW) | (codes == GCODES.ARC_CCW)
+        rapids = codes == GCODES.RAPID
+
+        # Lengths are converted by scaling, feeds are converted
+        # once for each unique value.
+        scale = self.length_scale
+
+        # Moves are grouped by their parameters in input order, and
+        # the values of each group are read in a single pass.
+        orders = {}
+        for i, order in enumerate(map(tuple, params)):
+            idx = orders.get(order)
+            if idx is None:
+                idx = orders[order] = []
+            idx.append(i)
+
+        orders = {order: np.array(idx) for order, idx in orders.items()}
+
+        cols = {k: np.full(n, np.nan) for k in self._BATCH_PARAMS}
+        for order, idx in orders.items():
+            if not order:
+                continue
+            values = np.fromiter(itertools.chain.from_iterable(dict.values(params[i]) for i in idx.tolist()),
+                dtype=float, count=len(idx) * len(order)).reshape(len(idx), len(order))
+            for j, k in enumerate(order):
+                cols[k][idx] = values[:, j]
+
+        presents = {}
+        changes = {}
+        for k in self._BATCH_PARAMS:
+            values = cols[k]
+            present = ~np.isnan(values)
+
+            if k == ARGS.FEED:
+                if present.any():
+                    unique, inverse = np.unique(values[present], return_inverse=True)
+                    converted = [self.feedrate(v) for v in unique.tolist()]
+                    values[present] = np.array(converted, dtype=float)[inverse]
+            elif scale != 1.0:
+                values *= scale
+
+            o = self._G.varFormats[k][0]
+
+            # Lengths are compared at output precision, rounded
+            # exactly as Output.arg() rounds them.
+            if k != ARGS.FEED and o.digits is not None and present.any():
+                unique, inverse = np.unique(values[present], return_inverse=True)
+                rounded = [round(v, o.digits) for v in unique.tolist()]
+                values[present] = np.array(rounded, dtype=float)[inverse]
+
+            # Values that format to nothing do not affect the Output
+            present &= ~o.zeromask(values)
+
+            cols[k] = values
+            presents[k] = present
+
+            if k == ARGS.FEED:
+                continue
+
+            # Linear params are forced on every arc move, and arc params
+            # are forced on every move.
+            resets = arcs if k in (ARGS.X, ARGS.Y, ARGS.Z) else np.ones(n, dtype=bool)
+            changes[k], o.lastCode = modal_changes(values, present, resets, o.lastCode)
+
+        other = np.zeros(n, dtype=bool)
+        for k in changes:
+            other |= changes[k]
+
+        # A changed feed on its own is not output, and a changed feed
+        # is removed from rapid moves. Both force the feed to be output
+        # on the next move with a feed.
+        o = self._G.varFormats[ARGS.FEED][0]
+        fidx = np.flatnonzero(presents[ARGS.FEED])
+        feed = np.zeros(n, dtype=bool)
+        if len(fidx):
+            fvalues = cols[ARGS.FEED][fidx]
+            fchanges, _ = modal_changes(fvalues, np.ones(len(fidx), dtype=bool), np.zeros(len(fidx), dtype=bool), o.lastCode)
+            triggers = rapids[fidx] | ~other[fidx]
+            fchanges = chained_changes(fchanges, triggers)
+            feed[fidx] = fchanges
+            o.lastCode = None if fchanges[-1] and triggers[-1] else int(fvalues[-1])
+        changes[ARGS.FEED] = feed & ~rapids
+
+        # Format each unique changed value once, for moves where
+        # anything other than the feed changed.
+        parts = {}
+        for k in self._BATCH_PARAMS:
+            mask = changes[k] & other
+            part = np.full(n, '', dtype=object)
+            if mask.any():
+                unique, inverse = np.unique(cols[k][mask], return_inverse=True)
+                formatted = self._G.varFormats[k][0].formatmany(unique.tolist())
+                part[mask] = np.array([' ' + f for f in formatted], dtype=object)[inverse]
+            parts[k] = part
+
+        # Assemble output lines in the same parameter order as the input
+        gcodes = np.array([self._G.format(float(c)) for c in range(4)], dtype=object)
+        lines = gcodes[codes]
+
+        for order, idx in orders.items():
+            columns = [lines[idx]] + [parts[k][idx] for k in order]
+            lines[idx] = [''.join(words) for words in zip(*columns)]
+
+        self.additions.extend(lines[other].tolist())
+
+        # Leave the command Output as if the last move was output
+        # normally.
+        self._G.lastCode = float(codes[-1])
+        self._G.lastVars = (self._G.lastCode, {k: cols[k][-1].item() for k in params[-1]})
+
+    # Parse objects, formatting the commands of large operations
+    # in a pool of worker processes and reusing cached output of
+    # unchanged operations. The commands of an operation that only
+    # contains moves only depend on the modal state of move
+    # parameters, which is reset at the start of every operation,
+    # so can be formatted on their own. Everything else is
+    # processed in order, and the output of each operation is
+    # inserted in order with the modal state it leaves behind.
+    # Operations are reordered by tool first if enabled.
+    def parse(self, objects, skip_inactive=True):
+        objects = self.objects(objects, skip_inactive)
+        if self.scheduler is not None:
+            objects = self.scheduler.schedule(list(objects))
+
+        if self.parallel < 2 and self.cache is None:
+            with self.Section(Section.RUN):
+                for o in objects:
+                    self._parseobj(o)
+            return
+
+        import concurrent.futures
+
+        objects = list(objects)
+        minimum = self._PARALLEL_MIN if self.cache is None else self._CACHE_MIN
+
+        with self.Section(Section.RUN), self.workerpool() as pool:
+            bodies = {}
+            for oid, task in self.bodies(objects, minimum).items():
+                key, result = None, None
+                if self.cache is not None:
+                    key = self.cache.key(self.cachesettings(), *task)
+                    result = self.cache.get(key)
+                if result is None and pool is not None and len(task[0]) >= self._PARALLEL_MIN:
+                    result = pool.submit(_formatbody, task)
+                bodies[oid] = (task, key, result)
+
+            for o in objects:
+                if id(o) not in bodies:
+                    self._parseobj(o)
+                    continue
+
+                task, key, result = bodies.pop(id(o))
+
+                self.brk()
+                self.onoperation(o)
+
+                # A delayed Z move left over from a previous object
+                # must be output by this operation, so it cannot
+                # use the output formatted on its own.
+                if self.delayed_z is not None:
+                    if isinstance(result, concurrent.futures.Future):
+                        result.cancel()
+                    self._parsecmds(o.Path.Commands)
+                    continue
+
+                if isinstance(result, concurrent.futures.Future):
+                    result = result.result()
+                elif result is None:
+                    result = self.formatbody_alone(task)
+                else:
+                    key = None
+
+                if key is not None:
+                    self.cache.put(key, result)
+
+                self.stitchbody(*result)
+
+        if self.cache is not None:
+            self.cache.evict()
+
+    # Format an operation on its own in this process, using a
+    # post-processor with the same arguments as this one.
+    def formatbody_alone(self, task):
+        if self.bodyformatter is None:
+            self.bodyformatter = MillenniumOSPostProcessor(args=self.args)
+        return self.bodyformatter.formatbody(*task)
+
+    # Return a pool of worker processes if formatting in
+    # parallel, otherwise a context that returns None. Workers
+    # are started fresh rather than forked, as forking a process
+    # with other threads running is unsafe, and are passed the
+    # arguments of this post.
+    def workerpool(self):
+        if self.parallel < 2:
+            return contextlib.nullcontext()
+
+        import multiprocessing
+        import concurrent.futures
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.parallel, mp_context=context, initializer=_initworker, initargs=(self.args,))
+
+    # Return the settings that affect the output of operations
+    def cachesettings(self):
+        settings = sorted((k, v) for k, v in vars(self.args).items() if k not in self._CACHE_IGNORED_ARGS)
+        return (RELEASE.VERSION, settings)
+
+    # Return the commands of an operation as (name, parameters)
+    # tuples if it can be formatted on its own, otherwise None.
+    def independent(self, obj, minimum):
+        if not hasattr(obj, 'Proxy') or type(obj.Proxy).__name__ in ('Comment', 'Fixture', 'ToolController'):
+            return None
+
+        cmds = obj.Path.Commands
+        if len(cmds) < minimum:
+            return None
+
+        codes = set(self._MOVES + self._MODAL_SETTINGS + self._UNSUPPORTED + [GCODES.DWELL])
+        allowed = self._PARALLEL_PARAMS
+        names = {}
+        out = []
+        for c in cmds:
+            name = c.Name
+            ok = names.get(name)
+            if ok is None:
+                ok = names[name] = name[0] == '(' or (name[0].upper() == 'G' and float(name[1:]) in codes)
+            params = c.Parameters
+            if not ok or not params.keys() <= allowed:
+                return None
+            out.append((name, params))
+        return out
+
+    # Work out the state each independent operation starts in.
+    # The active tool and the position of the last move are the
+    # only state carried into them. Returns the commands, tool
+    # radius, start position, precision, stock and safe height
+    # of each, by object id.
+    def bodies(self, objects, minimum):
+        tasks = {}
+        tool = self.tool
+        radii = {}
+        position = self.position.copy()
+
+        for o in objects:
+            proxy = type(o.Proxy).__name__ if hasattr(o, 'Proxy') else None
+            if proxy == 'ToolController':
+                radii[o.ToolNumber] = self.toolparams(o)['radius']
+
+            cmds = self.independent(o, minimum)
+            if cmds is not None:
+                # Position only affects the output of pipeline stages
+                tasks[id(o)] = (cmds, radii.get(tool, 0), position.copy() if self.stages else None, self.opprecision(o),
+                    self.stockbounds(o) if self.air_moves else None,
+                    self.safeheight(o) if self.keep_tool_down or self.optimise_rapids else None)
+            else:
+                for c in o.Path.Commands:
+                    if c.Name[0].upper() == 'M' and ARGS.TOOL in c.Parameters and float(c.Name[1:]) in self._TOOL_CHANGES:
+                        tool = c.Parameters[ARGS.TOOL]
+
+            if not self.stages:
+                continue
+
+            # Track the position of the last move
+            missing = set(position)
+            for c in reversed(o.Path.Commands):
+                if not missing:
+                    break
+                if c.Name[0].upper() != 'G' or float(c.Name[1:]) not in self._MOVES:
+                    continue
+                for k in missing & c.Parameters.keys():
+                    position[k] = self._parseparam(None, k, c.Parameters[k])
+                missing -= c.Parameters.keys()
+
+        return tasks
+
+    # Format the commands of an operation on their own, starting
+    # from the state set by onoperation(). Returns the output
+    # lines and the state left behind.
+    def formatbody(self, cmds, radius, position, precision, stock, safe_height):
+        self.setprecision(precision)
+        self.stock = stock
+        self.safe_height = safe_height
+        self.tools = {None: {'params': {'radius': radius}}}
+        self.tool = None
+        if position is not None:
+            self.position = position
+        self.xy_seen = False
+        self.delayed_z = None
+        self._forceAll()
+        for stage in self.stages:
+            stage.begin()
+
+        store = LineStore()
+        setattr(self, Section.RUN, store)
+        with self.Section(Section.RUN):
+            self._parsecmds(itertools.starmap(PlainCommand, cmds))
+
+        delayed_z = None
+        if self.delayed_z is not None:
+            dcmd, dchanged, dmove = self.delayed_z
+            delayed_z = (dcmd, dchanged, dmove.code, dmove.params)
+
+        state = {k: [o.lastCode for o in v] for k, v in self._G.varFormats.items()}
+        return list(store), state, self.xy_seen, delayed_z, self.position
+
+    # Output the lines of an operation formatted on its own and
+    # restore the state it left behind.
+    def stitchbody(self, lines, state, xy_seen, delayed_z, position):
+        self.additions.extend(lines)
+
+        for k, codes in state.items():
+            for o, code in zip(self._G.varFormats[k], codes):
+                o.lastCode = code
+
+        self.xy_seen = xy_seen
+        if self.stages:
+            self.position = position
+        if delayed_z is not None:
+            dcmd, dchanged, code, params = delayed_z
+            self.delayed_z = [dcmd, dchanged, Move(code, params, None, None)]
+
+    # Format the extents of each axis for output
+    def extent(self, lo, hi):
+        ranges = []
+        for axis, low, high in zip(Machine.AXES, lo, hi):
+            if low <= high:
+                ranges.append("{} {:.3f} to {:.3f}".format(axis, low, high))
+            else:
+                ranges.append("{} -".format(axis))
+        return ', '.join(ranges)
+
+    # Fail if the output moves exceed the machine limits
+    def checklimits(self):
+        if not self.bounds:
+            return
+        errors = self.bounds.violations()
+        if errors:
+            raise ValueError("Moves exceed machine limits:\n" + '\n'.join(errors))
+
     def rapid(self, x, y, z):
         return self.G(GCODES.RAPID, X=x, Y=y, Z=z, ctrl=Control.FORCE)
 
     def linear(self, x, y, z, f):
         return self.G(GCODES.LINEAR, X=x, Y=y, Z=z, F=f, ctrl=Control.FORCE)
 
-    def output(self):
+    def finalise(self):
         with self.Section(Section.PRE):
             self.comment("Begin preamble")
 
@@ -932,6 +5009,31 @@ class MillenniumOSPostProcessor(PostProcessor):
                     self.M(MCODES.ADD_TOOL, P=index, R=tool['params']['radius'], S=rrf_safe_string(tool['name'][:32]), ctrl=Control.FORCE)
                 self.brk()
 
+            if self.timer:
+                self.comment("Estimated cycle time:")
+                rows = self.timer.report()
+                width = max(len(label) for label, _ in rows)
+                for label, seconds in rows:
+                    self.comment("  {} {}".format(label.ljust(width), timedelta(seconds=round(seconds))))
+                self.comment("Excludes probing, spindle acceleration and operator interaction")
+                self.brk()
+
+            if self.scheduler:
+                self.comment("Operations grouped by tool: {} tool changes, {} saved".format(
+                    self.scheduler.after, self.scheduler.before - self.scheduler.after))
+                self.brk()
+
+            if self.bounds:
+                self.comment("Move extents in work coordinates:")
+                rows = []
+                for wcs, lo, hi, operations in self.bounds.extents():
+                    rows.append(('WCS {}'.format(wcs) if wcs is not None else 'Current WCS', lo, hi))
+                    rows.extend(('  ' + label, olo, ohi) for label, olo, ohi in operations)
+                width = max((len(label) for label, _, _ in rows), default=0)
+                for label, lo, hi in rows:
+                    self.comment("  {} {}".format(label.ljust(width), self.extent(lo, hi)))
+                self.brk()
+
             # Output job setup commands if necessary
             if self.args.output_job_setup:
                 if self.args.home_before_start:
@@ -947,7 +5049,7 @@ class MillenniumOSPostProcessor(PostProcessor):
                 self.comment("WCS Probing Mode: {}".format(self.args.probe_mode));
                 self.brk()
                 if self.args.probe_mode == PROBE.AT_START:
-                    for wcs in self.used_wcs:
+                    for wcs in self.probeorder():
                         self.probe(wcs)
 
             self.comment("Movement configuration")
@@ -977,27 +5079,92 @@ class MillenniumOSPostProcessor(PostProcessor):
             self.comment("Double-check spindle is stopped!")
             self.M(self._SPINDLE_ACTIONS_STOP[0])
 
-        return super().output()
+            # Output time is only included in the profile sidecar
+            if self.profiler is not None:
+                self.brk()
+                for line in self.profiler.summary():
+                    self.comment(line)
+
+# Commands extracted from FreeCAD objects so they can
+# be passed to worker processes.
+PlainCommand = collections.namedtuple('PlainCommand', ['Name', 'Parameters'])
+
+# Post-processor used by each worker process to format
+# operations in parallel, created with the arguments of the
+# post that started the worker. Only set in worker processes.
+_worker = None
+
+def _initworker(args):
+    global _worker
+    _worker = MillenniumOSPostProcessor(args=args)
+
+def _formatbody(task):
+    return _worker.formatbody(*task)
 
 # Parse and export the CAM objects.
-def export(objectslist, _, argstring):
+def export(objectslist, filename, argstring):
     try:
-        args = parser.parse_args(shlex.split(argstring))
+        args = argparser().parse_args(shlex.split(argstring))
     except Exception as e:
         import pprint
         pprint.pprint(e)
         sys.exit(1)
 
+    # Measure the post if profiling is enabled
+    profiler = Profiler() if args.profile else None
+
+    with profiler.enabled() if profiler is not None else contextlib.nullcontext():
+        out = post(objectslist, filename, args, profiler)
+
+    if profiler is not None and filename != '-':
+        profiler.save(os.path.splitext(filename)[0] + '.profile.json')
+
+    return out
+
+# Post-process the CAM objects, returning the gcode. It is
+# also written straight to the output files if any option
+# that writes files alongside them is enabled. When streaming
+# to a file, the gcode is only written and None is returned.
+def post(objectslist, filename, args, profiler=None):
     # Instantiate the Milo post-processor
     pp = MillenniumOSPostProcessor(args=args)
+    pp.profiler = profiler
 
     pp.parse(objectslist)
 
+    # Fail before writing any output if moves exceed the
+    # machine limits.
+    pp.checklimits()
+
+    # Split large jobs into multiple files. The output is then
+    # a master file that calls each of them.
+    if (args.split_lines or args.split_bytes) and filename != '-':
+        pp.split(filename, args.split_lines, args.split_bytes)
+
+    # Compressed copies, checksums and the index are written
+    # alongside the output file, so it must be written here.
+    direct = filename != '-' and (args.stream or args.compress or args.checksum or args.index)
+    import FreeCAD
+    editor = FreeCAD.GuiUp and args.show_editor
+
+    # When streaming, write the gcode straight to the output
+    # files rather than building it in memory. Nothing is
+    # returned, as reading the file back would hold the whole
+    # job in memory again, so there is no gcode to show in the
+    # editor either.
+    if direct and args.stream:
+        pp.save(filename)
+        return None
+
     # Generate the output gcode
-    out = pp.output()
+    out = generated = pp.output()
 
     # If GUI requested, open editor window
-    if FreeCAD.GuiUp and args.show_editor:
+    if editor:
+        import Path.Post.Utils as PostUtils
         out = PostUtils.editor(out)
 
+    if direct:
+        pp.save(filename, out, index=out == generated)
+
     return out